@@ -0,0 +1,294 @@
+
+import asyncio
+import signal
+import logging
+import watchdog
+
+"""
+asyncio runtime
+---------------
+Optional replacement of the serial and MQTT threads. All devices and the MQTT client run on a single
+asyncio loop:
+- The serialports are read non-blocking, data is processed as soon as the file descriptor is readable.
+- The MQTT socket is driven by the loop (see the paho asyncio example), no 'loop_start' thread is used.
+- Publishing is done directly after a telegram, or on a timer when a 'publish_interval' is configured.
+- Reconnects of the serialport and MQTT broker use an exponential backoff, a stalled serialport
+  (no telegram before the deadline of the watchdog) is reopened.
+- A SIGINT/SIGTERM cancels everything, shutdown doesn't wait on a serial timeout or publish interval.
+
+The serial readers and the publisher are the TaskReadSerial and TaskDoMQTT objects, only their
+OpenSerial/HandleLine/Opened/ReadTimeout/Stalled/SerialError/CheckReopen and CreateClient/Publish/PublishOffline/CheckReconnect
+methods are used (not the threads).
+"""
+
+logger = logging.getLogger('s0pcm.asyncio')
+
+class AsyncEngine():
+
+    def __init__(self, readers, publisher, config):
+        self._readers = readers
+        self._publisher = publisher
+        self._config = config
+
+        self._loop = None
+        self._stop = None
+        self._trigger = None
+        self._disconnected = None
+        self._mqttc = None
+
+    def Stop(self):
+        logger.debug('Stop requested')
+        self._stop.set()
+
+    def Run(self):
+        asyncio.run(self._Main())
+
+    async def _Main(self):
+
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._trigger = asyncio.Event()
+        self._disconnected = asyncio.Event()
+        self._publisher.SetWakeup(lambda: self._loop.call_soon_threadsafe(self._trigger.set))
+
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            self._loop.add_signal_handler(signum, self.Stop)
+
+        tasks = [asyncio.ensure_future(self._ReadDevice(reader)) for reader in self._readers]
+        tasks.append(asyncio.ensure_future(self._Mqtt()))
+        tasks.append(asyncio.ensure_future(self._Publish()))
+
+        # A task should never stop, if it does (e.g. an exception) we stop everything
+        stop = asyncio.ensure_future(self._stop.wait())
+        done, pending = await asyncio.wait(tasks + [stop], return_when=asyncio.FIRST_COMPLETED)
+
+        for task in done:
+            if task != stop and task.exception() != None:
+                logger.error('Fatal exception has occured', exc_info=task.exception())
+
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        self._Disconnect()
+
+    # --------------------------------------------------------------------------------
+    # Read a serialport. The port is opened non-blocking and the data is read when
+    # the file descriptor becomes readable.
+    # --------------------------------------------------------------------------------
+    async def _ReadDevice(self, reader):
+
+        backoff = watchdog.Backoff(reader.device['connect_retry'])
+
+        while True:
+            # Connecting to a network serialport can take a while, it is done outside the loop
+            try:
+                ser = await self._loop.run_in_executor(None, reader.OpenSerial, 0)
+            except Exception as e:
+                delay = backoff.Next()
+                reader.SerialError()
+                logger.error('%sSerialport connection failed. %s: \'%s\'', reader.prefix, type(e).__name__, str(e))
+                logger.error('%sRetry in %.1f seconds', reader.prefix, delay)
+                await asyncio.sleep(delay)
+                continue
+
+            reader.Opened()
+            stalled = False
+
+            readable = asyncio.Event()
+            self._loop.add_reader(ser.fileno(), readable.set)
+            reader.SetWakeup(lambda: self._loop.call_soon_threadsafe(readable.set))
+            buffer = b''
+
+            try:
+                while True:
+                    # Wait for data until the deadline of the watchdog
+                    await asyncio.wait_for(readable.wait(), reader.ReadTimeout())
+                    readable.clear()
+
+                    if reader.CheckReopen():
+                        break
+
+                    # With timeout=0, read() never blocks. It raises an exception if the device is gone.
+                    buffer += ser.read(max(ser.in_waiting, 1))
+
+                    while True:
+                        index = buffer.find(b'\n')
+                        if index < 0:
+                            break
+                        datain = buffer[:index + 1]
+                        buffer = buffer[index + 1:]
+
+                        if reader.HandleLine(datain):
+                            backoff.Reset()
+
+            except asyncio.TimeoutError:
+                reader.Stalled()
+                stalled = True
+
+                # Publish the stalled state
+                self._trigger.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error('%sSerialport read error. %s: \'%s\'', reader.prefix, type(e).__name__, str(e))
+                reader.SerialError()
+                stalled = True
+            finally:
+                reader.SetWakeup(None)
+                self._loop.remove_reader(ser.fileno())
+                ser.close()
+
+            # Don't reopen a stalled or failing device in a tight loop
+            if stalled:
+                delay = backoff.Next()
+                logger.error('%sRetry in %.1f seconds', reader.prefix, delay)
+                await asyncio.sleep(delay)
+
+    # --------------------------------------------------------------------------------
+    # The MQTT socket callbacks, the socket is driven by our loop. The callbacks can
+    # also be called from the executor (connect), then they are passed to our loop.
+    # --------------------------------------------------------------------------------
+    def _Call(self, function, *args):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop.call_soon_threadsafe(function, *args)
+            return
+        function(*args)
+
+    def _OnSocketOpen(self, client, userdata, sock):
+        self._Call(self._loop.add_reader, sock, client.loop_read)
+
+    def _OnSocketClose(self, client, userdata, sock):
+        # The socket is closed directly after this callback, so no call_soon_threadsafe
+        self._loop.remove_reader(sock)
+        self._loop.remove_writer(sock)
+        self._Call(self._disconnected.set)
+
+    def _OnSocketRegisterWrite(self, client, userdata, sock):
+        self._Call(self._loop.add_writer, sock, client.loop_write)
+
+    def _OnSocketUnregisterWrite(self, client, userdata, sock):
+        self._Call(self._loop.remove_writer, sock)
+
+    def _OnConnect(self, client, userdata, flags, rc):
+        self._publisher.on_connect(client, userdata, flags, rc)
+
+        # Publish directly after the broker acknowledged the connection
+        if rc == 0:
+            self._trigger.set()
+
+    # --------------------------------------------------------------------------------
+    # Connect and reconnect to the MQTT broker
+    # --------------------------------------------------------------------------------
+    def _CreateClient(self):
+        self._mqttc = self._publisher.CreateClient()
+        self._mqttc.on_connect = self._OnConnect
+        self._mqttc.on_socket_open = self._OnSocketOpen
+        self._mqttc.on_socket_close = self._OnSocketClose
+        self._mqttc.on_socket_register_write = self._OnSocketRegisterWrite
+        self._mqttc.on_socket_unregister_write = self._OnSocketUnregisterWrite
+
+    async def _Mqtt(self):
+
+        self._CreateClient()
+
+        backoff = watchdog.Backoff(self._config['mqtt']['connect_retry'])
+        reconnect = False
+
+        while True:
+            # A new client after a reload, the client id, TLS or last will can be changed
+            if self._publisher.CheckReconnect() or reconnect:
+                self._CreateClient()
+                self._publisher.Republish()
+                reconnect = False
+
+            logger.debug('Connecting to MQTT Broker \'%s:%s\'', self._config['mqtt']['host'], str(self._config['mqtt']['port']))
+
+            self._disconnected.clear()
+
+            # The TCP connect itself is blocking, do it in an executor
+            try:
+                await self._loop.run_in_executor(None, self._mqttc.connect, self._config['mqtt']['host'], self._config['mqtt']['port'], 60)
+            except Exception as e:
+                delay = backoff.Next()
+                logger.error('MQTT connection failed. %s: \'%s\'', type(e).__name__, str(e))
+                logger.error('Retry in %.1f seconds', delay)
+                await asyncio.sleep(delay)
+                continue
+
+            backoff.Reset()
+
+            # Keepalive handling, until the socket is closed
+            while not self._disconnected.is_set():
+                self._mqttc.loop_misc()
+
+                # Disconnect, the socket is closed after the disconnect is sent
+                if not reconnect and self._publisher.CheckReconnect():
+                    reconnect = True
+                    self._publisher.PublishOffline()
+                    self._mqttc.disconnect()
+
+                try:
+                    await asyncio.wait_for(self._disconnected.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+
+            if reconnect:
+                continue
+
+            delay = backoff.Next()
+            logger.error('MQTT connection lost, retry in %.1f seconds', delay)
+            await asyncio.sleep(delay)
+
+    # --------------------------------------------------------------------------------
+    # Publish on new data, or on a fixed interval
+    # --------------------------------------------------------------------------------
+    async def _Publish(self):
+
+        deadline = self._loop.time()
+
+        while True:
+            # The interval can be changed by a reload
+            interval = self._config['s0pcm']['publish_interval']
+
+            # Also wake up when a held back value or heartbeat of a publish policy is due
+            if interval == None:
+                try:
+                    await asyncio.wait_for(self._trigger.wait(), self._publisher.NextDue())
+                except asyncio.TimeoutError:
+                    pass
+                self._trigger.clear()
+            else:
+                # Don't drift, the next publish is relative to the previous deadline. The
+                # outbox (if any) is drained when we are woken up in between.
+                deadline = max(deadline + interval, self._loop.time())
+                while self._loop.time() < deadline:
+                    try:
+                        await asyncio.wait_for(self._trigger.wait(), deadline - self._loop.time())
+                    except asyncio.TimeoutError:
+                        break
+                    self._trigger.clear()
+                    self._publisher.Drain()
+
+            self._publisher.Publish()
+
+    def _Disconnect(self):
+
+        if self._mqttc == None:
+            return
+
+        # The values which are held back by a publish policy
+        self._publisher.Publish(flush=True)
+
+        self._publisher.PublishOffline()
+        self._mqttc.disconnect()
+
+        # Flush the offline message and disconnect, the loop isn't serving the socket anymore
+        try:
+            self._mqttc.loop_write()
+        except Exception:
+            pass
+
+# End
@@ -0,0 +1,108 @@
+
+import time
+import queue
+import threading
+import logging
+import logging.handlers
+
+import metrics
+
+"""
+Asynchronous logging
+--------------------
+The log records are put on a bounded queue and written to the logfile by a background thread, so a
+slow disk never delays the processing of a telegram. The message of a record is formatted by the
+background thread (the arguments of a log call should therefore not be changed afterwards). When the
+queue is full the record is dropped.
+
+Warnings and errors are rate limited per message type (the place of the log call), e.g. a serialport
+or MQTT broker which fails in a loop. At most 'rate_limit' messages per 'rate_interval' seconds are
+logged, the number of suppressed messages is added to the next message of that type which is logged.
+"""
+
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, limit=10, interval=60, level=logging.WARNING):
+        super().__init__()
+        self._level = level
+        self._lock = threading.Lock()
+
+        # Per message type: [start of the window, messages in the window, suppressed messages]
+        self._types = {}
+
+        self.Configure(limit, interval)
+
+    # A limit of 0 disables the rate limiting
+    def Configure(self, limit, interval):
+        self._limit = limit
+        self._interval = interval
+
+    def filter(self, record):
+
+        if record.levelno < self._level or self._limit == 0:
+            return True
+
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+
+        with self._lock:
+            try:
+                state = self._types[key]
+            except KeyError:
+                state = [now, 0, 0]
+                self._types[key] = state
+
+            # A new window, report the messages which are suppressed in the previous one
+            suppressed = 0
+            if now - state[0] >= self._interval:
+                suppressed = state[2]
+                state[0] = now
+                state[1] = 0
+                state[2] = 0
+
+            state[1] += 1
+            if state[1] > self._limit:
+                state[2] += 1
+                metrics.logsuppressed.Inc(record.levelname.lower())
+                return False
+
+        if suppressed > 0:
+            record.msg = str(record.msg) + ' (' + str(suppressed) + ' similar message(s) suppressed)'
+
+        return True
+
+class QueueHandler(logging.handlers.QueueHandler):
+
+    # The record is formatted by the writer thread, not by the caller
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.logdropped.Inc()
+
+class AsyncLog():
+
+    def __init__(self, handler, queue_size=10000, rate_limit=10, rate_interval=60):
+        self.handler = QueueHandler(queue.Queue(queue_size))
+        self._filter = RateLimitFilter(rate_limit, rate_interval)
+        self.handler.addFilter(self._filter)
+
+        self._listener = logging.handlers.QueueListener(self.handler.queue, handler, respect_handler_level=True)
+        self._listener.start()
+
+    # --------------------------------------------------------------------------------
+    # Change the settings, e.g. by a reload
+    # --------------------------------------------------------------------------------
+    def Configure(self, queue_size, rate_limit, rate_interval):
+        self.handler.queue.maxsize = queue_size
+        self._filter.Configure(rate_limit, rate_interval)
+
+    # Write the queued records and stop the writer thread
+    def Stop(self):
+        if self._listener._thread != None:
+            self._listener.stop()
+
+# End
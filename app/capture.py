@@ -0,0 +1,154 @@
+
+import os
+import time
+import struct
+import datetime
+import argparse
+
+"""
+Telegram capture
+----------------
+The raw lines as read from the serialport (also invalid ones) are stored with their receive time in
+a binary file per device, 'capture.bin' or 'capture-<device>.bin'. When the file is bigger then the
+configured size, it is renamed to '.1' and a new file is started.
+
+A capture can be replayed through the S0PCM-Reader (see the 'replay' command), the ReplaySource
+replaces the serialport and returns the lines at the original pace, N times faster or as fast as
+possible. The receive time of a line is used as the time of the telegram, so the day changes happen
+like they did when the telegrams were received.
+
+File layout (little endian):
+Header:
+  magic     8s  b'S0PCMCP1'
+  length    H   length of the device name, 0 with a single S0PCM
+  name      the device name (utf-8)
+Record:
+  timestamp q   microseconds since epoch (UTC)
+  length    H   length of the line
+  line      the raw line, including the '\r\n'
+
+Print a capture:
+python capture.py /config/capture.bin
+"""
+
+MAGIC = b'S0PCMCP1'
+NAME = struct.Struct('<H')
+RECORD = struct.Struct('<qH')
+
+class CaptureWriter():
+
+    def __init__(self, filename, name, max_size):
+        self._filename = filename
+        self._name = name
+        self._max_size = max_size
+        self._f = None
+        self._Open()
+
+    def _Open(self):
+        self._f = open(self._filename, 'ab')
+        if self._f.tell() == 0:
+            name = b'' if self._name == None else self._name.encode('utf-8')
+            self._f.write(MAGIC + NAME.pack(len(name)) + name)
+            self._f.flush()
+
+    def Append(self, timestamp, line):
+        self._f.write(RECORD.pack(int(timestamp * 1000000), len(line)) + line)
+        self._f.flush()
+
+        if self._max_size != None and self._f.tell() >= self._max_size:
+            self._f.close()
+            os.replace(self._filename, self._filename + '.1')
+            self._Open()
+
+    def Close(self):
+        if self._f != None:
+            self._f.close()
+            self._f = None
+
+# ------------------------------------------------------------------------------------
+# Read a capture file, returns the device name and a generator of (timestamp, line)
+# ------------------------------------------------------------------------------------
+def ReadCapture(filename):
+
+    f = open(filename, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        f.close()
+        raise ValueError('\'' + filename + '\' is not a capture file')
+
+    length = NAME.unpack(f.read(NAME.size))[0]
+    name = f.read(length).decode('utf-8') if length > 0 else None
+
+    def Records():
+        with f:
+            while True:
+                header = f.read(RECORD.size)
+                # A partial written last record (e.g. power failure) is ignored
+                if len(header) < RECORD.size:
+                    return
+                timestamp, length = RECORD.unpack(header)
+                line = f.read(length)
+                if len(line) < length:
+                    return
+                yield timestamp / 1000000, line
+
+    return name, Records()
+
+# ------------------------------------------------------------------------------------
+# Replaces the serialport with a capture. The speed is a factor of the original pace,
+# 0 means as fast as possible. 'timestamp' is the receive time of the last line.
+# ------------------------------------------------------------------------------------
+class ReplaySource():
+
+    def __init__(self, filename, speed=1):
+        self.name, self._records = ReadCapture(filename)
+        self._speed = speed
+        self._first = None
+        self._start = None
+        self.timestamp = None
+        self.count = 0
+
+    def readline(self):
+        try:
+            timestamp, line = next(self._records)
+        except StopIteration:
+            return b''
+
+        if self._speed > 0:
+            if self._first == None:
+                self._first = timestamp
+                self._start = time.monotonic()
+            delay = self._start + (timestamp - self._first) / self._speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        self.timestamp = timestamp
+        self.count += 1
+        return line
+
+    def close(self):
+        self._records.close()
+
+# ------------------------------------------------------------------------------------
+# The 'replay' command of the S0PCM-Reader
+# ------------------------------------------------------------------------------------
+def AddArguments(subparsers):
+    parser = subparsers.add_parser('replay', help='Replay capture files', description='Replay one or more capture files through the S0PCM-Reader, instead of reading the serialports')
+    parser.add_argument('filenames', help='The capture file(s), e.g. /config/capture.bin', nargs='+')
+    parser.add_argument('-s', '--speed', help='Replay N times faster then captured, 0 is as fast as possible. Default is 1.', type=float, default=1)
+    parser.add_argument('--no-mqtt', help='Don\'t publish to MQTT, e.g. to only rebuild \'measurement.yaml\' or the history', action='store_true')
+
+def main():
+    parser = argparse.ArgumentParser(prog='capture', description='Print the lines of a S0PCM-Reader capture file')
+    parser.add_argument('filename', help='The capture file, e.g. /config/capture.bin')
+    args = parser.parse_args()
+
+    name, records = ReadCapture(args.filename)
+    if name != None:
+        print('# device: ' + name)
+    for timestamp, line in records:
+        print(datetime.datetime.fromtimestamp(timestamp).isoformat(sep=' ', timespec='milliseconds') + ';' + repr(line)[2:-1])
+
+if __name__ == '__main__':
+    main()
+
+# End
@@ -0,0 +1,202 @@
+
+import threading
+import collections
+
+"""
+Counter store
+-------------
+Holds the counters of every device and input. Every field has a version, which is taken from a single
+monotonically increasing counter of the store. A reader (e.g. the MQTT publisher) remembers the last
+version it has seen and only fetches the inputs and fields which are changed since that version. The
+values are returned as immutable snapshots, so no copy of the complete measurement is required.
+Another thread can wait for the next change (e.g. a long-poll of the query API).
+"""
+
+# The counters which are stored in the 'measurement.yaml' file
+FIELDS = ('pulsecount', 'total', 'today', 'yesterday', 'this_hour', 'this_week', 'this_month', 'last_month')
+
+# All fields with a version, the 'rates' are derived (see 'rates.py') and not stored
+VERSIONED = FIELDS + ('rates',)
+
+# Immutable copy of an input, handed out to other threads
+CounterSnapshot = collections.namedtuple('CounterSnapshot', ['device', 'input', 'name', 'enabled'] + list(FIELDS) + ['rates', 'version'])
+
+class InputCounter():
+
+    __slots__ = ('device', 'input', 'name', 'enabled') + FIELDS + ('rates', 'versions', 'version', '_snapshot')
+
+    def __init__(self, device, input):
+        self.device = device
+        self.input = input
+        self.name = None
+        self.enabled = None
+        for field in FIELDS:
+            setattr(self, field, 0)
+        self.rates = ()
+
+        # The version per field and of the complete input
+        self.versions = dict([(field, 0) for field in VERSIONED])
+        self.version = 0
+        self._snapshot = None
+
+    def Snapshot(self):
+        if self._snapshot == None or self._snapshot.version != self.version:
+            self._snapshot = CounterSnapshot(self.device, self.input, self.name, self.enabled, self.pulsecount, self.total, self.today, self.yesterday,
+                                             self.this_hour, self.this_week, self.this_month, self.last_month, self.rates, self.version)
+        return self._snapshot
+
+class CounterStore():
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._version = 0
+        self._records = {}
+        self._dates = {}
+        self._hours = {}
+
+        # The inputs ordered by version, the last changed input is at the end
+        self._changes = collections.OrderedDict()
+
+    @property
+    def version(self):
+        return self._version
+
+    # --------------------------------------------------------------------------------
+    # Load the counters of a device, as read from the 'measurement.yaml' file
+    # --------------------------------------------------------------------------------
+    def Load(self, device, content):
+        with self._lock:
+            for key in content:
+                if not isinstance(key, int):
+                    continue
+
+                record = self._Record(device, key)
+                if content[key] == None:
+                    continue
+
+                record.name = content[key].get('name')
+                record.enabled = content[key].get('enabled')
+                self._Set(record, dict([(field, content[key][field]) for field in FIELDS if field in content[key]]))
+
+            if 'date' in content:
+                self._dates[device] = content['date']
+            if 'hour' in content:
+                self._hours[device] = content['hour']
+
+    # --------------------------------------------------------------------------------
+    # The counters of a device, in the format of the 'measurement.yaml' file
+    # --------------------------------------------------------------------------------
+    def Dump(self, device):
+        with self._lock:
+            content = {}
+            if device in self._dates:
+                content['date'] = self._dates[device]
+            if device in self._hours:
+                content['hour'] = self._hours[device]
+
+            for (name, key), record in self._records.items():
+                if name != device:
+                    continue
+
+                content[key] = {}
+                if record.name != None: content[key]['name'] = record.name
+                if record.enabled != None: content[key]['enabled'] = record.enabled
+                for field in FIELDS:
+                    content[key][field] = getattr(record, field)
+
+            return content
+
+    def Date(self, device):
+        return self._dates.get(device)
+
+    def SetDate(self, device, date):
+        self._dates[device] = date
+
+    # The local hour (0-23) of the 'this_hour' counter, None if unknown
+    def Hour(self, device):
+        return self._hours.get(device)
+
+    def SetHour(self, device, hour):
+        self._hours[device] = hour
+
+    def _Record(self, device, key):
+        try:
+            return self._records[(device, key)]
+        except KeyError:
+            record = InputCounter(device, key)
+            self._records[(device, key)] = record
+            return record
+
+    def _Set(self, record, values):
+        changed = False
+        for field in values:
+            if getattr(record, field) != values[field]:
+                if not changed:
+                    self._version += 1
+                    changed = True
+                setattr(record, field, values[field])
+                record.versions[field] = self._version
+
+        if changed:
+            record.version = self._version
+            self._changes[(record.device, record.input)] = self._version
+            self._changes.move_to_end((record.device, record.input))
+            self._changed.notify_all()
+
+        return changed
+
+    # --------------------------------------------------------------------------------
+    # Return the current values of an input, a new input starts with all zeros
+    # --------------------------------------------------------------------------------
+    def Get(self, device, key):
+        with self._lock:
+            return self._Record(device, key).Snapshot()
+
+    # If the device has the input, i.e. it is received in a telegram or stored in 'measurement.yaml'
+    def Has(self, device, key):
+        with self._lock:
+            return (device, key) in self._records
+
+    # --------------------------------------------------------------------------------
+    # Update one or more fields of an input, returns True if a value has changed
+    # --------------------------------------------------------------------------------
+    def Update(self, device, key, **values):
+        with self._lock:
+            return self._Set(self._Record(device, key), values)
+
+    # --------------------------------------------------------------------------------
+    # Return the new version and a list of (snapshot, fields) of the inputs which are
+    # changed since the supplied version. Only the changed inputs are visited.
+    # --------------------------------------------------------------------------------
+    def Changes(self, since):
+        with self._lock:
+            changes = []
+            for (device, key) in reversed(self._changes):
+                record = self._records[(device, key)]
+                if record.version <= since:
+                    break
+
+                fields = [field for field in VERSIONED if record.versions[field] > since]
+                changes.append((record.Snapshot(), fields))
+
+            changes.reverse()
+            return self._version, changes
+
+    # --------------------------------------------------------------------------------
+    # Wait until the version is newer then the supplied version, or the timeout (in
+    # seconds) has passed. Returns the current version.
+    # --------------------------------------------------------------------------------
+    def Wait(self, since, timeout):
+        with self._changed:
+            self._changed.wait_for(lambda: self._version > since, timeout)
+            return self._version
+
+    # --------------------------------------------------------------------------------
+    # Immutable snapshot of all inputs
+    # --------------------------------------------------------------------------------
+    def Snapshot(self):
+        with self._lock:
+            return tuple([record.Snapshot() for record in self._records.values()])
+
+# End
@@ -0,0 +1,408 @@
+
+import os
+import re
+import struct
+import heapq
+import datetime
+import logging
+
+"""
+History store
+-------------
+The usage of every input is stored per hour, day and month. Every resolution is a separate file in
+the 'history' folder, e.g. 'history/1.day' or 'history/water-1.day' (with multiple devices). A file
+is an array of fixed-size slots, the position of a slot is calculated from the date. So a lookup of
+a date is a single seek, no index or scan is required.
+
+Next to the usage, every slot also stores the cumulative usage and the cumulative number of slots
+with data. A sum or average of a range is therefore calculated from the first and last slot only.
+
+File layout (little endian):
+Header (32 bytes):
+  magic     8s  b'S0PCMHS1'
+  unit      8s  b'hour', b'day' or b'month'
+  origin    q   index of the first slot
+  reserved  q
+Slot (24 bytes):
+  value     q   usage in the period, -1 if there is no data
+  total     q   cumulative usage, up to and including this slot
+  count     q   cumulative number of slots with data, up to and including this slot
+
+The index of a slot is the hour (date.toordinal() * 24 + hour), day (date.toordinal()) or month
+(year * 12 + month - 1). The history is written by the S0PCM-Reader:
+- hour: the 'this_hour' counter, written at the hour change and on a stop
+- day: the 'yesterday' counter, written at the day change (like the 'dailystat' file)
+- month: the sum of the days of the month, updated at the day change
+"""
+
+logger = logging.getLogger('s0pcm.history')
+
+MAGIC = b'S0PCMHS1'
+HEADER = struct.Struct('<8s8sqq')
+SLOT = struct.Struct('<qqq')
+UNITS = ('hour', 'day', 'month')
+MISSING = -1
+
+# ------------------------------------------------------------------------------------
+# Convert a datetime/date to the slot index of an unit, and back
+# ------------------------------------------------------------------------------------
+def Index(unit, when):
+    if unit == 'hour':
+        return when.toordinal() * 24 + getattr(when, 'hour', 0)
+    elif unit == 'day':
+        return when.toordinal()
+    return when.year * 12 + when.month - 1
+
+def Period(unit, index):
+    if unit == 'hour':
+        return datetime.datetime.combine(datetime.date.fromordinal(index // 24), datetime.time(index % 24))
+    elif unit == 'day':
+        return datetime.date.fromordinal(index)
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+def FormatPeriod(unit, index):
+    if unit == 'hour':
+        return Period(unit, index).strftime('%Y-%m-%d %H:00')
+    elif unit == 'day':
+        return Period(unit, index).strftime('%Y-%m-%d')
+    return Period(unit, index).strftime('%Y-%m')
+
+# ------------------------------------------------------------------------------------
+# Parse a period like '2021', '2021-03', '2021-03-14' or '2021-03-14 10', returns the
+# first and last hour of the period
+# ------------------------------------------------------------------------------------
+def ParsePeriod(text):
+
+    for fmt in ['%Y-%m-%d %H', '%Y-%m-%dT%H', '%Y-%m-%d', '%Y-%m', '%Y']:
+        try:
+            start = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+
+        if '%H' in fmt:
+            end = start
+        elif fmt == '%Y-%m-%d':
+            end = start + datetime.timedelta(hours=23)
+        elif fmt == '%Y-%m':
+            end = (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1) - datetime.timedelta(hours=1)
+        else:
+            end = start.replace(year=start.year + 1) - datetime.timedelta(hours=1)
+
+        return start, end
+
+    raise ValueError('Invalid period \'' + text + '\', use e.g. \'2021\', \'2021-03\', \'2021-03-14\' or \'2021-03-14 10\'')
+
+class HistorySeries():
+
+    def __init__(self, filename, unit, create=True):
+        self._filename = filename
+        self._unit = unit
+
+        flags = os.O_RDWR | os.O_CREAT if create else os.O_RDONLY
+        self._fd = os.open(filename, flags, 0o644)
+
+        header = os.pread(self._fd, HEADER.size, 0)
+        if len(header) == 0 and create:
+            self._origin = None
+            self._count = 0
+        elif len(header) == HEADER.size:
+            magic, fileunit, self._origin, reserved = HEADER.unpack(header)
+            if magic != MAGIC or fileunit.rstrip(b'\0').decode('ascii') != unit:
+                os.close(self._fd)
+                raise ValueError('\'' + filename + '\' is not a history file of unit \'' + unit + '\'')
+            self._count = (os.fstat(self._fd).st_size - HEADER.size) // SLOT.size
+        else:
+            os.close(self._fd)
+            raise ValueError('\'' + filename + '\' is not a history file of unit \'' + unit + '\'')
+
+        if self._count == 0:
+            self._origin = None
+
+    @property
+    def unit(self):
+        return self._unit
+
+    @property
+    def first(self):
+        return self._origin
+
+    @property
+    def last(self):
+        if self._origin == None:
+            return None
+        return self._origin + self._count - 1
+
+    def _Read(self, first, last):
+        data = os.pread(self._fd, (last - first + 1) * SLOT.size, HEADER.size + (first - self._origin) * SLOT.size)
+        return list(SLOT.iter_unpack(data))
+
+    def _Clip(self, first, last):
+        if self._origin == None:
+            return None, None
+        if first == None or first < self._origin:
+            first = self._origin
+        if last == None or last > self.last:
+            last = self.last
+        return first, last
+
+    # --------------------------------------------------------------------------------
+    # The usage of a slot, None if there is no data
+    # --------------------------------------------------------------------------------
+    def Get(self, index):
+        if self._origin == None or index < self._origin or index > self.last:
+            return None
+        value = self._Read(index, index)[0][0]
+        return None if value == MISSING else value
+
+    # --------------------------------------------------------------------------------
+    # Store the usage of one or more slots, as a dict of index and value. The slots
+    # from the first changed slot up to the end are rewritten with a single write.
+    # --------------------------------------------------------------------------------
+    def Set(self, values):
+
+        if len(values) == 0:
+            return
+
+        # Data before the first slot, the complete file is rewritten with a new origin
+        if self._origin == None or min(values) < self._origin:
+            first = min(values) if self._origin == None else min(min(values), self._origin)
+            last = max(values) if self._origin == None else max(max(values), self.last)
+            current = [MISSING] * (last - first + 1)
+            if self._origin != None:
+                for i, slot in enumerate(self._Read(self._origin, self.last)):
+                    current[self._origin - first + i] = slot[0]
+
+            self._origin = first
+            self._Write(first, current, values, (0, 0), replace=True)
+            return
+
+        # A gap between the last slot and the new data is filled with slots without data
+        first = min(min(values), self.last + 1)
+        last = max(max(values), self.last)
+        current = [slot[0] for slot in self._Read(first, self.last)] if first <= self.last else []
+        current += [MISSING] * (last - first + 1 - len(current))
+
+        previous = (0, 0) if first == self._origin else self._Read(first - 1, first - 1)[0][1:]
+        self._Write(first, current, values, previous)
+
+    def _Write(self, first, current, values, previous, replace=False):
+
+        total, count = previous
+        data = bytearray()
+        for i, value in enumerate(current):
+            value = values.get(first + i, value)
+            if value != MISSING:
+                total += value
+                count += 1
+            data += SLOT.pack(value, total, count)
+
+        if replace:
+            # Write a new file and replace the old one, a reader always sees a complete file
+            tmpname = self._filename + '.tmp'
+            with open(tmpname, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, self._unit.encode('ascii'), self._origin, 0))
+                f.write(data)
+            os.replace(tmpname, self._filename)
+            os.close(self._fd)
+            self._fd = os.open(self._filename, os.O_RDWR)
+        else:
+            os.pwrite(self._fd, data, HEADER.size + (first - self._origin) * SLOT.size)
+
+        self._count = max(self._count, first - self._origin + len(current))
+
+    def Add(self, index, delta):
+        value = self.Get(index)
+        self.Set({index: delta if value == None else value + delta})
+
+    # --------------------------------------------------------------------------------
+    # The slots of a range, as a list of (index, value). Slots without data are skipped.
+    # --------------------------------------------------------------------------------
+    def Range(self, first=None, last=None):
+        first, last = self._Clip(first, last)
+        if first == None or first > last:
+            return []
+        return [(first + i, slot[0]) for i, slot in enumerate(self._Read(first, last)) if slot[0] != MISSING]
+
+    # --------------------------------------------------------------------------------
+    # The sum and number of slots with data of a range, only the first and last slot are read
+    # --------------------------------------------------------------------------------
+    def Sum(self, first=None, last=None):
+        first, last = self._Clip(first, last)
+        if first == None or first > last:
+            return 0, 0
+
+        end = self._Read(last, last)[0]
+        if first == self._origin:
+            return end[1], end[2]
+
+        start = self._Read(first - 1, first - 1)[0]
+        return end[1] - start[1], end[2] - start[2]
+
+    def Top(self, number, first=None, last=None, largest=True):
+        if largest:
+            return heapq.nlargest(number, self.Range(first, last), key=lambda slot: slot[1])
+        return heapq.nsmallest(number, self.Range(first, last), key=lambda slot: slot[1])
+
+    def Close(self):
+        os.close(self._fd)
+
+class HistoryStore():
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._series = {}
+
+        # The last completed hour, per series
+        self._hours = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+    def Series(self, name, unit):
+        try:
+            return self._series[(name, unit)]
+        except KeyError:
+            series = HistorySeries(os.path.join(self._directory, name + '.' + unit), unit)
+            self._series[(name, unit)] = series
+            return series
+
+    # --------------------------------------------------------------------------------
+    # Store the usage of an hour (the 'this_hour' counter), written at the hour change
+    # and on a stop. The second hour of a daylight saving time change has the same local
+    # hour, it is added to the first one.
+    # --------------------------------------------------------------------------------
+    def SetHour(self, name, hour, value, final=True):
+
+        index = Index('hour', hour)
+        series = self.Series(name, 'hour')
+
+        if self._hours.get(name) == index:
+            series.Add(index, value)
+        else:
+            series.Set({index: value})
+
+        # A partial hour (e.g. on a stop) is overwritten by the complete hour
+        if final:
+            self._hours[name] = index
+
+    # --------------------------------------------------------------------------------
+    # Store the usage of a complete day, the month is recalculated from its days
+    # --------------------------------------------------------------------------------
+    def SetDay(self, name, date, value):
+        self.SetDays(name, {Index('day', date): value})
+
+    def SetDays(self, name, values):
+
+        days = self.Series(name, 'day')
+        days.Set(values)
+
+        months = {}
+        for index in values:
+            date = Period('day', index)
+            months[Index('month', date)] = date
+
+        result = {}
+        for month, date in months.items():
+            first = Index('day', date.replace(day=1))
+            last = Index('day', (date.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)) - 1
+            total, count = days.Sum(first, last)
+            if count > 0:
+                result[month] = total
+
+        self.Series(name, 'month').Set(result)
+
+    def Close(self):
+        for series in self._series.values():
+            series.Close()
+        self._series = {}
+
+# ------------------------------------------------------------------------------------
+# Import the existing 'daily-<input>.txt' and 'daily-<device>-<input>.txt' files
+# ------------------------------------------------------------------------------------
+def ImportDaily(store, directory):
+
+    result = []
+    for filename in sorted(os.listdir(directory)):
+        match = re.match(r'^daily-(.+)\.txt$', filename)
+        if match == None:
+            continue
+
+        values = {}
+        with open(os.path.join(directory, filename), 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line == '':
+                    continue
+                try:
+                    date, value = line.split(';')
+                    values[Index('day', datetime.datetime.strptime(date, '%Y-%m-%d').date())] = int(value)
+                except ValueError:
+                    logger.warning('\'%s\' has an invalid line \'%s\', ignoring it', filename, line)
+
+        store.SetDays(match.group(1), values)
+        result.append((filename, match.group(1), len(values)))
+
+    return result
+
+# ------------------------------------------------------------------------------------
+# The 'history' command of the S0PCM-Reader
+# ------------------------------------------------------------------------------------
+def AddArguments(subparsers):
+    parser = subparsers.add_parser('history', help='Query the usage history', description='Query the hourly, daily or monthly usage of an input')
+    parser.add_argument('input', help='The input number, e.g. 1', type=int, nargs='?')
+    parser.add_argument('-d', '--device', help='The name of the device, with multiple devices', type=str, default=None)
+    parser.add_argument('-u', '--unit', help='The resolution, default is day', choices=UNITS, default='day')
+    parser.add_argument('-f', '--from', help='Start of the range, e.g. 2021, 2021-03, 2021-03-14 or \'2021-03-14 10\'', dest='start', type=str, default=None)
+    parser.add_argument('-t', '--to', help='End of the range (inclusive), same format as --from', dest='end', type=str, default=None)
+    parser.add_argument('-s', '--sum', help='Print the sum, number of periods and average of the range', action='store_true')
+    parser.add_argument('--top', help='Print the periods with the highest usage', type=int, default=None)
+    parser.add_argument('--bottom', help='Print the periods with the lowest usage', type=int, default=None)
+    parser.add_argument('--import', help='Import the existing daily-*.txt files', dest='importdaily', action='store_true')
+
+def Command(configdirectory, args):
+
+    directory = configdirectory + 'history'
+
+    if args.importdaily:
+        store = HistoryStore(directory)
+        try:
+            for filename, name, count in ImportDaily(store, configdirectory):
+                print('Imported ' + str(count) + ' days of \'' + filename + '\' into \'' + name + '\'')
+        finally:
+            store.Close()
+        return 0
+
+    if args.input == None:
+        print('ERROR: No input supplied')
+        return 1
+
+    name = str(args.input) if args.device == None else args.device + '-' + str(args.input)
+
+    try:
+        first = None if args.start == None else Index(args.unit, ParsePeriod(args.start)[0])
+        last = None if args.end == None else Index(args.unit, ParsePeriod(args.end)[1])
+        series = HistorySeries(os.path.join(directory, name + '.' + args.unit), args.unit, create=False)
+    except (ValueError, OSError) as e:
+        print('ERROR: ' + str(e))
+        return 1
+
+    try:
+        if args.sum:
+            total, count = series.Sum(first, last)
+            average = total / count if count > 0 else 0
+            print(str(total) + ';' + str(count) + ';' + str(round(average, 3)))
+        elif args.top != None:
+            slots = series.Top(args.top, first, last)
+        elif args.bottom != None:
+            slots = series.Top(args.bottom, first, last, largest=False)
+        else:
+            slots = series.Range(first, last)
+
+        if not args.sum:
+            for index, value in slots:
+                print(FormatPeriod(args.unit, index) + ';' + str(value))
+    finally:
+        series.Close()
+
+    return 0
+
+# End
@@ -0,0 +1,226 @@
+
+import os
+import time
+import datetime
+import yaml
+import logging
+
+"""
+Measurement journal
+-------------------
+Instead of rewriting the complete 'measurement.yaml' file on every change, every changed input is
+appended as a small record to 'measurement.journal'. On a configurable interval (or when the journal
+becomes too big) the journal is compacted into 'measurement.yaml', this is done with a write to a
+temporary file and an atomic rename. On start-up the journal is replayed on top of 'measurement.yaml'.
+
+A journal record is a single line with the following fields, separated by a space:
+<date>T<hour> <device> <input> <pulsecount> <total> <today> <yesterday> <this_hour> <this_week> <this_month> <last_month>
+
+The device is '-' when no 'devices' are configured (single S0PCM). E.g.:
+2021-03-14T15 - 1 1234 770123 15 77 3 120 411 1502
+2021-03-14T15 water 1 1234 770123 15 77 3 120 411 1502
+
+Records of older versions have only a date and the counters up to 'yesterday', these are still replayed.
+"""
+
+logger = logging.getLogger('s0pcm.journal')
+
+FIELDS = ['pulsecount', 'total', 'today', 'yesterday', 'this_hour', 'this_week', 'this_month', 'last_month']
+
+def FileSize(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+class MeasurementJournal():
+
+    def __init__(self, measurementname, journalname, compact_interval=3600, compact_size=65536, fsync_interval=60):
+        self._measurementname = measurementname
+        self._journalname = journalname
+        self._compact_interval = compact_interval
+        self._compact_size = compact_size
+        self._fsync_interval = fsync_interval
+
+        self._f = None
+        self._size = FileSize(journalname)
+        self._unsynced = False
+        self._lastsync = time.monotonic()
+        self._lastcompact = time.monotonic()
+
+        # Statistics, used to report the bytes written compared to a full rewrite of the yaml file
+        self._yamlsize = FileSize(measurementname)
+        self._statstart = time.monotonic()
+        self._statbytes = 0
+        self._statrewrite = 0
+
+    # --------------------------------------------------------------------------------
+    # Replay the journal on top of the measurement (read from 'measurement.yaml'). The
+    # measurement is a dict per device, the single S0PCM device is stored as 'None'.
+    # --------------------------------------------------------------------------------
+    def Replay(self, measurement):
+
+        count = 0
+
+        try:
+            with open(self._journalname, 'r') as f:
+                for line in f:
+                    # A partial written last line (e.g. power failure), we just ignore it
+                    if not line.endswith('\n'):
+                        logger.warning('Journal \'%s\' has an incomplete last record, ignoring it', self._journalname)
+                        break
+
+                    record = line.split()
+                    if len(record) != 7 and len(record) != 3 + len(FIELDS):
+                        logger.error('Journal \'%s\' has an invalid record \'%s\', ignoring it', self._journalname, line.rstrip('\n'))
+                        continue
+
+                    try:
+                        hour = None
+                        if 'T' in record[0]:
+                            date = datetime.datetime.strptime(record[0], '%Y-%m-%dT%H')
+                            hour = date.hour
+                            date = date.date()
+                        else:
+                            date = datetime.datetime.strptime(record[0], '%Y-%m-%d').date()
+                        key = int(record[2])
+                        values = [int(value) for value in record[3:]]
+                    except ValueError:
+                        logger.error('Journal \'%s\' has an invalid record \'%s\', ignoring it', self._journalname, line.rstrip('\n'))
+                        continue
+
+                    device = None if record[1] == '-' else record[1]
+                    if not device in measurement:
+                        logger.warning('Journal \'%s\' has a record of unknown device \'%s\', ignoring it', self._journalname, record[1])
+                        continue
+
+                    if not key in measurement[device]: measurement[device][key] = {}
+                    for field, value in zip(FIELDS, values):
+                        measurement[device][key][field] = value
+                    measurement[device]['date'] = date
+                    if hour != None:
+                        measurement[device]['hour'] = hour
+                    count += 1
+        except FileNotFoundError:
+            pass
+
+        if count > 0:
+            logger.info('Replayed %d record(s) from journal \'%s\'', count, self._journalname)
+
+        return count
+
+    # --------------------------------------------------------------------------------
+    # Append the changed inputs of a device to the journal, the inputs are supplied as
+    # counter snapshots (see 'counters.py'). The hour is the hour of 'this_hour'.
+    # --------------------------------------------------------------------------------
+    def Append(self, device, date, snapshots, hour=None):
+
+        if len(snapshots) == 0:
+            return
+
+        if self._f == None:
+            self._f = open(self._journalname, 'a')
+            self._size = self._f.tell()
+
+        prefix = str(date) + ('' if hour == None else 'T%02d' % hour) + ' ' + ('-' if device == None else device) + ' '
+        data = ''
+        for snapshot in snapshots:
+            data += prefix + str(snapshot.input) + ' ' + ' '.join([str(getattr(snapshot, field)) for field in FIELDS]) + '\n'
+
+        self._f.write(data)
+        self._f.flush()
+        self._unsynced = True
+
+        self._size += len(data)
+        self._statbytes += len(data)
+        self._statrewrite += self._yamlsize
+
+        # Batch the fsync, an fsync_interval of 0 means every record is synced directly
+        if time.monotonic() - self._lastsync >= self._fsync_interval:
+            self.Sync()
+
+    # --------------------------------------------------------------------------------
+    # Force the journal to disk
+    # --------------------------------------------------------------------------------
+    def Sync(self):
+        if self._f != None and self._unsynced:
+            os.fsync(self._f.fileno())
+            self._unsynced = False
+        self._lastsync = time.monotonic()
+
+    # The size of the journal, including the records which are not yet compacted at start-up
+    def Size(self):
+        return self._size
+
+    # --------------------------------------------------------------------------------
+    # Check if the journal should be compacted, based on the time and size
+    # --------------------------------------------------------------------------------
+    def NeedCompact(self):
+        if self._size == 0:
+            return False
+        if self._size >= self._compact_size:
+            return True
+        return time.monotonic() - self._lastcompact >= self._compact_interval
+
+    # --------------------------------------------------------------------------------
+    # Write 'measurement.yaml' atomically and truncate the journal
+    # --------------------------------------------------------------------------------
+    def Compact(self, content):
+
+        data = yaml.dump(content, default_flow_style=False)
+
+        tmpname = self._measurementname + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpname, self._measurementname)
+
+        # Make sure the rename itself is also on disk
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(self._measurementname)), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+        # Now the journal is not required anymore
+        if self._f != None:
+            self._f.close()
+            self._f = None
+        with open(self._journalname, 'w'):
+            pass
+
+        logger.debug('Compacted journal \'%s\' into \'%s\' (%d bytes)', self._journalname, self._measurementname, len(data))
+
+        self._size = 0
+        self._unsynced = False
+        self._yamlsize = len(data)
+        self._statbytes += len(data)
+        self._lastcompact = time.monotonic()
+
+    # --------------------------------------------------------------------------------
+    # Report the bytes written per hour, compared to rewriting 'measurement.yaml'
+    # --------------------------------------------------------------------------------
+    def Report(self, force=False):
+
+        elapsed = time.monotonic() - self._statstart
+        if elapsed < 3600 and not force:
+            return
+
+        if elapsed > 0:
+            logger.info('Journal wrote %d bytes/hour, a rewrite of \'%s\' on every change would have written %d bytes/hour', int(self._statbytes * 3600 / elapsed), self._measurementname, int(self._statrewrite * 3600 / elapsed))
+
+        self._statstart = time.monotonic()
+        self._statbytes = 0
+        self._statrewrite = 0
+
+    def Close(self):
+        self.Sync()
+        if self._f != None:
+            self._f.close()
+            self._f = None
+
+# End
@@ -0,0 +1,233 @@
+
+import bisect
+import threading
+import logging
+
+"""
+Metrics
+-------
+Counters, gauges and histograms in the Prometheus text format, served on '/metrics' by a small HTTP
+server thread. The metrics are updated directly by the serial and MQTT code (an update is a dict
+lookup and an addition), the values of the inputs are collected from the counter store when the
+endpoint is scraped. No external package is required.
+"""
+
+logger = logging.getLogger('s0pcm.metrics')
+
+# Buckets in seconds, the parse time is normally in the microseconds and a publish in milliseconds
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+def FormatLabels(labelnames, labelvalues):
+    if len(labelnames) == 0:
+        return ''
+    return '{' + ','.join([name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in zip(labelnames, labelvalues)]) + '}'
+
+def FormatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter():
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def Inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def Samples(self):
+        with self._lock:
+            return [(self.name, labelvalues, value) for labelvalues, value in self._values.items()]
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def Set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+class Histogram():
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def Observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            try:
+                counts = self._values[labelvalues]
+            except KeyError:
+                counts = [0] * (len(self._buckets) + 1) + [0.0]
+                self._values[labelvalues] = counts
+            counts[index] += 1
+            counts[-1] += value
+
+    def Samples(self):
+        samples = []
+        with self._lock:
+            for labelvalues, counts in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self._buckets + (float('inf'),), counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket', labelvalues + (FormatValue(bound),), cumulative))
+                samples.append((self.name + '_count', labelvalues, cumulative))
+                samples.append((self.name + '_sum', labelvalues, counts[-1]))
+        return samples
+
+class Registry():
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def Register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    # --------------------------------------------------------------------------------
+    # A collector is called on every scrape, it updates metrics which are only
+    # required when the endpoint is scraped (e.g. the counters of the inputs)
+    # --------------------------------------------------------------------------------
+    def AddCollector(self, collector):
+        self._collectors.append(collector)
+
+    def Render(self):
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error('Metrics collector failed. %s: \'%s\'', type(e).__name__, str(e))
+
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP ' + metric.name + ' ' + metric.help)
+            lines.append('# TYPE ' + metric.name + ' ' + metric.kind)
+            labelnames = metric.labelnames
+            for name, labelvalues, value in metric.Samples():
+                if name.endswith('_bucket'):
+                    lines.append(name + FormatLabels(labelnames + ('le',), labelvalues) + ' ' + FormatValue(value))
+                else:
+                    lines.append(name + FormatLabels(labelnames, labelvalues) + ' ' + FormatValue(value))
+
+        return '\n'.join(lines) + '\n'
+
+# ------------------------------------------------------------------------------------
+# The metrics of the S0PCM-Reader. The device label is empty with a single S0PCM.
+# ------------------------------------------------------------------------------------
+registry = Registry()
+
+telegrams = registry.Register(Counter('s0pcm_telegrams_total', 'Number of processed telegrams', ('device',)))
+lasttelegram = registry.Register(Gauge('s0pcm_last_telegram_timestamp_seconds', 'Time of the last processed telegram', ('device',)))
+decodeerrors = registry.Register(Counter('s0pcm_decode_errors_total', 'Number of lines which could not be parsed as telegram', ('device',)))
+invalidpackets = registry.Register(Counter('s0pcm_invalid_packets_total', 'Number of empty packets or telegrams of another S0PCM ID', ('device',)))
+serialstalled = registry.Register(Gauge('s0pcm_serial_stalled', 'If no telegram is received within the deadline of the watchdog', ('device',)))
+telegramsmissed = registry.Register(Counter('s0pcm_telegrams_missed_total', 'Number of telegrams which are missed, based on the interval of the telegrams', ('device',)))
+serialreconnects = registry.Register(Counter('s0pcm_serial_reconnects_total', 'Number of failed serialport opens, read errors and stalls', ('device',)))
+workerrestarts = registry.Register(Counter('s0pcm_worker_restarts_total', 'Number of restarts of a worker process which exited (runtime process)', ('device',)))
+devicerestarts = registry.Register(Counter('s0pcm_device_restarts_total', 'Number of times the pulsecount was lower then the stored pulsecount', ('device', 'input')))
+
+parseseconds = registry.Register(Histogram('s0pcm_parse_seconds', 'Time to parse a telegram', ('device',)))
+persistseconds = registry.Register(Histogram('s0pcm_persist_seconds', 'Time to write the changed counters to the journal or measurement file'))
+publishseconds = registry.Register(Histogram('s0pcm_publish_seconds', 'Time to publish the changed counters to MQTT'))
+startupseconds = registry.Register(Gauge('s0pcm_startup_seconds', 'Time from the start of the process to the counters loaded, the MQTT broker connected and the first publish', ('phase',)))
+
+mqttconnected = registry.Register(Gauge('s0pcm_mqtt_connected', 'If the MQTT broker is connected'))
+mqttpublished = registry.Register(Counter('s0pcm_mqtt_published_total', 'Number of MQTT messages handed to the MQTT client'))
+mqttfiltered = registry.Register(Counter('s0pcm_mqtt_filtered_total', 'Number of values held back by a publish policy (deadband or minimum interval)'))
+mqttsent = registry.Register(Counter('s0pcm_mqtt_sent_total', 'Number of MQTT messages sent to the broker'))
+mqttqueue = registry.Register(Gauge('s0pcm_mqtt_queue_depth', 'Number of MQTT messages which are not yet sent to the broker'))
+outboxdepth = registry.Register(Gauge('s0pcm_outbox_depth', 'Number of publishes in the outbox'))
+outboxdropped = registry.Register(Counter('s0pcm_outbox_dropped_total', 'Number of publishes dropped from the outbox, because it was full or too old'))
+
+sinkqueue = registry.Register(Gauge('s0pcm_sink_queue_depth', 'Number of readings in the queue of a sink', ('sink',)))
+sinkdropped = registry.Register(Counter('s0pcm_sink_dropped_total', 'Number of readings dropped because the queue of a sink was full', ('sink',)))
+sinkwritten = registry.Register(Counter('s0pcm_sink_written_total', 'Number of readings written by a sink', ('sink',)))
+sinkerrors = registry.Register(Counter('s0pcm_sink_errors_total', 'Number of failed batch writes of a sink', ('sink',)))
+
+logsuppressed = registry.Register(Counter('s0pcm_log_suppressed_total', 'Number of log messages suppressed by the rate limit', ('level',)))
+apirequests = registry.Register(Counter('s0pcm_api_requests_total', 'Number of query API requests', ('status',)))
+
+logdropped = registry.Register(Counter('s0pcm_log_dropped_total', 'Number of log messages dropped because the log queue was full'))
+
+inputcounter = registry.Register(Gauge('s0pcm_input_counter', 'The total, today, yesterday, hour, week, month and pulsecount counter of an input', ('device', 'input', 'name', 'counter')))
+inputrate = registry.Register(Gauge('s0pcm_input_rate', 'Flow rate/power of an input over a sliding window', ('device', 'input', 'name', 'window')))
+
+# ------------------------------------------------------------------------------------
+# Collect the counters of all inputs from the counter store
+# ------------------------------------------------------------------------------------
+def AddCounterStore(counterstore):
+
+    def Collect():
+        for snapshot in counterstore.Snapshot():
+            labels = ('' if snapshot.device == None else snapshot.device, snapshot.input, '' if snapshot.name == None else snapshot.name)
+            for field in ['total', 'today', 'yesterday', 'this_hour', 'this_week', 'this_month', 'last_month', 'pulsecount']:
+                inputcounter.Set(getattr(snapshot, field), *(labels + (field,)))
+            for window, value in snapshot.rates:
+                inputrate.Set(value, *(labels + (window,)))
+
+        mqttqueue.Set(sum([value for name, labels, value in mqttpublished.Samples()]) - sum([value for name, labels, value in mqttsent.Samples()]))
+
+    registry.AddCollector(Collect)
+
+# ------------------------------------------------------------------------------------
+# The request handler. http.server (with http.client, ssl and email) is only imported
+# when the metrics are served, it is a large part of the start-up time otherwise.
+# ------------------------------------------------------------------------------------
+def MetricsHandler():
+
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            data = registry.Render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug('Metrics: ' + format, *args)
+
+    return Handler
+
+# ------------------------------------------------------------------------------------
+# The HTTP server, it runs in its own (daemon) thread
+# ------------------------------------------------------------------------------------
+class MetricsServer():
+
+    def __init__(self, host, port):
+        from http.server import ThreadingHTTPServer
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def Start(self):
+        self._thread.start()
+
+    def Stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+# End
@@ -0,0 +1,214 @@
+
+import socket
+import threading
+import logging
+
+import serial
+
+"""
+Network serialports
+-------------------
+A S0PCM behind a serial-to-network server (e.g. ser2net) is configured with an URL as 'port':
+- socket://<host>:<port>: a raw TCP connection
+- rfc2217://<host>:<port>: a RFC2217 connection, the baudrate etc. are set on the remote serialport
+
+There is a single connection per URL, shared by all devices with that URL. The connection is read by
+its own thread and every line is handed to the device with the ID of the line (the 'id' of the
+device), a device without an 'id' receives all lines. A device reads its lines from its own channel,
+a socket pair which behaves like a non-blocking serialport (fileno, in_waiting, read and close), so
+the serialport readers of both runtimes are used unchanged.
+
+The TCP keepalive detects a connection which is silently gone. When the connection fails, all its
+channels are closed and the devices reopen with their own backoff. The connection is closed when its
+last channel is closed, e.g. when the only device behind it is stalled and reopens.
+"""
+
+logger = logging.getLogger('s0pcm.netserial')
+
+def IsUrl(port):
+    return '://' in str(port)
+
+# ------------------------------------------------------------------------------------
+# The ID of a telegram ('ID:<id>:I:...') or header ('/<id>:S0 Pulse Counter ...'), None
+# for other lines
+# ------------------------------------------------------------------------------------
+def LineId(line):
+    if line.startswith(b'ID:'):
+        return line[3:].split(b':', 1)[0].decode('ascii', 'replace')
+    if line.startswith(b'/'):
+        return line[1:].split(b':', 1)[0].decode('ascii', 'replace')
+    return None
+
+# ------------------------------------------------------------------------------------
+# Enable the TCP keepalive, the idle time is in seconds. 0 disables it.
+# ------------------------------------------------------------------------------------
+def SetKeepalive(sock, idle):
+    if idle == None or idle <= 0:
+        return
+
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(idle))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(int(idle) // 3, 1))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+class Channel():
+
+    def __init__(self, connection, id):
+        self.id = id
+        self._connection = connection
+        self._read, self._write = socket.socketpair()
+        self._read.setblocking(False)
+        self._write.setblocking(False)
+
+    # --------------------------------------------------------------------------------
+    # The serialport interface. The number of waiting bytes isn't known, a read returns
+    # what is available (up to the size) and raises an exception if the connection is gone.
+    # --------------------------------------------------------------------------------
+    @property
+    def in_waiting(self):
+        return 4096
+
+    def fileno(self):
+        return self._read.fileno()
+
+    def read(self, size=1):
+        try:
+            data = self._read.recv(size)
+        except BlockingIOError:
+            return b''
+        if data == b'':
+            raise serial.SerialException('Connection to \'' + self._connection.url + '\' is closed')
+        return data
+
+    def close(self):
+        self._connection.Unsubscribe(self)
+        self._read.close()
+
+    # --------------------------------------------------------------------------------
+    # Called by the connection
+    # --------------------------------------------------------------------------------
+    def Put(self, line):
+        try:
+            self._write.send(line)
+        except BlockingIOError:
+            logger.warning('Channel of ID \'%s\' on \'%s\' is full, dropping a line', self.id, self._connection.url)
+        except OSError:
+            pass
+
+    # The connection is gone, the device reads an end-of-file
+    def Shutdown(self):
+        self._write.close()
+
+class Connection():
+
+    def __init__(self, url):
+        self.url = url
+        self._lock = threading.Lock()
+        self._channels = []
+        self._serial = None
+
+    # --------------------------------------------------------------------------------
+    # Add a channel for the device, the connection is made if required. Raises an
+    # exception if the connection fails.
+    # --------------------------------------------------------------------------------
+    def Subscribe(self, device):
+        with self._lock:
+            if self._serial == None:
+                self._Connect(device)
+
+            channel = Channel(self, device['id'])
+            self._channels.append(channel)
+            return channel
+
+    def Unsubscribe(self, channel):
+        with self._lock:
+            if not channel in self._channels:
+                return
+            self._channels.remove(channel)
+            channel.Shutdown()
+
+            if len(self._channels) == 0 and self._serial != None:
+                logger.info('Closing connection to \'%s\', no devices left', self.url)
+                self._Disconnect()
+
+    def _Connect(self, device):
+        logger.info('Connecting to \'%s\'', self.url)
+
+        ser = serial.serial_for_url(self.url, do_not_open=True,
+                                    baudrate=device['baudrate'],
+                                    parity=device['parity'],
+                                    stopbits=device['stopbits'],
+                                    bytesize=device['bytesize'],
+                                    timeout=1)
+        ser.open()
+
+        # Both the socket:// and rfc2217:// implementation of pyserial use a plain socket
+        sock = getattr(ser, '_socket', None)
+        if sock != None:
+            SetKeepalive(sock, device['keepalive'])
+
+        self._serial = ser
+        threading.Thread(target=self._Run, args=(ser,), name='netserial-' + self.url, daemon=True).start()
+
+    def _Disconnect(self):
+        ser = self._serial
+        self._serial = None
+        for channel in self._channels:
+            channel.Shutdown()
+        self._channels = []
+        try:
+            ser.close()
+        except Exception:
+            pass
+
+    # --------------------------------------------------------------------------------
+    # Read the connection and hand every line to the channel(s) of its ID
+    # --------------------------------------------------------------------------------
+    def _Run(self, ser):
+
+        buffer = b''
+
+        try:
+            while self._serial is ser:
+                data = ser.read(max(ser.in_waiting, 1))
+                if len(data) == 0:
+                    continue
+
+                buffer += data
+                lines = buffer.split(b'\n')
+                buffer = lines.pop()
+
+                with self._lock:
+                    for line in lines:
+                        id = LineId(line)
+                        for channel in self._channels:
+                            if channel.id == None or channel.id == id:
+                                channel.Put(line + b'\n')
+
+        except Exception as e:
+            with self._lock:
+                if self._serial is ser:
+                    logger.error('Connection to \'%s\' failed. %s: \'%s\'', self.url, type(e).__name__, str(e))
+                    self._Disconnect()
+
+# ------------------------------------------------------------------------------------
+# The connections, one per URL
+# ------------------------------------------------------------------------------------
+class SerialPool():
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def Open(self, device):
+        with self._lock:
+            try:
+                connection = self._connections[device['port']]
+            except KeyError:
+                connection = Connection(device['port'])
+                self._connections[device['port']] = connection
+
+        return connection.Subscribe(device)
+
+# End
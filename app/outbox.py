@@ -0,0 +1,224 @@
+
+import os
+import struct
+import logging
+
+"""
+MQTT outbox
+-----------
+The publishes which can't be send to the MQTT broker (not connected, or older publishes are still
+waiting) are appended to 'outbox.bin'. When the broker is connected again, the outbox is drained in
+order with QoS 1, with a limited number of publishes in flight. A publish is removed from the outbox
+when the broker acknowledged it (PUBACK), so after a restart the not acknowledged publishes are send
+again (at least once).
+
+The outbox has a maximum size, when it is full the oldest publishes are dropped. The file is a
+segment: records are appended at the end and removed by moving the head. The unused space before
+the head is reclaimed when nothing is in flight.
+
+File layout (little endian):
+Header:
+  magic     8s  b'S0PCMOB1'
+  head      q   file offset of the oldest record
+Record:
+  timestamp q   microseconds since epoch (UTC), the time of the publish
+  retain    B   1 if the publish is retained
+  length    H   length of the topic
+  length    I   length of the payload
+  topic     the topic (utf-8)
+  payload   the payload
+"""
+
+logger = logging.getLogger('s0pcm.outbox')
+
+MAGIC = b'S0PCMOB1'
+HEADER = struct.Struct('<8sq')
+RECORD = struct.Struct('<qBHI')
+
+class Outbox():
+
+    def __init__(self, filename, max_size):
+        self._filename = filename
+        self._max_size = max_size
+
+        # The oldest record, the next record to send and the end of the last record
+        self._head = HEADER.size
+        self._cursor = HEADER.size
+        self._end = HEADER.size
+
+        # The offsets of acknowledged records, which are not at the head
+        self._acked = set()
+
+        # Incremented when the offsets change (compaction), older positions aren't valid
+        self._generation = 0
+
+        self._count = 0
+        self.dropped = 0
+
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        self._Load()
+
+    @property
+    def count(self):
+        return self._count
+
+    def _Load(self):
+        size = os.fstat(self._fd).st_size
+        header = os.pread(self._fd, HEADER.size, 0)
+
+        if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+            if size > 0:
+                logger.error('Outbox \'%s\' is invalid, starting with an empty outbox', self._filename)
+            self._Reset()
+            return
+
+        head = HEADER.unpack(header)[1]
+        if head < HEADER.size or head > size:
+            logger.error('Outbox \'%s\' has an invalid head, starting with an empty outbox', self._filename)
+            self._Reset()
+            return
+
+        # Count the records, a partial written last record (e.g. power failure) is removed
+        offset = head
+        count = 0
+        while True:
+            record = self._Read(offset)
+            if record == None:
+                break
+            offset = record[0]
+            count += 1
+
+        if offset < size:
+            logger.warning('Outbox \'%s\' has an incomplete last record, ignoring it', self._filename)
+            os.ftruncate(self._fd, offset)
+
+        self._head = head
+        self._cursor = head
+        self._end = offset
+        self._count = count
+
+        if count > 0:
+            logger.info('Outbox \'%s\' has %d publishes to send', self._filename, count)
+
+    def _Reset(self):
+        os.ftruncate(self._fd, 0)
+        os.pwrite(self._fd, HEADER.pack(MAGIC, HEADER.size), 0)
+        self._head = HEADER.size
+        self._cursor = HEADER.size
+        self._end = HEADER.size
+        self._acked = set()
+        self._count = 0
+        self._generation += 1
+
+    # --------------------------------------------------------------------------------
+    # Read a record, returns (next offset, timestamp, topic, payload, retain) or None
+    # --------------------------------------------------------------------------------
+    def _Read(self, offset):
+        header = os.pread(self._fd, RECORD.size, offset)
+        if len(header) < RECORD.size:
+            return None
+
+        timestamp, retain, topiclength, payloadlength = RECORD.unpack(header)
+        data = os.pread(self._fd, topiclength + payloadlength, offset + RECORD.size)
+        if len(data) < topiclength + payloadlength:
+            return None
+
+        return offset + RECORD.size + topiclength + payloadlength, timestamp / 1000000, data[:topiclength].decode('utf-8'), data[topiclength:], retain == 1
+
+    def _SetHead(self, head):
+        self._head = head
+        if self._cursor < head:
+            self._cursor = head
+        os.pwrite(self._fd, struct.pack('<q', head), len(MAGIC))
+
+        # Empty, or much unused space before the head. Only when nothing is in flight,
+        # the offsets of the records in flight would change.
+        if self._cursor == self._head and (self._head == self._end or self._head - HEADER.size >= self._max_size):
+            self._Compact()
+
+    def _Compact(self):
+        if self._head == self._end:
+            self._Reset()
+            return
+
+        # Copy the records to a new file and replace the outbox (atomic)
+        size = self._end - self._head
+        data = os.pread(self._fd, size, self._head)
+        tmpname = self._filename + '.tmp'
+        fd = os.open(tmpname, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, HEADER.pack(MAGIC, HEADER.size) + data)
+            os.fsync(fd)
+        except:
+            os.close(fd)
+            raise
+        os.replace(tmpname, self._filename)
+        os.close(self._fd)
+        self._fd = fd
+
+        self._head = HEADER.size
+        self._cursor = HEADER.size
+        self._end = HEADER.size + size
+        self._generation += 1
+
+    # --------------------------------------------------------------------------------
+    # Append a publish, the oldest publishes are dropped when the outbox is full
+    # --------------------------------------------------------------------------------
+    def Append(self, timestamp, topic, payload, retain):
+        topic = topic.encode('utf-8')
+        record = RECORD.pack(int(timestamp * 1000000), 1 if retain else 0, len(topic), len(payload)) + topic + payload
+
+        os.pwrite(self._fd, record, self._end)
+        self._end += len(record)
+        self._count += 1
+
+        if self._end - self._head > self._max_size:
+            head = self._head
+            while self._end - head > self._max_size and self._count > 1:
+                head = self._Read(head)[0]
+                self._count -= 1
+                self.dropped += 1
+            self._acked = set([offset for offset in self._acked if offset >= head])
+            self._SetHead(head)
+
+    # --------------------------------------------------------------------------------
+    # The next publish to send, returns (position, timestamp, topic, payload, retain)
+    # or None. The position is used to acknowledge it.
+    # --------------------------------------------------------------------------------
+    def Next(self):
+        if self._cursor >= self._end:
+            return None
+        record = self._Read(self._cursor)
+        position = (self._generation, self._cursor)
+        self._cursor = record[0]
+        return (position,) + record[1:]
+
+    # --------------------------------------------------------------------------------
+    # A publish is acknowledged, the head is moved over all acknowledged publishes
+    # --------------------------------------------------------------------------------
+    def Ack(self, position):
+        generation, offset = position
+        if generation != self._generation or offset < self._head:
+            return
+        self._acked.add(offset)
+
+        head = self._head
+        while head in self._acked:
+            self._acked.remove(head)
+            head = self._Read(head)[0]
+            self._count -= 1
+
+        if head != self._head:
+            self._SetHead(head)
+
+    # The publishes in flight are lost (e.g. disconnected), send them again
+    def Rewind(self):
+        self._cursor = self._head
+        self._acked = set()
+
+    def Close(self):
+        if self._fd != None:
+            os.close(self._fd)
+            self._fd = None
+
+# End
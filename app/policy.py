@@ -0,0 +1,169 @@
+
+import collections
+
+"""
+Publish policies
+----------------
+Decides per topic if a new value is published now, later or not at all:
+- deadband: the value is only published if it differs at least 'deadband' (absolute) or
+  'deadband_percent' (relative to the last published value) from the last published value
+- min_interval: a topic is published at most once per 'min_interval' seconds. Values which arrive
+  in between are coalesced, only the latest value is published when the interval has passed
+- max_interval: a topic is published at least once per 'max_interval' seconds (heartbeat), also if
+  the value is within the deadband or not changed
+
+The policy of a topic is taken from the 'publish' section, overruled by the settings of the input and
+the settings of the subtopic of the input (e.g. 'rate_1m'). Without any setting the filter is skipped.
+"""
+
+SETTINGS = ('deadband', 'deadband_percent', 'min_interval', 'max_interval')
+
+PublishPolicy = collections.namedtuple('PublishPolicy', SETTINGS)
+
+# Publish every offered value directly, this is the same as without a policy
+DEFAULT = PublishPolicy(0, 0, 0, None)
+
+# ------------------------------------------------------------------------------------
+# The policy of a subtopic of an input, returns None if nothing is configured
+# ------------------------------------------------------------------------------------
+def Resolve(defaults, inputs, key, subkey):
+
+    settings = dict([(name, defaults[name]) for name in SETTINGS])
+
+    if inputs != None:
+        for name in inputs:
+            if int(name) != key or inputs[name] == None:
+                continue
+            for setting in SETTINGS:
+                if setting in inputs[name]: settings[setting] = inputs[name][setting]
+            if isinstance(inputs[name].get(subkey), dict):
+                for setting in SETTINGS:
+                    if setting in inputs[name][subkey]: settings[setting] = inputs[name][subkey][setting]
+
+    policy = PublishPolicy(**settings)
+    if policy == DEFAULT:
+        return None
+    return policy
+
+class TopicState():
+
+    __slots__ = ('policy', 'topic', 'value', 'payload', 'published', 'time', 'pending')
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.topic = None
+        self.value = None
+        self.payload = None
+        self.published = None
+        self.time = None
+        self.pending = False
+
+class PublishFilter():
+
+    def __init__(self, resolve):
+        self._resolve = resolve
+        self._states = {}
+
+        # The earliest time a pending or heartbeat publish can be due
+        self._due = None
+
+    # --------------------------------------------------------------------------------
+    # Forget all published values and policies, e.g. after a reload or reconnect
+    # --------------------------------------------------------------------------------
+    def Reset(self):
+        self._states = {}
+        self._due = None
+
+    def _Schedule(self, due):
+        if self._due == None or due < self._due:
+            self._due = due
+
+    def _Published(self, state, now):
+        state.published = state.value
+        state.time = now
+        state.pending = False
+        if state.policy.max_interval != None:
+            self._Schedule(now + state.policy.max_interval)
+
+    # --------------------------------------------------------------------------------
+    # Offer a new value of a topic, returns True if it should be published now. The
+    # scope is the (device, input, subkey) of the topic.
+    # --------------------------------------------------------------------------------
+    def Offer(self, scope, topic, value, payload, now):
+
+        try:
+            state = self._states[scope]
+        except KeyError:
+            state = TopicState(self._resolve(*scope))
+            self._states[scope] = state
+
+        # No policy, always publish
+        if state.policy == None:
+            return True
+
+        state.topic = topic
+        state.value = value
+        state.payload = payload
+        policy = state.policy
+
+        # The first value is always published
+        if state.time == None:
+            self._Published(state, now)
+            return True
+
+        threshold = max(policy.deadband, abs(state.published) * policy.deadband_percent / 100)
+        heartbeat = policy.max_interval != None and now - state.time >= policy.max_interval
+
+        # Within the deadband, a pending (coalesced) value isn't required anymore
+        if abs(value - state.published) < threshold and not heartbeat:
+            state.pending = False
+            return False
+
+        # Too soon, publish the latest value when the minimum interval has passed
+        if now - state.time < policy.min_interval:
+            state.pending = True
+            self._Schedule(state.time + policy.min_interval)
+            return False
+
+        self._Published(state, now)
+        return True
+
+    # --------------------------------------------------------------------------------
+    # Returns a list of (topic, payload) of the coalesced values and heartbeats which
+    # are due. With 'flush' all coalesced values are returned, e.g. at shutdown.
+    # --------------------------------------------------------------------------------
+    def Due(self, now, flush=False):
+
+        if not flush and (self._due == None or now < self._due):
+            return []
+
+        due = []
+        self._due = None
+
+        for state in self._states.values():
+            if state.policy == None or state.time == None:
+                continue
+
+            if state.pending and (flush or now - state.time >= state.policy.min_interval):
+                self._Published(state, now)
+                due.append((state.topic, state.payload))
+            elif state.policy.max_interval != None and now - state.time >= state.policy.max_interval:
+                self._Published(state, now)
+                due.append((state.topic, state.payload))
+            else:
+                if state.pending:
+                    self._Schedule(state.time + state.policy.min_interval)
+                if state.policy.max_interval != None:
+                    self._Schedule(state.time + state.policy.max_interval)
+
+        return due
+
+    # --------------------------------------------------------------------------------
+    # Seconds until the next coalesced value or heartbeat is due, None if nothing
+    # --------------------------------------------------------------------------------
+    def NextDue(self, now):
+        if self._due == None:
+            return None
+        return max(self._due - now, 0)
+
+# End
@@ -0,0 +1,271 @@
+
+import os
+import sys
+import glob
+import time
+import datetime
+import threading
+import tracemalloc
+import collections
+import logging
+
+"""
+Profiler
+--------
+On-demand profiling of the running S0PCM-Reader, started by a SIGUSR1 or a MQTT command and stopped
+after 'duration' seconds (or by another SIGUSR1/command). Nothing is done until a profile is started.
+
+A background thread samples the stack of every other thread every 'interval' seconds (like py-spy, but
+without an external tool), so the serial readers, MQTT and the other threads are profiled together.
+On Linux the CPU time of every thread is read at every sample, only a sample of a thread which used
+CPU since the previous sample is counted. A thread waiting in select() or on an event is then not a
+hot spot. Optionally tracemalloc is started for the same window, the report contains the lines which
+allocated the most memory.
+
+The report is written to 'profile-<date>-<time>.txt' in the configuration directory (next to the
+logfile), only the last 'count' reports are kept. A short summary (the top functions per thread and
+memory) is handed to the 'onreport' function, e.g. to publish it.
+"""
+
+logger = logging.getLogger('s0pcm.profiler')
+
+# The per thread CPU clock is not available on every platform
+THREADCLOCK = hasattr(time, 'pthread_getcpuclockid')
+
+# The number of functions per thread in the summary
+SUMMARYTOP = 5
+
+def Function(code, lineno=None):
+    filename = os.path.basename(code.co_filename)
+    if lineno == None:
+        return filename + ':' + code.co_name
+    return filename + ':' + str(lineno) + ':' + code.co_name
+
+def ThreadCpu(ident):
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (OSError, OverflowError):
+        return None
+
+class ThreadProfile():
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = 0
+        self.cpu = 0.0
+        self.lastcpu = None
+
+        # The samples per function where it is running (self) and where it is on the stack (total)
+        self.own = collections.Counter()
+        self.total = collections.Counter()
+
+class Profiler():
+
+    def __init__(self, directory, interval=0.01, top=20, count=5, onreport=None):
+        self._directory = directory
+        self._onreport = onreport
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.Configure(interval, top, count)
+
+    # --------------------------------------------------------------------------------
+    # Change the settings, e.g. by a reload. A running profile keeps its interval.
+    # --------------------------------------------------------------------------------
+    def Configure(self, interval, top, count):
+        self._interval = max(interval, 0.001)
+        self._top = top
+        self._count = count
+
+    @property
+    def running(self):
+        return self._thread != None and self._thread.is_alive()
+
+    # --------------------------------------------------------------------------------
+    # Start a profile of 'duration' seconds, with 'memory' tracemalloc is also started.
+    # Returns False if a profile is already running.
+    # --------------------------------------------------------------------------------
+    def Start(self, duration, memory=False):
+        with self._lock:
+            if self.running:
+                return False
+
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._Run, args=(duration, memory), name='Profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    # Stop a running profile, the report is still written
+    def Stop(self):
+        self._stop.set()
+
+    # Stop a running profile, or start one (e.g. SIGUSR1)
+    def Toggle(self, duration, memory=False):
+        if self.running:
+            logger.info('Profile stop requested')
+            self.Stop()
+        else:
+            self.Start(duration, memory)
+
+    def _Run(self, duration, memory):
+
+        logger.info('Profile started for %d seconds%s', duration, ', with tracemalloc' if memory else '')
+
+        # tracemalloc can already be started, e.g. with PYTHONTRACEMALLOC
+        tracing = memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+
+        started = datetime.datetime.now()
+        start = time.monotonic()
+        deadline = start + duration
+
+        try:
+            threads = self._Sample(deadline)
+            elapsed = time.monotonic() - start
+
+            snapshot = None
+            traced = None
+            if memory:
+                # Without the allocations of the profile itself
+                snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)])
+                traced = tracemalloc.get_traced_memory()
+        finally:
+            if tracing:
+                tracemalloc.stop()
+
+        try:
+            filename = self._Write(started, elapsed, threads, snapshot, traced)
+            logger.info('Profile written to \'%s\'', filename)
+        except Exception as e:
+            logger.error('Profile write failed. %s: \'%s\'', type(e).__name__, str(e))
+            filename = None
+
+        if self._onreport != None:
+            self._onreport(self._Summary(started, elapsed, filename, threads, snapshot, traced))
+
+    # --------------------------------------------------------------------------------
+    # Sample the stacks of all threads until the deadline or a stop
+    # --------------------------------------------------------------------------------
+    def _Sample(self, deadline):
+
+        own = threading.get_ident()
+        threads = {}
+        nextsample = time.monotonic()
+
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if nextsample > now:
+                self._stop.wait(min(nextsample, deadline) - now)
+                continue
+            nextsample += self._interval
+
+            names = dict([(thread.ident, thread.name) for thread in threading.enumerate()])
+
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+
+                try:
+                    profile = threads[ident]
+                except KeyError:
+                    profile = ThreadProfile(names.get(ident, str(ident)))
+                    threads[ident] = profile
+
+                # Only count a thread which used CPU since the previous sample
+                if THREADCLOCK:
+                    cpu = ThreadCpu(ident)
+                    if cpu != None:
+                        last = profile.lastcpu
+                        profile.lastcpu = cpu
+                        if last == None or cpu <= last:
+                            continue
+                        profile.cpu += cpu - last
+
+                profile.samples += 1
+                profile.own[Function(frame.f_code, frame.f_lineno)] += 1
+
+                seen = set()
+                while frame != None:
+                    function = Function(frame.f_code)
+                    if not function in seen:
+                        seen.add(function)
+                        profile.total[function] += 1
+                    frame = frame.f_back
+
+            frame = None
+
+        return [profile for profile in threads.values() if profile.samples > 0]
+
+    # --------------------------------------------------------------------------------
+    # Write the report, the oldest reports are removed
+    # --------------------------------------------------------------------------------
+    def _Write(self, started, elapsed, threads, snapshot, traced):
+
+        filename = os.path.join(self._directory, 'profile-' + started.strftime('%Y%m%d-%H%M%S') + '.txt')
+
+        with open(filename, 'w') as f:
+            f.write('S0PCM-Reader profile of ' + started.strftime('%Y-%m-%d %H:%M:%S') + ', ' + '%.1f' % elapsed + ' seconds, a sample every ' + '%.1f' % (self._interval * 1000) + ' ms\n')
+            if THREADCLOCK:
+                f.write('Only the samples of a thread which used CPU since the previous sample are counted\n')
+
+            for profile in sorted(threads, key=lambda profile: profile.samples, reverse=True):
+                f.write('\nThread \'' + profile.name + '\': ' + str(profile.samples) + ' samples')
+                if THREADCLOCK:
+                    f.write(', ' + '%.3f' % profile.cpu + ' seconds CPU (' + '%.1f' % (profile.cpu / elapsed * 100 if elapsed > 0 else 0) + '%)')
+                f.write('\n')
+
+                f.write('  Self (running in the function):\n')
+                for function, count in profile.own.most_common(self._top):
+                    f.write('    ' + '%6.1f' % (count / profile.samples * 100) + '%  ' + function + '\n')
+
+                f.write('  Total (the function is on the stack):\n')
+                for function, count in profile.total.most_common(self._top):
+                    f.write('    ' + '%6.1f' % (count / profile.samples * 100) + '%  ' + function + '\n')
+
+            if snapshot != None:
+                f.write('\nMemory (tracemalloc): ' + str(traced[0]) + ' bytes traced, peak ' + str(traced[1]) + ' bytes\n')
+                f.write('  Allocated by line, still allocated at the end of the profile:\n')
+                for statistic in snapshot.statistics('lineno')[:self._top]:
+                    frame = statistic.traceback[0]
+                    f.write('    ' + '%10d' % statistic.size + ' bytes ' + '%8d' % statistic.count + ' blocks  ' + os.path.basename(frame.filename) + ':' + str(frame.lineno) + '\n')
+
+        # Keep the last 'count' reports
+        reports = sorted(glob.glob(os.path.join(self._directory, 'profile-*.txt')))
+        for name in reports[:max(len(reports) - self._count, 0)]:
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+        return filename
+
+    def _Summary(self, started, elapsed, filename, threads, snapshot, traced):
+
+        summary = {}
+        summary['start'] = started.strftime('%Y-%m-%dT%H:%M:%S')
+        summary['duration'] = round(elapsed, 1)
+        summary['file'] = None if filename == None else os.path.basename(filename)
+        summary['threads'] = {}
+
+        for profile in threads:
+            summary['threads'][profile.name] = {}
+            summary['threads'][profile.name]['samples'] = profile.samples
+            if THREADCLOCK:
+                summary['threads'][profile.name]['cpu'] = round(profile.cpu, 3)
+            summary['threads'][profile.name]['top'] = [[function, round(count / profile.samples * 100, 1)] for function, count in profile.own.most_common(SUMMARYTOP)]
+
+        if snapshot != None:
+            summary['memory'] = {}
+            summary['memory']['current'] = traced[0]
+            summary['memory']['peak'] = traced[1]
+            summary['memory']['top'] = []
+            for statistic in snapshot.statistics('lineno')[:SUMMARYTOP]:
+                frame = statistic.traceback[0]
+                summary['memory']['top'].append([os.path.basename(frame.filename) + ':' + str(frame.lineno), statistic.size])
+
+        return summary
+
+# End
@@ -0,0 +1,192 @@
+
+import json
+import struct
+import operator
+
+"""
+Publish plan
+------------
+The topics, include/enabled checks and payload templates of every input, compiled once when the MQTT
+client is created or the configuration is reloaded. Publishing is then a walk over the changed inputs,
+with a dict lookup per input. The encoded payload of an input is kept as bytes with the version of the
+input, so an input which isn't changed isn't encoded again and paho sends it as is. The topics are
+kept as a string, paho only accepts a string topic and encodes it itself.
+
+Encodings ('encoding' in the 'mqtt' section):
+- plain: a topic per counter, e.g. 'base_topic/1/total' with the value '12345'
+- json: a topic per input, e.g. 'base_topic/1' with '{"total": 12345, "today": 15, "yesterday": 77, ...}'
+- bulk: a topic per device ('base_topic' or 'base_topic/<device topic>') with a single json document
+  of all inputs, e.g. '{"1": {"total": 12345, "today": 15, "yesterday": 77, ...}, "2": {...}}'
+- binary: a topic per input, with the little endian signed 64-bit integers total, today, yesterday,
+  this_hour, this_week, this_month and last_month, followed by a double per rate (struct '<qqqqqqq'
+  + 'd' per rate)
+"""
+
+ENCODINGS = ('plain', 'json', 'bulk', 'binary')
+
+# The counters which are published, the rates are added when configured
+SUBKEYS = ('total', 'today', 'yesterday', 'this_hour', 'this_week', 'this_month', 'last_month')
+
+# Returns the counters of a snapshot as a tuple, in the order of SUBKEYS
+Counters = operator.attrgetter(*SUBKEYS)
+
+class InputPlan():
+
+    __slots__ = ('name', 'topic', 'topics', 'key', 'ratecount', 'template', 'version', 'payload')
+
+    def __init__(self, name, topic, key):
+        self.name = name
+        self.key = key
+
+        # The topic of the input (json/binary) and of every counter and rate (plain)
+        self.topic = topic
+        self.topics = dict([(subkey, topic + '/' + subkey) for subkey in SUBKEYS])
+
+        # The payload template, depends on the number of rates
+        self.ratecount = None
+        self.template = None
+
+        # The last encoded payload and the version of the input it is encoded from
+        self.version = None
+        self.payload = None
+
+    def Topic(self, subkey):
+        try:
+            return self.topics[subkey]
+        except KeyError:
+            topic = self.topic + '/' + subkey
+            self.topics[subkey] = topic
+            return topic
+
+class DevicePlan():
+
+    __slots__ = ('topic', 'include', 'inputs')
+
+    def __init__(self, topic, include):
+        self.topic = topic
+        self.include = include
+        self.inputs = {}
+
+class PublishPlan():
+
+    def __init__(self, config):
+        self._encoding = config['mqtt']['encoding']
+
+        self._devices = {}
+        for device in config['devices']:
+            if device['topic'] == None:
+                topic = config['mqtt']['base_topic']
+            else:
+                topic = config['mqtt']['base_topic'] + '/' + device['topic']
+            include = None if device['include'] == None else set(device['include'])
+            self._devices[device['name']] = DevicePlan(topic, include)
+
+        if self._encoding == 'binary':
+            self._Encode = self._EncodeBinary
+        else:
+            self._Encode = self._EncodeJson
+
+    @property
+    def encoding(self):
+        return self._encoding
+
+    # The topic of a device, 'base_topic' or 'base_topic/<device topic>'
+    def DeviceTopic(self, name):
+        return self._devices[name].topic
+
+    # --------------------------------------------------------------------------------
+    # The plan of an input, None if the input isn't published (disabled or not included)
+    # --------------------------------------------------------------------------------
+    def Input(self, snapshot):
+
+        device = self._devices[snapshot.device]
+        try:
+            plan = device.inputs[snapshot.input]
+            if plan == None or plan.name == snapshot.name:
+                return plan
+        except KeyError:
+            pass
+
+        # The name of the input is changed (or new), compile it again
+        if snapshot.enabled == False or (device.include != None and not snapshot.input in device.include):
+            plan = None
+        else:
+            instancename = str(snapshot.name) if snapshot.name != None else str(snapshot.input)
+            plan = InputPlan(snapshot.name, device.topic + '/' + instancename, json.dumps(instancename).encode('ascii'))
+
+        device.inputs[snapshot.input] = plan
+        return plan
+
+    def _EncodeJson(self, plan, snapshot):
+        if plan.ratecount != len(snapshot.rates):
+            plan.ratecount = len(snapshot.rates)
+            plan.template = '{' + ', '.join([json.dumps(name) + ': %s' for name in SUBKEYS + tuple([name for name, value in snapshot.rates])]) + '}'
+        return (plan.template % (Counters(snapshot) + tuple([value for name, value in snapshot.rates]))).encode('ascii')
+
+    def _EncodeBinary(self, plan, snapshot):
+        if plan.ratecount != len(snapshot.rates):
+            plan.ratecount = len(snapshot.rates)
+            plan.template = struct.Struct('<' + 'q' * len(SUBKEYS) + 'd' * len(snapshot.rates))
+        return plan.template.pack(*([int(value) for value in Counters(snapshot)] + [value for name, value in snapshot.rates]))
+
+    # The encoded payload of an input, only encoded again if the input is changed
+    def Payload(self, plan, snapshot):
+        if plan.version != snapshot.version:
+            plan.payload = self._Encode(plan, snapshot)
+            plan.version = snapshot.version
+        return plan.payload
+
+    # --------------------------------------------------------------------------------
+    # Returns a list of (scope, topic, value, payload) to publish. The scope is the
+    # (device, input, subkey) of the publish policy and the value is used for its
+    # deadband. The changes are a list of (snapshot, fields), with 'bulk' all inputs
+    # of a changed device are required.
+    # --------------------------------------------------------------------------------
+    def Messages(self, changes):
+
+        messages = []
+
+        if self._encoding == 'plain':
+            for snapshot, fields in changes:
+                plan = self.Input(snapshot)
+                if plan == None:
+                    continue
+
+                for subkey in SUBKEYS:
+                    if subkey in fields:
+                        value = getattr(snapshot, subkey)
+                        messages.append(((snapshot.device, snapshot.input, subkey), plan.topics[subkey], value, value))
+
+                # The derived rates are published as extra subtopics, e.g. 'rate_1m'
+                if 'rates' in fields:
+                    for subkey, value in snapshot.rates:
+                        messages.append(((snapshot.device, snapshot.input, subkey), plan.Topic(subkey), value, value))
+
+        elif self._encoding == 'bulk':
+            documents = {}
+            for snapshot, fields in changes:
+                plan = self.Input(snapshot)
+                if plan == None:
+                    continue
+                if not snapshot.device in documents:
+                    documents[snapshot.device] = ([], [0])
+                parts, total = documents[snapshot.device]
+                parts.append(plan.key + b': ' + self.Payload(plan, snapshot))
+                total[0] += snapshot.total
+
+            # The deadband of a document is based on the sum of the totals
+            for name, (parts, total) in documents.items():
+                messages.append(((name, None, None), self._devices[name].topic, total[0], b'{' + b', '.join(parts) + b'}'))
+
+        else:
+            for snapshot, fields in changes:
+                plan = self.Input(snapshot)
+                if plan == None:
+                    continue
+
+                # The deadband of the json or binary value is based on the total
+                messages.append(((snapshot.device, snapshot.input, None), plan.topic, snapshot.total, self.Payload(plan, snapshot)))
+
+        return messages
+
+# End
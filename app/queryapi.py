@@ -0,0 +1,210 @@
+
+import os
+import json
+import math
+import time
+import threading
+import socketserver
+import logging
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import metrics
+
+"""
+Query API
+---------
+The live counters as JSON, served from memory (the counter store) by a small HTTP server thread on a
+TCP port and/or a Unix socket. The paths follow the MQTT topics:
+- /counters: all inputs, per device with multiple devices
+- /counters/<device>: the inputs of a device (only with multiple devices)
+- /counters[/<device>]/<input>: a single input
+
+The ETag of a response is the newest version (see 'counters.py') of the inputs in it, a request with
+a matching 'If-None-Match' gets a '304 Not Modified'. With '?wait=<seconds>' the request is held until
+the response differs from the 'If-None-Match' (or without it, from the current response) or the time
+has passed, a long-poll for the next change. A response is rendered once per change of the counter
+store and path, all other requests (and woken up long-polls) get the cached response.
+"""
+
+logger = logging.getLogger('s0pcm.queryapi')
+
+# The counters of an input in a response, followed by its rates
+FIELDS = ('total', 'today', 'yesterday', 'this_hour', 'this_week', 'this_month', 'last_month', 'pulsecount')
+
+def Input(snapshot):
+    content = {}
+    if snapshot.name != None:
+        content['name'] = snapshot.name
+    for field in FIELDS:
+        content[field] = getattr(snapshot, field)
+    for name, value in snapshot.rates:
+        content[name] = value
+    return content
+
+class Query():
+
+    def __init__(self, counterstore, devices, max_wait=60):
+        self._store = counterstore
+        self._multidevice = devices != [None]
+        self._devices = devices
+        self.max_wait = max_wait
+
+        # Per path: (version of the counter store, etag, body)
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    # --------------------------------------------------------------------------------
+    # The path as a tuple of its parts. Raises a KeyError for an unknown path.
+    # --------------------------------------------------------------------------------
+    def Parse(self, path):
+        parts = tuple([urllib.parse.unquote(part) for part in path.strip('/').split('/')])
+        if parts[0] != 'counters' or len(parts) > (3 if self._multidevice else 2):
+            raise KeyError(path)
+        if self._multidevice and len(parts) > 1 and not parts[1] in self._devices:
+            raise KeyError(path)
+        return parts[1:]
+
+    # --------------------------------------------------------------------------------
+    # Render the response of a path, returns (etag, body). Raises a KeyError for an
+    # unknown input.
+    # --------------------------------------------------------------------------------
+    def Render(self, parts):
+        key = parts
+        version = self._store.version
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached != None and cached[0] == version:
+            return cached[1], cached[2]
+
+        snapshots = [snapshot for snapshot in self._store.Snapshot() if snapshot.enabled != False]
+        device = None
+        if self._multidevice and len(parts) > 0:
+            device = parts[0]
+            snapshots = [snapshot for snapshot in snapshots if snapshot.device == device]
+            parts = parts[1:]
+
+        if len(parts) > 0:
+            snapshots = [snapshot for snapshot in snapshots if str(snapshot.input) == parts[0]]
+            if len(snapshots) == 0:
+                raise KeyError(parts[0])
+            content = Input(snapshots[0])
+        elif self._multidevice and device == None:
+            content = dict([(name, {}) for name in self._devices])
+            for snapshot in snapshots:
+                content[snapshot.device][str(snapshot.input)] = Input(snapshot)
+        else:
+            content = dict([(str(snapshot.input), Input(snapshot)) for snapshot in snapshots])
+
+        etag = '"' + str(max([snapshot.version for snapshot in snapshots], default=0)) + '"'
+        body = json.dumps(content).encode('utf-8')
+
+        with self._lock:
+            self._cache[key] = (version, etag, body)
+        return etag, body
+
+    # --------------------------------------------------------------------------------
+    # The response of a path, a long-poll waits (at most 'wait' seconds) until the etag
+    # differs from the supplied etag
+    # --------------------------------------------------------------------------------
+    def Get(self, parts, etag=None, wait=0):
+        wait = max(0, min(wait, self.max_wait))
+        deadline = time.monotonic() + wait
+        if etag == None and wait > 0:
+            etag = self.Render(parts)[0]
+
+        while True:
+            version = self._store.version
+            response = self.Render(parts)
+            remaining = deadline - time.monotonic()
+            if response[0] != etag or remaining <= 0:
+                return response
+            self._store.Wait(version, remaining)
+
+class ApiHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = self.server.query
+
+        try:
+            wait = float(urllib.parse.parse_qs(url.query).get('wait', ['0'])[0])
+        except ValueError:
+            self.Error(400)
+            return
+
+        # float() also accepts 'nan' and 'inf', a nan deadline never expires
+        if not math.isfinite(wait):
+            self.Error(400)
+            return
+        wait = max(0, min(wait, query.max_wait))
+
+        try:
+            etag, body = query.Get(query.Parse(url.path), self.headers.get('If-None-Match'), wait)
+        except KeyError:
+            self.Error(404)
+            return
+
+        if etag == self.headers.get('If-None-Match'):
+            metrics.apirequests.Inc('304')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        metrics.apirequests.Inc('200')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def Error(self, code):
+        metrics.apirequests.Inc(str(code))
+        self.send_error(code)
+
+    def log_message(self, format, *args):
+        logger.debug('Api: ' + format, *args)
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    # A socket of a previous run is removed
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+# ------------------------------------------------------------------------------------
+# The HTTP servers, they run in their own (daemon) threads
+# ------------------------------------------------------------------------------------
+class ApiServer():
+
+    def __init__(self, query, host=None, port=None, path=None):
+        self._servers = []
+        if port != None:
+            server = ThreadingHTTPServer((host, port), ApiHandler)
+            server.daemon_threads = True
+            self._servers.append(server)
+        if path != None:
+            self._servers.append(UnixHTTPServer(path, ApiHandler))
+
+        for server in self._servers:
+            server.query = query
+        self._path = path
+
+    def Start(self):
+        for server in self._servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def Stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        if self._path != None and os.path.exists(self._path):
+            os.unlink(self._path)
+
+# End
@@ -0,0 +1,93 @@
+
+import collections
+
+"""
+Derived rates
+-------------
+Calculates the flow rate (e.g. liters per minute) or power (e.g. watts) of an input over one or more
+sliding windows, from the pulses in the last interval of every telegram. Every window keeps a running
+sum of the pulses and seconds, so adding a sample is O(1) (amortized, old samples are dropped once).
+
+rate = pulses / pulses_per_unit / seconds * per
+
+E.g. a water meter with 1 pulse per liter, in liters per minute: pulses_per_unit=1, per=60
+E.g. a kWh meter with 1000 pulses per kWh (1 per Wh), in watts: pulses_per_unit=1, per=3600
+"""
+
+# ------------------------------------------------------------------------------------
+# The name of a window, as used in the topic. E.g. 60 -> 'rate_1m', 3600 -> 'rate_1h'
+# ------------------------------------------------------------------------------------
+def WindowName(seconds):
+    if seconds % 3600 == 0:
+        return 'rate_' + str(seconds // 3600) + 'h'
+    elif seconds % 60 == 0:
+        return 'rate_' + str(seconds // 60) + 'm'
+    return 'rate_' + str(seconds) + 's'
+
+class SlidingWindow():
+
+    __slots__ = ('_length', '_samples', '_pulses', '_seconds')
+
+    def __init__(self, length):
+        self._length = length
+        self._samples = collections.deque()
+        self._pulses = 0
+        self._seconds = 0
+
+    def Add(self, timestamp, interval, pulses):
+        self._samples.append((timestamp, interval, pulses))
+        self._pulses += pulses
+        self._seconds += interval
+
+        # Drop the samples which are outside of the window
+        while self._samples[0][0] <= timestamp - self._length:
+            oldest = self._samples.popleft()
+            self._pulses -= oldest[2]
+            self._seconds -= oldest[1]
+
+    # Pulses per second, until the window is filled we use the seconds we have
+    def Rate(self):
+        if self._seconds <= 0:
+            return 0.0
+        return self._pulses / self._seconds
+
+class RateCalculator():
+
+    def __init__(self, windows, inputs):
+        self._windows = windows
+        self._names = [WindowName(seconds) for seconds in windows]
+
+        # Only the configured inputs get a rate, with their own factor
+        self._inputs = {}
+        for key in inputs:
+            settings = inputs[key] if inputs[key] != None else {}
+            factor = settings.get('per', 60) / settings.get('pulses_per_unit', 1)
+            decimals = settings.get('decimals', 3)
+            self._inputs[int(key)] = (factor, decimals, [SlidingWindow(seconds) for seconds in windows])
+
+    @property
+    def names(self):
+        return self._names
+
+    # --------------------------------------------------------------------------------
+    # Add the pulses of a telegram, returns a list of (input, rates). The rates are a
+    # tuple of (name, value) per window.
+    # --------------------------------------------------------------------------------
+    def Add(self, timestamp, interval, pulses):
+
+        result = []
+        for key in self._inputs:
+            if key > len(pulses):
+                continue
+
+            factor, decimals, windows = self._inputs[key]
+            values = []
+            for name, window in zip(self._names, windows):
+                window.Add(timestamp, interval, pulses[key - 1])
+                values.append((name, round(window.Rate() * factor, decimals)))
+
+            result.append((key, tuple(values)))
+
+        return result
+
+# End
@@ -0,0 +1,87 @@
+
+import time
+import datetime
+import collections
+
+"""
+Rollover calendar
+-----------------
+The 'today', 'this_hour', 'this_week' and 'this_month' counters are reset at the start of a new
+period in the configured timezone ('timezone' in the 's0pcm' section, default the local time of the
+container). The rollover is done by a timer at the start of every hour, the telegrams don't do any
+date work. With daylight saving time a day has 23 or 25 hours, the hours are based on the UTC time
+and the day, week (starting on Monday) and month on the local time of the timezone.
+"""
+
+PERIODS = ('hour', 'day', 'week', 'month')
+
+# The start of the hour (seconds since epoch), the date of the day, the Monday of the week and the first day of the month
+Periods = collections.namedtuple('Periods', PERIODS)
+
+# ------------------------------------------------------------------------------------
+# The timezone, None is the local time. Raises an exception for an unknown timezone.
+# ------------------------------------------------------------------------------------
+def TimeZone(name):
+    if name == None:
+        return None
+
+    # Only imported when a timezone is configured, it requires the timezone database
+    import zoneinfo
+    return zoneinfo.ZoneInfo(str(name))
+
+class Calendar():
+
+    def __init__(self, timezone=None):
+        self._timezone = timezone
+
+    # The local time of the timezone, without tzinfo (like the rest of the S0PCM-Reader)
+    def Local(self, timestamp):
+        if self._timezone == None:
+            return datetime.datetime.fromtimestamp(timestamp)
+        return datetime.datetime.fromtimestamp(timestamp, self._timezone).replace(tzinfo=None)
+
+    def Offset(self, timestamp):
+        if self._timezone == None:
+            return time.localtime(timestamp).tm_gmtoff
+        return datetime.datetime.fromtimestamp(timestamp, self._timezone).utcoffset().total_seconds()
+
+    def Periods(self, timestamp):
+        local = self.Local(timestamp)
+        day = local.date()
+        hour = int(timestamp - (timestamp + self.Offset(timestamp)) % 3600)
+        return Periods(hour, day, day - datetime.timedelta(days=day.weekday()), day.replace(day=1))
+
+    # --------------------------------------------------------------------------------
+    # The periods of a stored date and hour (e.g. 'measurement.yaml'), the hour can be
+    # None. Then only the day, week and month are known.
+    # --------------------------------------------------------------------------------
+    def Stored(self, date, hour):
+        if date == None:
+            return None
+
+        start = None
+        if hour != None:
+            local = datetime.datetime.combine(date, datetime.time(hour))
+            if self._timezone == None:
+                start = int(time.mktime(local.timetuple()))
+            else:
+                start = int(local.replace(tzinfo=self._timezone).timestamp())
+
+        return Periods(start, date, date - datetime.timedelta(days=date.weekday()), date.replace(day=1))
+
+    # --------------------------------------------------------------------------------
+    # The start of the next hour, a day/week/month always starts at an hour
+    # --------------------------------------------------------------------------------
+    def Next(self, timestamp):
+        return self.Periods(timestamp).hour + 3600
+
+    # --------------------------------------------------------------------------------
+    # The periods which are changed, in the order hour, day, week and month. A period
+    # which isn't known (e.g. a new measurement) isn't a change.
+    # --------------------------------------------------------------------------------
+    def Changed(self, previous, current):
+        if previous == None:
+            return []
+        return [period for period, old, new in zip(PERIODS, previous, current) if old != None and old != new]
+
+# End
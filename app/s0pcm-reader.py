@@ -1,17 +1,35 @@
 
+import time
+
+# The start of the process, to measure the time to the first publish
+STARTTIME = time.monotonic()
+
+import os
 import sys
+import select
 import datetime
-import time
+import math
 import threading
+import signal
 import serial
 import yaml
 import logging
 from logging.handlers import RotatingFileHandler
-import paho.mqtt.client as mqtt
-import ssl
 import argparse
-import copy
 import json
+import collections
+import journal
+import telegram
+import counters
+import metrics
+import policy
+import publishplan
+import watchdog
+import sinks
+import rollover
+import asynclog
+import netserial
+import statefile
 
 """
 Description
@@ -65,18 +83,34 @@ MQTT
 MQTT Topic - when split_topic=yes (default):
 base_topic/status - online/offline
 base_topic/error - if any?
+base_topic/stalled - true/false, if no telegrams are received from the S0PCM
+base_topic/profile - json summary of the last profile (retained)
+base_topic/profile/set - command to start/stop a profile (subscribed)
+base_topic/calibrate/set - command to correct the counters, e.g. '{"input": 1, "set_total": 370689}' (subscribed)
 base_topic/1/total
 base_topic/1/today
 base_topic/1/yesterday
+base_topic/1/this_hour
+base_topic/1/this_week
+base_topic/1/this_month
+base_topic/1/last_month
 base_topic/X/total
 base_topic/X/today
 base_topic/X/yesterday
+...
 
-MQTT Topic - when split_topic=no:
+MQTT Topic - when split_topic=no (or encoding=json):
 base_topic/status - online/offline
 base_topic/error - if any?
-base_topic/1 - json string e.g. '{"total": 12345, "today": 15, "yesterday": 77}'
-base_topic/X - json string e.g. '{"total": 12345, "today": 15, "yesterday": 77}'
+base_topic/1 - json string e.g. '{"total": 12345, "today": 15, "yesterday": 77, "this_hour": 3, "this_week": 120, "this_month": 411, "last_month": 1502}'
+base_topic/X - json string e.g. '{"total": 12345, "today": 15, "yesterday": 77, "this_hour": 3, "this_week": 120, "this_month": 411, "last_month": 1502}'
+
+MQTT Topic - when encoding=bulk:
+base_topic - json string e.g. '{"1": {"total": 12345, "today": 15, ...}, "X": {...}}'
+
+MQTT Topic - when encoding=binary:
+base_topic/1 - total, today, yesterday, this_hour, this_week, this_month and last_month as little endian
+               64-bit integers (struct '<qqqqqqq')
 
 """
 
@@ -90,41 +124,78 @@ lock = threading.Lock()
 # Global Variables
 # ------------------------------------------------------------------------------------
 config = {}
-measurement = {}
-measurementshare = {}
+loghandler = None
+logwriter = None
+counterstore = counters.CounterStore()
+measurementjournal = None
+historystore = None
+serialpool = netserial.SerialPool()
+
+# The paho MQTT client is only imported by the MQTT task, see 'ImportMqtt'
+mqtt = None
+
+# The MQTT protocol versions, as defined by paho (MQTTv31 and MQTTv311)
+MQTTV31 = 3
+MQTTV311 = 4
 
 # ------------------------------------------------------------------------------------
-# Parameters
+# Parameters. The normal start ('-c <directory>') is parsed without a parser, creating
+# an ArgumentParser imports gettext. The commands are only imported when one is used.
 # ------------------------------------------------------------------------------------
-parser = argparse.ArgumentParser(prog='s0pcm-reader', description='S0 Pulse Counter Module', epilog='...')
-parser.add_argument('-c', '--config', help='Directory where the configuration resides', type=str, default='./')
-args = parser.parse_args()
+def ParseArguments():
+
+    argv = sys.argv[1:]
+    if len(argv) == 0:
+        return argparse.Namespace(config='./', command=None)
+    if len(argv) == 2 and argv[0] in ['-c', '--config'] and not argv[1].startswith('-'):
+        return argparse.Namespace(config=argv[1], command=None)
+
+    import history
+    import capture
+
+    parser = argparse.ArgumentParser(prog='s0pcm-reader', description='S0 Pulse Counter Module', epilog='...')
+    parser.add_argument('-c', '--config', help='Directory where the configuration resides', type=str, default='./')
+    subparsers = parser.add_subparsers(dest='command')
+    history.AddArguments(subparsers)
+    capture.AddArguments(subparsers)
+    return parser.parse_args()
+
+args = ParseArguments()
 
 configdirectory = args.config
 if not configdirectory.endswith('/'):
     configdirectory += '/'
 
+# Only query the history, e.g. 's0pcm-reader.py -c /config history 1 --from 2021-03 --to 2021-03 --sum'
+if args.command == 'history':
+    import history
+    sys.exit(history.Command(configdirectory, args))
+
 # ------------------------------------------------------------------------------------
 # Setup filenames
 # ------------------------------------------------------------------------------------
 configname = configdirectory + 'configuration.yaml'
 measurementname = configdirectory + 'measurement.yaml'
+journalname = configdirectory + 'measurement.journal'
+statename = configdirectory + 'measurement.state'
 logname= configdirectory + 's0pcm-reader.log'
+outboxname = configdirectory + 'outbox.bin'
 
 # ------------------------------------------------------------------------------------
 # Logging
 # ------------------------------------------------------------------------------------
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s %(levelname)s: %(message)s')
-logger = logging.getLogger(__name__)
+logger = logging.getLogger('s0pcm')
 logger.setLevel(logging.DEBUG)
 logger.propagate = False
 
 # ------------------------------------------------------------------------------------
-# Read the 'configuration.yaml' file
+# Read the 'configuration.yaml' file, returns the configuration with all defaults. An
+# exception is raised if the configuration is invalid.
 # ------------------------------------------------------------------------------------
-def ReadConfig():
+def LoadConfig():
 
-    global config
+    config = {}
 
     try:
         with open(configname, 'r') as f:
@@ -132,10 +203,16 @@ def ReadConfig():
     except FileNotFoundError:
         print('WARN: No \'' + configname + '\' found, using defaults.')
 
+    if config == None:
+        config = {}
+
     # Setup 'log' variables if not existing
     if not 'log' in config: config['log'] = {}
     if not 'size' in config['log']: config['log']['size'] = 10
     if not 'count' in config['log']: config['log']['count'] = 3
+    if not 'queue_size' in config['log']: config['log']['queue_size'] = 10000
+    if not 'rate_limit' in config['log']: config['log']['rate_limit'] = 10
+    if not 'rate_interval' in config['log']: config['log']['rate_interval'] = 60
 
     if 'level' in config['log']:
         config['log']['level'] = str(config['log']['level']).upper()
@@ -155,12 +232,6 @@ def ReadConfig():
     #  Convert MB to Bytes
     config['log']['size'] = config['log']['size'] * 1024 * 1024
 
-    # Setup logfile and rotation
-    handler = RotatingFileHandler(logname, maxBytes=config['log']['size'], backupCount=config['log']['count'])
-    handler.setLevel(config['log']['level'])
-    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-    logger.addHandler(handler)
-
     # Setup 'mqtt' variables if not existing
     if 'mqtt' in config:
         if config['mqtt'] == None:
@@ -173,19 +244,25 @@ def ReadConfig():
     if not 'password' in config['mqtt']: config['mqtt']['password'] = None
     if not 'base_topic' in config['mqtt']: config['mqtt']['base_topic'] = 's0pcm-reader'
     if not 'client_id' in config['mqtt']: config['mqtt']['client_id'] = None
-    if not 'version' in config['mqtt']: config['mqtt']['version'] = mqtt.MQTTv311
+    if not 'version' in config['mqtt']: config['mqtt']['version'] = MQTTV311
     if not 'retain' in config['mqtt']: config['mqtt']['retain'] = True
     if not 'split_topic' in config['mqtt']: config['mqtt']['split_topic'] = True
+    if not 'encoding' in config['mqtt']: config['mqtt']['encoding'] = 'plain' if config['mqtt']['split_topic'] else 'json'
     if not 'connect_retry' in config['mqtt']: config['mqtt']['connect_retry'] = 5
     if not 'online' in config['mqtt']: config['mqtt']['online'] = 'online'
     if not 'offline' in config['mqtt']: config['mqtt']['offline'] = 'offline'
     if not 'lastwill' in config['mqtt']: config['mqtt']['lastwill'] = 'offline'
 
     if str(config['mqtt']['version']) == '3.1':
-      config['mqtt']['version'] = mqtt.MQTTv31
+      config['mqtt']['version'] = MQTTV31
     else:
-      config['mqtt']['version'] = mqtt.MQTTv311
+      config['mqtt']['version'] = MQTTV311
  
+    config['mqtt']['encoding'] = str(config['mqtt']['encoding']).lower()
+    if not config['mqtt']['encoding'] in publishplan.ENCODINGS:
+        print('WARN: Invalid \'encoding\' ' + config['mqtt']['encoding'] + ' supplied. Only \'plain\', \'json\', \'bulk\' and \'binary\' are supported. Using \'plain\' now.')
+        config['mqtt']['encoding'] = 'plain'
+
     # TLS configuration
     if not 'tls' in config['mqtt']: config['mqtt']['tls'] = False
     if not 'tls_ca' in config['mqtt']: config['mqtt']['tls_ca'] = ''
@@ -209,6 +286,8 @@ def ReadConfig():
     if not 'bytesize' in config['serial']: config['serial']['bytesize'] = serial.SEVENBITS
     if not 'timeout' in config['serial']: config['serial']['timeout'] = None
     if not 'connect_retry' in config['serial']: config['serial']['connect_retry'] = 5
+    if not 'stall_factor' in config['serial']: config['serial']['stall_factor'] = 3
+    if not 'keepalive' in config['serial']: config['serial']['keepalive'] = 60
 
     # Setup 's0pcm'
     if 's0pcm' in config:
@@ -220,37 +299,459 @@ def ReadConfig():
     if not 'dailystat' in config['s0pcm']: config['s0pcm']['dailystat'] = None
     if not 'publish_interval' in config['s0pcm']: config['s0pcm']['publish_interval'] = None
     if not 'publish_onchange' in config['s0pcm']: config['s0pcm']['publish_onchange'] = True
+    if not 'runtime' in config['s0pcm']: config['s0pcm']['runtime'] = 'threading'
+    if not 'timezone' in config['s0pcm']: config['s0pcm']['timezone'] = None
+    if not 'calibrate' in config['s0pcm']: config['s0pcm']['calibrate'] = True
+
+    config['s0pcm']['runtime'] = str(config['s0pcm']['runtime']).lower()
+    if config['s0pcm']['runtime'] != 'threading' and config['s0pcm']['runtime'] != 'asyncio' and config['s0pcm']['runtime'] != 'process':
+        print('WARN: Invalid \'runtime\' ' + config['s0pcm']['runtime'] + ' supplied. Only \'threading\', \'asyncio\' and \'process\' are supported. Using \'threading\' now.')
+        config['s0pcm']['runtime'] = 'threading'
+
+    # The timezone of the day, week and month rollover, default is the local time
+    if config['s0pcm']['timezone'] != None:
+        try:
+            rollover.TimeZone(config['s0pcm']['timezone'])
+        except Exception as e:
+            print('WARN: Invalid \'timezone\' ' + str(config['s0pcm']['timezone']) + ' supplied (' + type(e).__name__ + '). Using the local time now.')
+            config['s0pcm']['timezone'] = None
+
+    # Setup 'journal'
+    if 'journal' in config:
+        if config['journal'] == None:
+            config['journal'] = {}
+    else:
+        config['journal'] = {}
+    if not 'enabled' in config['journal']: config['journal']['enabled'] = True
+    if not 'compact_interval' in config['journal']: config['journal']['compact_interval'] = 3600
+    if not 'compact_size' in config['journal']: config['journal']['compact_size'] = 64
+    if not 'fsync_interval' in config['journal']: config['journal']['fsync_interval'] = 60
+    if not 'state' in config['journal']: config['journal']['state'] = True
+
+    #  Convert KB to Bytes
+    config['journal']['compact_size'] = config['journal']['compact_size'] * 1024
+
+    # Setup 'samples'
+    if 'samples' in config:
+        if config['samples'] == None:
+            config['samples'] = {}
+    else:
+        config['samples'] = {}
+    if not 'enabled' in config['samples']: config['samples']['enabled'] = False
+    if not 'capacity' in config['samples']: config['samples']['capacity'] = 60480
+
+    # Setup 'rates'
+    if 'rates' in config:
+        if config['rates'] == None:
+            config['rates'] = {}
+    else:
+        config['rates'] = {}
+    if not 'windows' in config['rates']: config['rates']['windows'] = [60, 300, 3600]
+    if not 'inputs' in config['rates']: config['rates']['inputs'] = None
+
+    # A window without a length would drop every sample, also the one just added
+    if not isinstance(config['rates']['windows'], list):
+        raise ValueError('Invalid rate windows \'' + str(config['rates']['windows']) + '\' supplied, expected a list of seconds')
+    for seconds in config['rates']['windows']:
+        if not isinstance(seconds, (int, float)) or isinstance(seconds, bool) or not math.isfinite(seconds) or seconds <= 0:
+            raise ValueError('Invalid rate window \'' + str(seconds) + '\' supplied, it should be a positive number of seconds')
+
+    # Setup 'publish', the default publish policy of all inputs
+    if 'publish' in config:
+        if config['publish'] == None:
+            config['publish'] = {}
+    else:
+        config['publish'] = {}
+    if not 'deadband' in config['publish']: config['publish']['deadband'] = 0
+    if not 'deadband_percent' in config['publish']: config['publish']['deadband_percent'] = 0
+    if not 'min_interval' in config['publish']: config['publish']['min_interval'] = 0
+    if not 'max_interval' in config['publish']: config['publish']['max_interval'] = None
+    if not 'inputs' in config['publish']: config['publish']['inputs'] = None
+
+    # Setup 'history'
+    if 'history' in config:
+        if config['history'] == None:
+            config['history'] = {}
+    else:
+        config['history'] = {}
+    if not 'enabled' in config['history']: config['history']['enabled'] = False
+
+    # Setup 'metrics'
+    if 'metrics' in config:
+        if config['metrics'] == None:
+            config['metrics'] = {}
+    else:
+        config['metrics'] = {}
+    if not 'enabled' in config['metrics']: config['metrics']['enabled'] = False
+    if not 'host' in config['metrics']: config['metrics']['host'] = '0.0.0.0'
+    if not 'port' in config['metrics']: config['metrics']['port'] = 9470
+
+    # Setup 'api'
+    if 'api' in config:
+        if config['api'] == None:
+            config['api'] = {}
+    else:
+        config['api'] = {}
+    if not 'enabled' in config['api']: config['api']['enabled'] = False
+    if not 'host' in config['api']: config['api']['host'] = '0.0.0.0'
+    if not 'port' in config['api']: config['api']['port'] = 9471
+    if not 'socket' in config['api']: config['api']['socket'] = None
+    if not 'max_wait' in config['api']: config['api']['max_wait'] = 60
+
+    # Append the configuration path if no '/' is in front of the socket
+    if config['api']['socket'] != None and not str(config['api']['socket']).startswith('/'):
+        config['api']['socket'] = configdirectory + str(config['api']['socket'])
+
+    # Setup 'capture'
+    if 'capture' in config:
+        if config['capture'] == None:
+            config['capture'] = {}
+    else:
+        config['capture'] = {}
+    if not 'enabled' in config['capture']: config['capture']['enabled'] = False
+    if not 'max_size' in config['capture']: config['capture']['max_size'] = 100
+
+    #  Convert MB to Bytes
+    config['capture']['max_size'] = config['capture']['max_size'] * 1024 * 1024
+
+    # Setup 'outbox'
+    if 'outbox' in config:
+        if config['outbox'] == None:
+            config['outbox'] = {}
+    else:
+        config['outbox'] = {}
+    if not 'enabled' in config['outbox']: config['outbox']['enabled'] = False
+    if not 'max_size' in config['outbox']: config['outbox']['max_size'] = 10
+    if not 'window' in config['outbox']: config['outbox']['window'] = 10
+    if not 'max_age' in config['outbox']: config['outbox']['max_age'] = None
+
+    #  Convert MB to Bytes
+    config['outbox']['max_size'] = config['outbox']['max_size'] * 1024 * 1024
+
+    # Setup 'influxdb' and 'csv', the sinks next to MQTT
+    if 'influxdb' in config:
+        if config['influxdb'] == None:
+            config['influxdb'] = {}
+    else:
+        config['influxdb'] = {}
+    if not 'enabled' in config['influxdb']: config['influxdb']['enabled'] = False
+    if not 'file' in config['influxdb']: config['influxdb']['file'] = 'influxdb.lp'
+    if not 'host' in config['influxdb']: config['influxdb']['host'] = None
+    if not 'port' in config['influxdb']: config['influxdb']['port'] = 8089
+    if not 'measurement' in config['influxdb']: config['influxdb']['measurement'] = 's0pcm'
+
+    if 'csv' in config:
+        if config['csv'] == None:
+            config['csv'] = {}
+    else:
+        config['csv'] = {}
+    if not 'enabled' in config['csv']: config['csv']['enabled'] = False
+    if not 'file' in config['csv']: config['csv']['file'] = 'export.csv'
+    if not 'delimiter' in config['csv']: config['csv']['delimiter'] = ','
+
+    for section in ['influxdb', 'csv']:
+        if not 'queue_size' in config[section]: config[section]['queue_size'] = 1000
+        if not 'batch_size' in config[section]: config[section]['batch_size'] = 100
+        if not 'flush_interval' in config[section]: config[section]['flush_interval'] = 10
+        if not 'drop' in config[section]: config[section]['drop'] = 'oldest'
+
+        config[section]['drop'] = str(config[section]['drop']).lower()
+        if not config[section]['drop'] in ['oldest', 'newest']:
+            print('WARN: Invalid \'drop\' ' + config[section]['drop'] + ' supplied in \'' + section + '\'. Only \'oldest\' and \'newest\' are supported. Using \'oldest\' now.')
+            config[section]['drop'] = 'oldest'
+
+        # Append the configuration path if no '/' is in front of the file
+        if not config[section]['file'].startswith('/'):
+            config[section]['file'] = configdirectory + config[section]['file']
+
+    # Setup 'supervisor', used by the 'process' runtime
+    if 'supervisor' in config:
+        if config['supervisor'] == None:
+            config['supervisor'] = {}
+    else:
+        config['supervisor'] = {}
+    if not 'poll_interval' in config['supervisor']: config['supervisor']['poll_interval'] = 0.1
+
+    # The worker processes only hand over the parsed telegrams, not the raw lines
+    if config['s0pcm']['runtime'] == 'process' and config['capture']['enabled']:
+        print('WARN: \'capture\' isn\'t supported with the \'process\' runtime, disabling it.')
+        config['capture']['enabled'] = False
+
+    # Setup 'profile'
+    if 'profile' in config:
+        if config['profile'] == None:
+            config['profile'] = {}
+    else:
+        config['profile'] = {}
+    if not 'enabled' in config['profile']: config['profile']['enabled'] = True
+    if not 'duration' in config['profile']: config['profile']['duration'] = 60
+    if not 'max_duration' in config['profile']: config['profile']['max_duration'] = 600
+    if not 'memory' in config['profile']: config['profile']['memory'] = False
+    if not 'interval' in config['profile']: config['profile']['interval'] = 0.01
+    if not 'top' in config['profile']: config['profile']['top'] = 20
+    if not 'count' in config['profile']: config['profile']['count'] = 5
+
+    # Setup 'reload'
+    if 'reload' in config:
+        if config['reload'] == None:
+            config['reload'] = {}
+    else:
+        config['reload'] = {}
+    if not 'watch' in config['reload']: config['reload']['watch'] = True
+    if not 'interval' in config['reload']: config['reload']['interval'] = 5
+
+    # A replay doesn't capture again and uses the threads, the replay isn't a file descriptor
+    if args.command == 'replay':
+        config['capture']['enabled'] = False
+        config['outbox']['enabled'] = False
+        config['s0pcm']['runtime'] = 'threading'
+
+    # Setup 'devices'. Without devices, we have a single S0PCM with the 'serial' settings
+    if not 'devices' in config or config['devices'] == None:
+        config['devices'] = [{'name': None}]
+        config['multidevice'] = False
+    else:
+        config['multidevice'] = True
+
+    names = []
+    for device in config['devices']:
+        # Each device inherits the 'serial' and 's0pcm' settings which are not configured
+        for key in config['serial']:
+            if not key in device: device[key] = config['serial'][key]
+        if not 'include' in device: device['include'] = config['s0pcm']['include']
+        if not 'dailystat' in device: device['dailystat'] = config['s0pcm']['dailystat']
+        if not 'rates' in device: device['rates'] = config['rates']['inputs']
+        if not 'publish' in device: device['publish'] = config['publish']['inputs']
+        if not 'id' in device: device['id'] = None
+
+        if config['multidevice']:
+            if not 'name' in device or device['name'] == None:
+                if device['id'] != None:
+                    device['name'] = str(device['id'])
+                else:
+                    device['name'] = device['port'].split('/')[-1]
+            device['name'] = str(device['name'])
+
+            if device['name'] == '' or device['name'] == '-' or ' ' in device['name'] or '/' in device['name']:
+                raise ValueError('Invalid device name \'' + device['name'] + '\' supplied')
+            if device['name'] in names:
+                raise ValueError('Duplicate device name \'' + device['name'] + '\' supplied')
+            names.append(device['name'])
+
+            if not 'topic' in device: device['topic'] = device['name']
+        else:
+            device['topic'] = None
+
+        if device['id'] != None:
+            device['id'] = str(device['id'])
+
+    # The devices behind a network serialport share its connection, the lines are handed out by ID
+    for device in config['devices']:
+        if netserial.IsUrl(device['port']) and device['id'] == None and len([other for other in config['devices'] if other['port'] == device['port']]) > 1:
+            print('WARN: Device \'' + str(device['name']) + '\' shares \'' + device['port'] + '\' with other devices, but has no \'id\'. It receives the telegrams of all devices.')
+
+    return config
+
+def ReadConfig():
+
+    global config
+    global loghandler
+    global logwriter
+
+    # Setup logfile and rotation, with the defaults until the configuration is read. The logfile
+    # is written by a background thread, the queued records are written by 'StopLogging' at the stop.
+    loghandler = RotatingFileHandler(logname, maxBytes=10 * 1024 * 1024, backupCount=3)
+    loghandler.setLevel(logging.WARNING)
+    loghandler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+    logwriter = asynclog.AsyncLog(loghandler)
+    logger.addHandler(logwriter.handler)
+
+    config = LoadConfig()
+    SetupLogging()
 
     logger.debug('Start: s0pcm-reader')
     
-    logger.debug('Config: %s', str(config))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Config: %s', str(config))
+
+# ------------------------------------------------------------------------------------
+# Apply the 'log' settings to the logfile, also done on a reload
+# ------------------------------------------------------------------------------------
+def SetupLogging():
+    loghandler.setLevel(config['log']['level'])
+    loghandler.maxBytes = config['log']['size']
+    loghandler.backupCount = config['log']['count']
+
+    # A message below the level isn't even created, e.g. the debug messages of every telegram
+    logger.setLevel(config['log']['level'])
+    logwriter.Configure(config['log']['queue_size'], config['log']['rate_limit'], config['log']['rate_interval'])
+
+# ------------------------------------------------------------------------------------
+# Write the queued log records and stop the background thread. Called at the end of
+# the shutdown (also after a SIGTERM, see the signal handler) and before an exit.
+# ------------------------------------------------------------------------------------
+def StopLogging():
+    if logwriter != None:
+        logwriter.Stop()
 
 # ------------------------------------------------------------------------------------
 # Read the 'measurement.yaml' file
 # ------------------------------------------------------------------------------------
 def ReadMeasurement():
 
-    global measurement
+    global measurementjournal
+    global historystore
 
-    try:
-        with open(measurementname, 'r') as f:
-            measurement = yaml.safe_load(f)
-    except FileNotFoundError:
-        logger.warning('No \'%s\' found, using defaults.', measurementname)
+    # The state file is only used if it belongs to the current 'measurement.yaml'
+    state = None
+    if config['journal']['state']:
+        state = statefile.Read(statename, statefile.Source(measurementname))
+        if state != None:
+            logger.debug('Read counters from \'%s\'', statename)
 
-    # check date format
-    if 'date' in measurement:
-        # check date format
+    if state == None:
+        content = {}
         try:
-            measurement['date'] = datetime.datetime.strptime(str(measurement['date']), '%Y-%m-%d')
-            measurement['date'] = measurement['date'].date()
-        except ValueError:
-            logger.error('\'%s\' has an invalid date field \'%s\', default to today \'%s\'', measurementname, str(measurement['date']), str(datetime.date.today()))
-            measurement['date'] = datetime.date.today()
+            with open(measurementname, 'r') as f:
+                content = yaml.safe_load(f)
+        except FileNotFoundError:
+            logger.warning('No \'%s\' found, using defaults.', measurementname)
+
+        if content == None:
+            content = {}
+
+    # With multiple devices, every device has its own section in the file
+    measurement = {}
+    for device in config['devices']:
+        if state != None:
+            measurement[device['name']] = state.get(device['name'], {})
+        elif config['multidevice']:
+            measurement[device['name']] = {}
+            for key in content:
+                if str(key) == device['name'] and content[key] != None:
+                    measurement[device['name']] = content[key]
+        else:
+            measurement[None] = content
+
+    # The counters of a single S0PCM (before 'devices' was configured) belong to the first device
+    migrated = False
+    if config['multidevice']:
+        names = [device['name'] for device in config['devices']]
+        if state != None:
+            single = state.get(None, {})
+        else:
+            single = dict([(key, content[key]) for key in content if not str(key) in names])
+
+        if 'date' in single or len([key for key in single if isinstance(key, int)]) > 0:
+            if len(measurement[names[0]]) > 0:
+                raise ValueError('\'' + measurementname + '\' has the counters of a single S0PCM and of device \'' + names[0] + '\', move the single S0PCM counters into a device section')
+            logger.warning('\'%s\' has the counters of a single S0PCM, they are moved to device \'%s\'', measurementname, names[0])
+            measurement[names[0]] = single
+            migrated = True
+
+    # Replay the changes which are not yet compacted into 'measurement.yaml'
+    if config['journal']['enabled']:
+        measurementjournal = journal.MeasurementJournal(measurementname, journalname,
+                                                        compact_interval=config['journal']['compact_interval'],
+                                                        compact_size=config['journal']['compact_size'],
+                                                        fsync_interval=config['journal']['fsync_interval'])
+
+        # The journal records of the single S0PCM ('-') are moved along
+        if migrated:
+            measurement[None] = measurement[names[0]]
+        measurementjournal.Replay(measurement)
+        if migrated:
+            del measurement[None]
+
+    # check date format
+    for name in measurement:
+        if 'date' in measurement[name]:
+            # check date format
+            try:
+                measurement[name]['date'] = datetime.datetime.strptime(str(measurement[name]['date']), '%Y-%m-%d')
+                measurement[name]['date'] = measurement[name]['date'].date()
+            except ValueError:
+                logger.error('\'%s\' has an invalid date field \'%s\', default to today \'%s\'', measurementname, str(measurement[name]['date']), str(datetime.date.today()))
+                measurement[name]['date'] = datetime.date.today()
+        elif args.command != 'replay':
+            measurement[name]['date'] = datetime.date.today()
+
+        # The hour of the 'this_hour' counter, without it the hour isn't rolled over at start-up
+        if 'hour' in measurement[name]:
+            if not isinstance(measurement[name]['hour'], int) or measurement[name]['hour'] < 0 or measurement[name]['hour'] > 23:
+                logger.error('\'%s\' has an invalid hour field \'%s\', ignoring it', measurementname, str(measurement[name]['hour']))
+                del measurement[name]['hour']
+
+    logger.debug('Measurement: %s', measurement)
+
+    # From now on, the counters are maintained by the counter store
+    for name in measurement:
+        counterstore.Load(name, measurement[name])
+
+    # Start with an empty journal, nothing to do if the journal is already empty
+    if measurementjournal != None and (measurementjournal.Size() > 0 or statefile.Source(measurementname) == None):
+        measurementjournal.Compact(MeasurementContent())
+        state = None
+
+    # (Re)write the state file if it wasn't used, e.g. after an edit of 'measurement.yaml'
+    if state == None:
+        WriteState()
+
+    # The hourly, daily and monthly usage is stored in the 'history' folder
+    if config['history']['enabled']:
+        import history
+        historystore = history.HistoryStore(configdirectory + 'history')
+
+# ------------------------------------------------------------------------------------
+# The measurement as it is stored in the 'measurement.yaml' file
+# ------------------------------------------------------------------------------------
+def MeasurementContent():
+
+    if config['multidevice']:
+        content = {}
+        for device in config['devices']:
+            content[device['name']] = counterstore.Dump(device['name'])
+        return content
     else:
-        measurement['date'] = datetime.date.today()
+        return counterstore.Dump(None)
+
+# ------------------------------------------------------------------------------------
+# Write the counters to the state file, after 'measurement.yaml' is written. The next
+# start-up reads the counters from it instead of parsing 'measurement.yaml'.
+# ------------------------------------------------------------------------------------
+def WriteState():
 
-    logger.debug('Measurement: %s', str(measurement))
+    if not config['journal']['state']:
+        return
+
+    try:
+        statefile.Write(statename, dict([(device['name'], counterstore.Dump(device['name'])) for device in config['devices']]), statefile.Source(measurementname))
+    except (OSError, TypeError) as e:
+        logger.error('Failed to write \'%s\'. %s: \'%s\'', statename, type(e).__name__, str(e))
+
+# ------------------------------------------------------------------------------------
+# Write the 'measurement.yaml' file, or append the changed inputs to the journal.
+# The caller needs to hold the lock, because multiple devices can write.
+# ------------------------------------------------------------------------------------
+def WriteMeasurement(name, snapshots):
+
+    start = time.perf_counter()
+
+    if measurementjournal == None:
+        logger.debug('Updated \'%s\' file', measurementname)
+        with open(measurementname, 'w') as f:
+            yaml.dump(MeasurementContent(), f, default_flow_style=False)
+    else:
+        logger.debug('Updated \'%s\' file', journalname)
+        measurementjournal.Append(name, counterstore.Date(name), snapshots, counterstore.Hour(name))
+
+        if measurementjournal.NeedCompact():
+            measurementjournal.Compact(MeasurementContent())
+            WriteState()
+
+        measurementjournal.Report()
+
+    metrics.persistseconds.Observe(time.perf_counter() - start)
 
 # ------------------------------------------------------------------------------------
 # Task to read the serial port. We continue to try to open the serialport, because
@@ -258,180 +759,437 @@ def ReadMeasurement():
 # ------------------------------------------------------------------------------------
 class TaskReadSerial(threading.Thread):
 
-    def __init__(self, trigger, stopper):
-        super().__init__()
+    def __init__(self, trigger, stopper, device, replay=None):
+        # The thread is named after the device, e.g. in a profile
+        super().__init__(name='ReadSerial' if device['name'] == None else 'ReadSerial-' + device['name'])
         self._trigger = trigger
         self._stopper = stopper
+        self._device = device
+        self._devicename = device['name']
+        self._replay = replay
+        self._reopen = False
+        self._wakeup = None
+
+        self._parser = telegram.TelegramParser()
+        self._samples = None
+        self._rates = None
+        self._capture = None
+
+        # Detects a stalled S0PCM, the pipe wakes up the select() of the reader
+        self._watchdog = watchdog.TelegramWatchdog(device['stall_factor'], device['timeout'])
+        self._wakeupread, self._wakeupwrite = os.pipe()
+        os.set_blocking(self._wakeupread, False)
+        os.set_blocking(self._wakeupwrite, False)
+
+        # Make the logging clear, if we have multiple devices
+        if self._devicename == None:
+            self._prefix = ''
+        else:
+            self._prefix = '[' + self._devicename + '] '
 
-        self._serialerror = 0
+        # The device label of the metrics
+        self._label = '' if self._devicename == None else self._devicename
 
-    def ReadSerial(self):
+        # The flow rate/power is calculated from the pulses of the last interval
+        self._ratesettings = None
+        self.Reconfigure()
 
-        global measurementshare
+        # The pulses of the last interval are stored in a ring buffer file
+        if config['samples']['enabled']:
+            import samples
 
-        while not self._stopper.is_set():
+            if self._devicename == None:
+                samplename = configdirectory + 'samples.ring'
+            else:
+                samplename = configdirectory + 'samples-' + self._devicename + '.ring'
 
-            logger.debug('Opening serialport \'%s\'', config['serial']['port'])
+            try:
+                self._samples = samples.SampleRing(samplename, config['samples']['capacity'])
+            except Exception as e:
+                logger.error('%sSample file \'%s\' open/create failed. %s: \'%s\'', self._prefix, samplename, type(e).__name__, str(e))
+
+        # The raw lines are stored in a capture file, which can be replayed
+        if config['capture']['enabled']:
+            import capture
+
+            if self._devicename == None:
+                capturename = configdirectory + 'capture.bin'
+            else:
+                capturename = configdirectory + 'capture-' + self._devicename + '.bin'
 
             try:
-                ser = serial.Serial(config['serial']['port'], 
-                                    baudrate=config['serial']['baudrate'],
-                                    parity=config['serial']['parity'],
-                                    stopbits=config['serial']['stopbits'],
-                                    bytesize=config['serial']['bytesize'],
-                                    timeout=config['serial']['timeout'])
-                self._serialerror = 0
+                self._capture = capture.CaptureWriter(capturename, self._devicename, config['capture']['max_size'])
             except Exception as e:
-                self._serialerror += 1
-                logger.error('Serialport connection failed. %s: \'%s\'', type(e).__name__, str(e))
-                logger.error('Retry in %d seconds', config['serial']['connect_retry'])
-                time.sleep(config['serial']['connect_retry'])
+                logger.error('%sCapture file \'%s\' open/create failed. %s: \'%s\'', self._prefix, capturename, type(e).__name__, str(e))
+
+    @property
+    def device(self):
+        return self._device
+
+    @property
+    def stalled(self):
+        return self._watchdog.stalled
+
+    # --------------------------------------------------------------------------------
+    # Apply the settings of the device which can be changed by a reload
+    # --------------------------------------------------------------------------------
+    def Reconfigure(self):
+
+        self._watchdog.Configure(self._device['stall_factor'], self._device['timeout'])
+
+        settings = (config['rates']['windows'], self._device['rates'])
+        if settings == self._ratesettings:
+            return
+
+        self._ratesettings = settings
+        if self._device['rates'] != None:
+            import rates
+            self._rates = rates.RateCalculator(config['rates']['windows'], self._device['rates'])
+        else:
+            self._rates = None
+
+    # --------------------------------------------------------------------------------
+    # Reopen the serialport, e.g. the port is changed by a reload. A pending read is
+    # cancelled by the wakeup function of the runtime.
+    # --------------------------------------------------------------------------------
+    def Reopen(self):
+        self._reopen = True
+        wakeup = self._wakeup
+        if wakeup != None:
+            wakeup()
+
+    def SetWakeup(self, wakeup):
+        self._wakeup = wakeup
+
+    # Wake up the select() of the reader thread, e.g. to stop or reopen
+    def Wakeup(self):
+        if self._wakeupwrite == None:
+            return
+        try:
+            os.write(self._wakeupwrite, b'\0')
+        except BlockingIOError:
+            pass
+
+    def CheckReopen(self):
+        if not self._reopen:
+            return False
+        self._reopen = False
+        logger.info('%sSerialport settings changed, reopening serialport \'%s\'', self._prefix, self._device['port'])
+        return True
+
+    @property
+    def prefix(self):
+        return self._prefix
+
+    # --------------------------------------------------------------------------------
+    # Add the new pulses to the counters. The counters are reset by the rollover task,
+    # so no date is required here.
+    # --------------------------------------------------------------------------------
+    def ProcessTelegram(self, packet):
+
+        # Keep track of the changed inputs, then we known we need to write the file
+        changed = []
+
+        # Loop through 2/5 s0pcm data
+        for count in range(1, packet.size + 1):
+            # We are interested in the total pulse count, because that is most reliable
+            pulsecount = packet.totals[count - 1]
+
+            # A new input starts with all counters at 0
+            current = counterstore.Get(self._devicename, count)
+
+            if pulsecount > current.pulsecount:
+
+                logger.debug('%sPulsecount changed from \'%d\' to \'%d\'', self._prefix, current.pulsecount, pulsecount)
+
+                # Pulsecount has changed, lets do some magic :-)
+                delta = pulsecount - current.pulsecount
+
+            elif pulsecount < current.pulsecount:
+                metrics.devicerestarts.Inc(self._label, count)
+                logger.warning('%sStored pulsecount \'%d\' of input \'%d\' is higher then read \'%d\', this normally happens if the s0pcm is restarted. We will continue counting, but for an precise value, read the meter value and correct the totals in the \'%s\' file', self._prefix, current.pulsecount, count, pulsecount, measurementname)
+                delta = pulsecount
+
+            else:
                 continue
 
-            # Only do a read of the data when the port is opened succesfully
-            while not self._stopper.is_set():
+            if counterstore.Update(self._devicename, count, pulsecount=pulsecount, total=current.total + delta, today=current.today + delta,
+                                   this_hour=current.this_hour + delta, this_week=current.this_week + delta, this_month=current.this_month + delta):
+                changed.append(counterstore.Get(self._devicename, count))
 
-                try:
-                    datain = ser.readline()
-                except Exception as e:
-                    logger.error('Serialport read error. %s: \'%s\'', type(e).__name__, str(e))
-                    ser.close()
-                    break
-             
-                # check if there is data received
-                # If there is really nothing, most likely a timeout on reading the input data
-                if len(datain) == 0:
-                    logger.error('Failed to read any data (timeout)')
-                    ser.close()
-                    break
+        # Write the 'measurement.yaml' file with the new data. Only when data has changed.
+        if len(changed) == 0:
+            logger.debug('%sNo change to the \'%s\' file (no write)', self._prefix, measurementname)
+        else:
+            WriteMeasurement(self._devicename, changed)
+
+    # --------------------------------------------------------------------------------
+    # Open the serialport of the device, the timeout can be overruled (e.g. asyncio)
+    # --------------------------------------------------------------------------------
+    def OpenSerial(self, timeout=None):
+
+        # A replay of a capture, it returns the lines like a serialport
+        if self._replay != None:
+            logger.debug('%sReplaying capture \'%s\'', self._prefix, self._replay)
+            import capture
+            return capture.ReplaySource(self._replay, args.speed)
+
+        # A network serialport, e.g. 'socket://host:port' of ser2net, shared by the devices behind it
+        if netserial.IsUrl(self._device['port']):
+            logger.debug('%sOpening network serialport \'%s\'', self._prefix, self._device['port'])
+            return serialpool.Open(self._device)
+
+        logger.debug('%sOpening serialport \'%s\'', self._prefix, self._device['port'])
+
+        return serial.Serial(self._device['port'],
+                             baudrate=self._device['baudrate'],
+                             parity=self._device['parity'],
+                             stopbits=self._device['stopbits'],
+                             bytesize=self._device['bytesize'],
+                             timeout=self._device['timeout'] if timeout == None else timeout)
+
+    # --------------------------------------------------------------------------------
+    # Handle a single line of data, returns True if the counters are processed. The
+    # timestamp is the receive time, only supplied with a replay.
+    # --------------------------------------------------------------------------------
+    def HandleLine(self, datain, timestamp=None):
+
+        if timestamp == None:
+            timestamp = time.time()
+            clock = time.monotonic()
+        else:
+            clock = timestamp
 
-                # need to decode the data to ascii string
-                try:
-                    datastr = datain.decode('ascii')
-                except UnicodeDecodeError:
-                    logger.error('Failed to decode \'%s\'', str(datain))
-                    continue
+            # A replay has its own time, the counters are rolled over at the time of the capture
+            t4.Check(timestamp)
 
-                # Need to remove '\r\n' from the input
-                datastr = datastr.rstrip('\r\n')
+        if self._capture != None:
+            try:
+                self._capture.Append(timestamp, datain)
+            except Exception as e:
+                logger.error('%sCapture write failed. %s: \'%s\'', self._prefix, type(e).__name__, str(e))
 
-                if datastr.startswith('/'):
-                    logger.debug('Header Packet: \'%s\'', datastr)
-                elif datastr.startswith('ID:'):
-                    logger.debug('S0PCM Packet: \'%s\'', datastr)
+        # Parse the raw data, the parser also validates the S0PCM-2/S0PCM-5 layout
+        start = time.perf_counter()
+        try:
+            packet = self._parser.Parse(datain)
+        except telegram.TelegramError as e:
+            metrics.decodeerrors.Inc(self._label)
+            logger.error('%s%s', self._prefix, str(e))
+            return False
+        finally:
+            metrics.parseseconds.Observe(time.perf_counter() - start, self._label)
+
+        if packet == None:
+            metrics.invalidpackets.Inc(self._label)
+            logger.warning('%sEmpty Packet received, this can happen during start-up', self._prefix)
+            return False
+        elif isinstance(packet, telegram.Header):
+            logger.debug('%sHeader Packet: \'%s\'', self._prefix, packet)
+            return False
+
+        logger.debug('%sS0PCM Packet: \'%s\'', self._prefix, datain)
+
+        return self.HandleTelegram(packet, timestamp, clock)
+
+    # --------------------------------------------------------------------------------
+    # Handle a parsed telegram, also used by the 'process' runtime. The clock is the
+    # monotonic time of the receive time.
+    # --------------------------------------------------------------------------------
+    def HandleTelegram(self, packet, timestamp, clock):
+
+        # The telegram should be of the configured S0PCM
+        if self._device['id'] != None and packet.id != self._device['id']:
+            metrics.invalidpackets.Inc(self._label)
+            logger.error('%sPacket has ID \'%s\', expected \'%s\'', self._prefix, packet.id, self._device['id'])
+            return False
+
+        if self._samples != None:
+            self._samples.Append(timestamp, packet.pulses)
+
+        # Do some lock/release on global variables, other devices also write the measurement
+        with lock:
+            self.ProcessTelegram(packet)
+
+        if self._rates != None:
+            for key, values in self._rates.Add(clock, packet.interval, packet.pulses):
+                counterstore.Update(self._devicename, key, rates=values)
+
+        metrics.telegrams.Inc(self._label)
+        metrics.lasttelegram.Set(time.time(), self._label)
+
+        stalled = self._watchdog.stalled
+        missed = self._watchdog.Telegram(clock, packet.interval)
+        if missed > 0:
+            metrics.telegramsmissed.Inc(self._label, amount=missed)
+            logger.warning('%sTelegram is late, %d telegram(s) missed', self._prefix, missed)
+        if stalled:
+            metrics.serialstalled.Set(0, self._label)
+            logger.warning('%sTelegrams are received again, the S0PCM isn\'t stalled anymore', self._prefix)
+
+        # Hand the new counters to the sinks, this also wakes up MQTT
+        pipeline.Put(sinks.Reading(timestamp, self._devicename, tuple([counterstore.Get(self._devicename, count) for count in range(1, packet.size + 1)]), packet.pulses))
+
+        return True
+
+    # --------------------------------------------------------------------------------
+    # The watchdog of the telegrams: the serialport is opened, the seconds to wait for
+    # a telegram and no telegram is received in time
+    # --------------------------------------------------------------------------------
+    def Opened(self):
+        self._watchdog.Start(time.monotonic())
+
+    def ReadTimeout(self):
+        return self._watchdog.Timeout(time.monotonic())
+
+    def Stalled(self):
+        self.SerialError()
+        if not self._watchdog.stalled:
+            self._watchdog.stalled = True
+            metrics.serialstalled.Set(1, self._label)
+
+            # Publish the stalled state
+            self._trigger.set()
+
+        logger.error('%sNo telegram received in %d seconds, the S0PCM is stalled. Reopening serialport \'%s\'', self._prefix, self._watchdog.limit, self._device['port'])
+
+    # --------------------------------------------------------------------------------
+    # Count a failed open, read error or read timeout of the serialport
+    # --------------------------------------------------------------------------------
+    def SerialError(self):
+        metrics.serialreconnects.Inc(self._label)
+
+    def Close(self):
+        for fd in [self._wakeupread, self._wakeupwrite]:
+            if fd != None:
+                os.close(fd)
+        self._wakeupread = self._wakeupwrite = None
+        if self._samples != None:
+            self._samples.Close()
+            self._samples = None
+        if self._capture != None:
+            self._capture.Close()
+            self._capture = None
+
+    # --------------------------------------------------------------------------------
+    # Read the serialport. The port is read non-blocking, select() waits for data until
+    # the deadline of the watchdog. A stop or reopen wakes up select() with the pipe.
+    # --------------------------------------------------------------------------------
+    def ReadSerial(self):
 
-                    # Split data into an array
-                    s0arr = datastr.split(':')
+        if self._replay != None:
+            return self.ReadReplay()
 
-                    # s0pcm-5 - 19
-                    if len(s0arr) == 19:
-                        # ID:8237:I:10:M1:0:0:M2:0:0:M3:0:0:M4:0:0:M5:0:0
-                        size = 5
+        backoff = watchdog.Backoff(self._device['connect_retry'])
+        self.SetWakeup(self.Wakeup)
+        self._stopper.AddWakeup(self.Wakeup)
 
-                    # s0pcm-2 - 10
-                    elif len(s0arr) == 10: 
-                        # ID:8237:I:10:M1:0:0:M2:0:0
-                        size = 2
+        while not self._stopper.is_set():
 
-                    else:
-                        logger.error('Packet has invalid length. Excepted 10 or 19, got %d.', len(s0arr))
-                        continue
+            try:
+                self._reopen = False
+                ser = self.OpenSerial(timeout=0)
+            except Exception as e:
+                delay = backoff.Next()
+                self.SerialError()
+                logger.error('%sSerialport connection failed. %s: \'%s\'', self._prefix, type(e).__name__, str(e))
+                logger.error('%sRetry in %.1f seconds', self._prefix, delay)
+                self._stopper.wait(delay)
+                continue
 
-                    # Key a copy of the measurement file, then we known we need to write the file
-                    measurementstr = str(measurement)
+            self.Opened()
+            stalled = False
+            buffer = b''
 
-                    # Loop through 2/5 s0pcm data
-                    for count in range(1, size + 1):
-                        offset = 4 + ((count - 1) * 3)
-                        if s0arr[offset] == 'M' + str(count):
-                            # We are interested in the total pulse count, because that is most reliable
+            try:
+                while not self._stopper.is_set():
+                    readable = select.select([ser.fileno(), self._wakeupread], [], [], self.ReadTimeout())[0]
 
+                    if self._wakeupread in readable:
+                        while True:
                             try:
-                                pulsecount = int(s0arr[offset + 2])
-                            except:
-                                logger.error('Cannot convert pulsecount \'%s\' into integer, received \'%s\'', s0arr[offset], s0arr[offset + 2])
-                                pulsecount = 0
-
-                            # Initialize the variables, if they doesn't exist
-                            if not count in measurement: measurement[count] = {}
-                            if not 'pulsecount' in measurement[count]: measurement[count]['pulsecount'] = 0
-                            if not 'total' in measurement[count]: measurement[count]['total'] = 0
-                            if not 'today' in measurement[count]: measurement[count]['today'] = 0
-                            if not 'yesterday' in measurement[count]: measurement[count]['yesterday'] = 0
-                            
-                            # We got a date change
-                            if str(measurement['date']) != str(datetime.date.today()):
-                                logger.debug('Day changed from \'%s\' to \'%s\', resetting today counter \'%d\' to \'0\'. Yesterday counter is \'%d\'', str(measurement['date']), str(datetime.date.today()), count, measurement[count]['today'])
-                                measurement[count]['yesterday'] = measurement[count]['today']
-                                measurement[count]['today'] = 0
-
-                                # Write the counters to a text file if required
-                                todayfile = False
-                                if config['s0pcm']['dailystat'] != None:
-                                    if count in config['s0pcm']['dailystat']:
-                                        todayfile = True
-
-                                if todayfile == True:
-                                    try:
-                                        fstat = open(configdirectory + 'daily-' + str(count) + '.txt', 'a')
-                                        fstat.write(str(measurement['date']) + ';' + str(measurement[count]['yesterday']) + '\n')
-                                        fstat.close()
-                                    except Exception as e:
-                                        logger.error('Stats file \'%s\' write/create failed. %s: \'%s\'', configdirectory + 'daily-' + str(count) + '.txt', type(e).__name__, str(e))
-                            
-                            if pulsecount > measurement[count]['pulsecount']:
-
-                                logger.debug('Pulsecount changed from \'%d\' to \'%d\'', measurement[count]['pulsecount'], pulsecount)
-
-                                # Pulsecount has changed, lets do some magic :-)
-                                delta = pulsecount - measurement[count]['pulsecount']
-                                measurement[count]['pulsecount'] = pulsecount
-                                measurement[count]['total'] += delta
-                                measurement[count]['today'] += delta
-
-                            elif pulsecount < measurement[count]['pulsecount']:
-                                logger.warning('Stored pulsecount \'%s\' is higher then read, this normally happens if the s0pcm is restarted. We will continue counting, but for an precise value, read the meter value and correct the totals in the \'%s\' file', s0arr[offset], measurementname)
-                                delta = pulsecount
-                                measurement[count]['pulsecount'] = pulsecount
-                                measurement[count]['total'] += delta
-                                measurement[count]['today'] += delta
-
-                        else:
-                            logger.error('Expecting \'M%s\', received \'%s\'', str(count), s0arr[offset])
-                            continue
-
-                    # Update todays date - but we don't convert to str yet, it looks nicer without it in the yaml file ;-)
-                    if str(measurement['date']) != str(datetime.date.today()):
-                        measurement['date'] = datetime.date.today()
-
-                    # Write the 'measurement.yaml' file with the new data. Only when data has changed.
-                    if measurementstr == str(measurement):
-                        logger.debug('No change to the \'%s\' file (no write)', measurementname)
-                    else:
-                        logger.debug('Updated \'%s\' file', measurementname)
-                        with open(measurementname, 'w') as f:
-                            yaml.dump(measurement, f, default_flow_style=False)
+                                os.read(self._wakeupread, 64)
+                            except BlockingIOError:
+                                break
 
-                    # Do some lock/release on global variables
-                    lock.acquire()
-                    measurementshare = copy.deepcopy(measurement)
-                    lock.release()
+                    if self._stopper.is_set() or self.CheckReopen():
+                        break
 
-                    # Trigger that new data is available for MQTT
-                    self._trigger.set()
+                    if len(readable) == 0:
+                        self.Stalled()
+                        stalled = True
+                        break
 
-                elif datastr == '':
-                    logger.warning('Empty Packet received, this can happen during start-up')
-                else:
-                    logger.error('Invalid Packet: \'%s\'', datastr)
+                    if not ser.fileno() in readable:
+                        continue
+
+                    # With timeout=0, read() never blocks. It raises an exception if the device is gone.
+                    buffer += ser.read(max(ser.in_waiting, 1))
+
+                    while True:
+                        index = buffer.find(b'\n')
+                        if index < 0:
+                            break
+                        datain = buffer[:index + 1]
+                        buffer = buffer[index + 1:]
+
+                        if self.HandleLine(datain):
+                            backoff.Reset()
+
+            except Exception as e:
+                logger.error('%sSerialport read error. %s: \'%s\'', self._prefix, type(e).__name__, str(e))
+                self.SerialError()
+                stalled = True
+            finally:
+                ser.close()
+
+            # Don't reopen a stalled or failing device in a tight loop
+            if stalled:
+                delay = backoff.Next()
+                logger.error('%sRetry in %.1f seconds', self._prefix, delay)
+                self._stopper.wait(delay)
+
+    # --------------------------------------------------------------------------------
+    # Replay a capture, the lines are read from the capture file instead of a port
+    # --------------------------------------------------------------------------------
+    def ReadReplay(self):
+
+        ser = self.OpenSerial()
+
+        while not self._stopper.is_set():
+            datain = ser.readline()
+
+            if len(datain) == 0:
+                logger.info('%sReplay of \'%s\' finished, %d line(s)', self._prefix, self._replay, ser.count)
+                break
+
+            self.HandleLine(datain, ser.timestamp)
+
+        ser.close()
 
     def run(self):
         try:
             self.ReadSerial()
         except:
             logger.error('Fatal exception has occured', exc_info=True)
-        finally:
             self._stopper.set()
+        finally:
+            # At the end of a replay the other devices continue, the main code stops everything
+            if self._replay == None:
+                self._stopper.set()
+            self._trigger.set()
+
+# ------------------------------------------------------------------------------------
+# Import the paho MQTT client on first use (by the MQTT task). It is the slowest import
+# and isn't needed by e.g. a replay without MQTT.
+# ------------------------------------------------------------------------------------
+def ImportMqtt():
+
+    global mqtt
+
+    if mqtt == None:
+        import paho.mqtt.client
+        mqtt = paho.mqtt.client
 
 # ------------------------------------------------------------------------------------
 # Task to do MQTT Publish
@@ -440,52 +1198,130 @@ class TaskReadSerial(threading.Thread):
 class TaskDoMQTT(threading.Thread):
 
     def __init__(self, trigger, stopper):
-        super().__init__()
+        super().__init__(name='DoMQTT')
         self._trigger = trigger
         self._stopper = stopper
         self._connected = False
+        self._connack = threading.Event()
+        self._reconnect = False
+        self._republish = False
+        self._firstpublish = False
+        self._wakeup = trigger.set
+        self._filter = policy.PublishFilter(self.ResolvePolicy)
+
+        # The published stalled state per device
+        self._stalled = {}
+
+        # The command topics (below 'base_topic') with their handler, and the messages
+        # posted by other threads, which are published by the next publish
+        self._commands = {}
+        self._posted = collections.deque()
+
+        # The publishes which can't be send are stored in the outbox, see 'outbox.py'
+        self._outbox = None
+        self._inflight = {}
+        self._acks = collections.deque()
+        self._connection = 0
+        self._drainconnection = 0
+        self._dropped = 0
+
+        if config['outbox']['enabled']:
+            try:
+                import outbox
+                self._outbox = outbox.Outbox(outboxname, config['outbox']['max_size'])
+                metrics.outboxdepth.Set(self._outbox.count)
+            except Exception as e:
+                logger.error('Outbox \'%s\' open/create failed. %s: \'%s\'', outboxname, type(e).__name__, str(e))
 
     def on_connect(self, mqttc, obj, flags, rc):
         if rc == 0:
             self._connected = True
+            self._connection += 1
+            metrics.mqttconnected.Set(1)
             logger.debug('MQTT successfully connected to broker')
+            if not self._firstpublish:
+                metrics.startupseconds.Set(time.monotonic() - STARTTIME, 'connected')
             self._mqttc.publish(config['mqtt']['base_topic'] + '/status', config['mqtt']['online'], retain=config['mqtt']['retain'])
+            metrics.mqttpublished.Inc()
+
+            # Subscribe (again) to the command topics
+            for subtopic in self._commands:
+                self._mqttc.subscribe(config['mqtt']['base_topic'] + '/' + subtopic)
+
+            # Publish the (retained) counters directly, the broker can be restarted and the
+            # outbox is drained
+            self.Republish()
         else:
             self._connected = False
 
+        self._connack.set()
+
     def on_disconnect(self, mqttc, userdata, rc):
         self._connected = False
+        metrics.mqttconnected.Set(0)
         if rc == 0:
             logger.debug('MQTT successfully disconnected to broker')
         else:
             logger.error('MQTT failed to connect to broker \'%s\', retrying.', mqtt.connack_string(rc))
 
     def on_message(self, mqttc, obj, msg):
-        logger.debug('MQTT on_message: ' + msg.topic + ' ' + str(msg.qos) + ' ' + str(msg.payload))
+        logger.debug('MQTT on_message: %s %s %s', msg.topic, msg.qos, msg.payload)
+
+        # A retained command would be executed again on every connect
+        if msg.retain:
+            logger.warning('MQTT command \'%s\' is retained, ignoring it', msg.topic)
+            return
+
+        prefix = config['mqtt']['base_topic'] + '/'
+        if not msg.topic.startswith(prefix):
+            return
+
+        handler = self._commands.get(msg.topic[len(prefix):])
+        if handler == None:
+            return
+
+        try:
+            handler(msg.payload)
+        except Exception as e:
+            logger.error('MQTT command \'%s\' failed. %s: \'%s\'', msg.topic, type(e).__name__, str(e))
 
     def on_publish(self, mqttc, obj, mid):
-        logger.debug('MQTT on_publish: mid: ' + str(mid))
+        metrics.mqttsent.Inc()
+
+        # The acknowledge of a publish from the outbox is handled by our own thread, the
+        # MQTT client holds its own lock during this callback
+        if self._outbox != None:
+            self._acks.append(mid)
+            if len(self._inflight) > 0:
+                self._wakeup()
 
     def on_subscribe(self, mqttc, obj, mid, granted_qos):
-        logger.debug('MQTT on_subscribe: ' + str(mid) + ' ' + str(granted_qos))
+        logger.debug('MQTT on_subscribe: %s %s', mid, granted_qos)
 
     def on_log(self, mqttc, obj, level, string):
-        logger.debug('MQTT on_log: ' + string)
+        logger.debug('MQTT on_log: %s', string)
 
-    def DoMQTT(self):
+    # --------------------------------------------------------------------------------
+    # Define our MQTT Client
+    # --------------------------------------------------------------------------------
+    def CreateClient(self):
 
-        global measurementshare
-        measurementprevious = {}
+        # Start from the current version, preventing send values when on change is enabled
+        self._version = counterstore.version
 
-        # Copy the measurements to previous one, preventing send values when on change is enabled
-        measurementprevious = measurement
+        self._devices = {}
+        for device in config['devices']:
+            self._devices[device['name']] = device
 
-        # Define our MQTT Client
+        # The topics and payload templates of all inputs
+        self._plan = publishplan.PublishPlan(config)
+
+        ImportMqtt()
         self._mqttc = mqtt.Client(client_id=config['mqtt']['client_id'], protocol=config['mqtt']['version'])
         self._mqttc.on_connect = self.on_connect
         self._mqttc.on_disconnect = self.on_disconnect
-        #self._mqttc.on_message = self.on_message
-        #self._mqttc.on_publish = self.on_publish
+        self._mqttc.on_message = self.on_message
+        self._mqttc.on_publish = self.on_publish
         #self._mqttc.on_subscribe = self.on_subscribe
 
         # https://github.com/eclipse/paho.mqtt.python/blob/master/examples/client_pub-wait.py
@@ -495,6 +1331,7 @@ class TaskDoMQTT(threading.Thread):
 
         # Setup TLS if requested
         if config['mqtt']['tls']:
+            import ssl
             context = ssl.SSLContext(ssl.PROTOCOL_TLS)
 
             if config['mqtt']['tls_ca'] == '':
@@ -510,126 +1347,711 @@ class TaskDoMQTT(threading.Thread):
         # Set last will
         self._mqttc.will_set(config['mqtt']['base_topic'] + '/status', config['mqtt']['lastwill'], retain=config['mqtt']['retain'])
 
+        return self._mqttc
+
+    # --------------------------------------------------------------------------------
+    # The publish policy of a subtopic of an input, see 'policy.py'
+    # --------------------------------------------------------------------------------
+    def ResolvePolicy(self, device, key, subkey):
+        return policy.Resolve(config['publish'], self._devices[device]['publish'], key, subkey)
+
+    # --------------------------------------------------------------------------------
+    # Seconds until a coalesced value or heartbeat has to be published, None if nothing
+    # --------------------------------------------------------------------------------
+    def NextDue(self):
+        return self._filter.NextDue(time.monotonic())
+
+    # --------------------------------------------------------------------------------
+    # Publish the counters, returns False if we are not connected. With 'flush' the
+    # values which are held back by a minimum interval are published too.
+    # --------------------------------------------------------------------------------
+    def Publish(self, flush=False):
+
+        # Check if we are connected, with an outbox we continue and store the publishes
+        if self._connected == False:
+            logger.debug('Not connected to MQTT Broker')
+            if self._outbox == None:
+                return False
+
+        start = time.perf_counter()
+        now = time.monotonic()
+
+        # Only fetch the inputs which are changed since the last publish. With an other
+        # encoding then 'plain' or 'publish_onchange=no' all inputs are published. After a
+        # reload everything is published again, e.g. the topic is changed.
+        if self._republish:
+            self._republish = False
+            self._filter.Reset()
+            self._stalled = {}
+            self._plan = publishplan.PublishPlan(config)
+            self._version = counterstore.version
+            changes = [(snapshot, counters.VERSIONED) for snapshot in counterstore.Snapshot()]
+        elif self._plan.encoding == 'plain' and config['s0pcm']['publish_onchange'] == True:
+            self._version, changes = counterstore.Changes(self._version)
+        else:
+            self._version = counterstore.version
+            changes = [(snapshot, counters.VERSIONED) for snapshot in counterstore.Snapshot()]
+
+        debug = logger.isEnabledFor(logging.DEBUG)
+        retain = config['mqtt']['retain']
+
+        for scope, topic, value, payload in self._plan.Messages(changes):
+
+            # The publish policy can hold back the value (deadband, minimum interval)
+            if not self._filter.Offer(scope, topic, value, payload, now):
+                metrics.mqttfiltered.Inc()
+                continue
+
+            self.Send(topic, payload, retain, debug)
+
+        # The coalesced values of which the minimum interval has passed, and the heartbeats
+        for topic, payload in self._filter.Due(now, flush):
+            self.Send(topic, payload, retain, debug)
+
+        # The stalled state of every device, only published when it is changed
+        for task in tasks:
+            if self._stalled.get(task.device['name']) != task.stalled:
+                self._stalled[task.device['name']] = task.stalled
+                self.Send(self._plan.DeviceTopic(task.device['name']) + '/stalled', 'true' if task.stalled else 'false', retain, debug)
+
+        # The messages of other threads, e.g. the summary of a profile
+        while len(self._posted) > 0:
+            subtopic, payload, postretain = self._posted.popleft()
+            self.Send(config['mqtt']['base_topic'] + '/' + subtopic, payload, postretain, debug)
+
+        self.Drain()
+
+        metrics.publishseconds.Observe(time.perf_counter() - start)
+
+        # The time from the start of the process to the first publish of the counters
+        if not self._firstpublish and self._connected:
+            self._firstpublish = True
+            elapsed = time.monotonic() - STARTTIME
+            metrics.startupseconds.Set(elapsed, 'published')
+            logger.info('First publish %.0f ms after the start', elapsed * 1000)
+
+        return self._connected
+
+    # --------------------------------------------------------------------------------
+    # Publish a single message. It is stored in the outbox when we are not connected,
+    # or when older publishes are still in the outbox (the order is kept).
+    # --------------------------------------------------------------------------------
+    def Send(self, topic, payload, retain, debug):
+
+        if self._outbox != None and (self._connected == False or self._outbox.count > 0):
+            if isinstance(payload, str):
+                payload = payload.encode('utf-8')
+            elif not isinstance(payload, bytes):
+                payload = str(payload).encode('ascii')
+
+            try:
+                self._outbox.Append(time.time(), topic, payload, retain)
+                metrics.outboxdepth.Set(self._outbox.count)
+            except Exception as e:
+                logger.error('Outbox write failed. Topic=%s. %s: \'%s\'', topic, type(e).__name__, str(e))
+            return
+
+        try:
+            if debug:
+                logger.debug('MQTT Publish of topic \'%s\' and value \'%s\'', topic, payload)
+
+            # Do a MQTT Publish
+            self._mqttc.publish(topic, payload, retain=retain)
+            metrics.mqttpublished.Inc()
+        except Exception as e:
+            logger.error('MQTT Publish Failed. Topic=%s. %s: \'%s\'', topic, type(e).__name__, str(e))
+
+    # --------------------------------------------------------------------------------
+    # Send the publishes of the outbox with QoS 1, with at most 'window' in flight. A
+    # publish is removed from the outbox when the broker acknowledged it.
+    # --------------------------------------------------------------------------------
+    def Drain(self):
+
+        if self._outbox == None:
+            return
+
+        try:
+            self.HandleAcks()
+
+            # The publishes in flight are lost with the connection, send them again
+            if len(self._inflight) > 0 and (self._connected == False or self._drainconnection != self._connection):
+                self._inflight.clear()
+                self._outbox.Rewind()
+
+            if self._connected == False:
+                return
+
+            self._drainconnection = self._connection
+
+            while len(self._inflight) < config['outbox']['window']:
+                record = self._outbox.Next()
+                if record == None:
+                    break
+
+                position, timestamp, topic, payload, retain = record
+
+                # Too old to be useful anymore
+                if config['outbox']['max_age'] != None and time.time() - timestamp > config['outbox']['max_age']:
+                    self._outbox.Ack(position)
+                    metrics.outboxdropped.Inc()
+                    continue
+
+                info = self._mqttc.publish(topic, payload, qos=1, retain=retain)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    self._inflight.clear()
+                    self._outbox.Rewind()
+                    break
+
+                self._inflight[info.mid] = position
+                metrics.mqttpublished.Inc()
+
+            # An acknowledge can be received before the publish is in our administration
+            self.HandleAcks()
+        except Exception as e:
+            logger.error('Outbox drain failed. %s: \'%s\'', type(e).__name__, str(e))
+
+    def HandleAcks(self):
+        while len(self._acks) > 0:
+            position = self._inflight.pop(self._acks.popleft(), None)
+            if position != None:
+                self._outbox.Ack(position)
+
+        if self._outbox.dropped > self._dropped:
+            logger.warning('Outbox is full, %d oldest publish(es) dropped', self._outbox.dropped - self._dropped)
+            metrics.outboxdropped.Inc(amount=self._outbox.dropped - self._dropped)
+            self._dropped = self._outbox.dropped
+        metrics.outboxdepth.Set(self._outbox.count)
+
+    def Close(self):
+        if self._outbox != None:
+            self._outbox.Close()
+            self._outbox = None
+
+    # --------------------------------------------------------------------------------
+    # Request a reconnect with a new client (e.g. the broker is changed by a reload)
+    # and/or to publish all values again on the next publish
+    # --------------------------------------------------------------------------------
+    def Reconnect(self):
+        self._reconnect = True
+        self._wakeup()
+
+    def CheckReconnect(self):
+        if not self._reconnect:
+            return False
+        self._reconnect = False
+        logger.info('MQTT settings changed, reconnecting to MQTT Broker \'%s:%s\'', config['mqtt']['host'], str(config['mqtt']['port']))
+        return True
+
+    def Republish(self):
+        self._republish = True
+        self._wakeup()
+
+    # --------------------------------------------------------------------------------
+    # Subscribe to '<base_topic>/<subtopic>', the handler is called with the payload by
+    # the MQTT client (thread or loop), so it should return quickly
+    # --------------------------------------------------------------------------------
+    def AddCommand(self, subtopic, handler):
+        self._commands[subtopic] = handler
+
+    # Publish '<base_topic>/<subtopic>' by the next publish, can be called by any thread
+    def Post(self, subtopic, payload, retain=False):
+        self._posted.append((subtopic, payload, retain))
+        self._wakeup()
+
+    # The function to wake up the publisher, the asyncio runtime has its own trigger
+    def SetWakeup(self, wakeup):
+        self._wakeup = wakeup
+
+    # --------------------------------------------------------------------------------
+    # MQTT as sink: the new counters are already in the counter store, which only keeps
+    # the latest value of every input. Only wake up the publisher, a slow broker never
+    # blocks the reader.
+    # --------------------------------------------------------------------------------
+    def Put(self, reading):
+        self._wakeup()
+
+    # --------------------------------------------------------------------------------
+    # Send an official offline message
+    # --------------------------------------------------------------------------------
+    def PublishOffline(self):
+        if self._connected:
+            self._mqttc.publish(config['mqtt']['base_topic'] + '/status', config['mqtt']['offline'], retain=config['mqtt']['retain'])
+            metrics.mqttpublished.Inc()
+
+    def DoMQTT(self):
+
+        self.CreateClient()
+        reconnect = False
+
         while not self._stopper.is_set():
 
+            # A new client, the client id, TLS or last will can be changed
+            if self.CheckReconnect() or reconnect:
+                self.CreateClient()
+                self.Republish()
+                reconnect = False
+
             logger.debug('Connecting to MQTT Broker \'%s:%s\'', config['mqtt']['host'], str(config['mqtt']['port']))
 
+            self._connack.clear()
+
             try:
                 self._mqttc.connect(config['mqtt']['host'], config['mqtt']['port'], 60)
             except Exception as e:
                 logger.error('MQTT connection failed. %s: \'%s\'', type(e).__name__, str(e))
                 logger.error('Retry in %d seconds', config['mqtt']['connect_retry'])
-                time.sleep(config['mqtt']['connect_retry'])
+
+                # With an outbox the changes are stored until we are connected
+                if self._outbox != None:
+                    self.Publish()
+
+                self._stopper.wait(config['mqtt']['connect_retry'])
                 continue
 
             #connect_async(host, port=1883, keepalive=60, bind_address="")
             self._mqttc.loop_start()
 
-            # Let's wait 1 second, otherwise we can be too fast?
-            time.sleep(1)
+            # Wait for the broker to acknowledge the connection, the counters are published
+            # directly after it. Without an acknowledge we continue, the client reconnects.
+            self._connack.wait(config['mqtt']['connect_retry'])
 
             while not self._stopper.is_set():
                 #Do our publish here with information we get from other Thread
 
                 # If no interval is defined, we wait on an event from the other thread
                 # We need to clear it (directly), otherwise it will run at  100% cpu
+                # We also wake up when a held back value or heartbeat is due.
                 if config['s0pcm']['publish_interval'] == None:
-                    self._trigger.wait()
+                    self._trigger.wait(self.NextDue())
                     self._trigger.clear()
 
-                # Do some lock/release on global variables
-                lock.acquire()
-                measurementlocal = copy.deepcopy(measurementshare)
-                lock.release()
+                if self.CheckReconnect():
+                    reconnect = True
+                    break
 
-                # Check if we are connected
-                if self._connected == False:
-                    logger.debug('Not connected to MQTT Broker')
-                    if config['s0pcm']['publish_interval'] != None:
-                        time.sleep(config['s0pcm']['publish_interval'])
-                    continue
+                self.Publish()
 
-                for key in measurementlocal:
-                    if isinstance(key, int):
+                # Now sleep according to publish interval, the outbox is drained in between
+                if config['s0pcm']['publish_interval'] != None:
+                    if self._outbox == None:
+                        self._stopper.wait(config['s0pcm']['publish_interval'])
+                    else:
+                        deadline = time.monotonic() + config['s0pcm']['publish_interval']
+                        while time.monotonic() < deadline and not self._stopper.is_set():
+                            if self._trigger.wait(deadline - time.monotonic()):
+                                self._trigger.clear()
+                                self.Drain()
 
-                        # define dict for json value
-                        jsondata = {}
+            # Publish the last changes, e.g. at the end of a replay
+            self.Publish(flush=True)
 
-                        try:
-                            if not measurement[key]['enabled']:
-                                continue
-                        except:
-                            pass
+            self._mqttc.loop_stop()
 
-                        # Skip an input if not configured
-                        if config['s0pcm']['include'] != None:
-                            if not key in config['s0pcm']['include']:
-                                logger.debug('MQTT Publish for input \'%d\' is disabled', key)
-                                continue
+            # Send an official offline message
+            self.PublishOffline()
 
-                        try:
-                            instancename = measurementlocal[key]['name']
-                        except:
-                            instancename = str(key)
+            self._mqttc.disconnect()
 
-                        for subkey in ['total', 'today', 'yesterday']:
+    def run(self):
+        try:
+            self.DoMQTT()
+        except:
+            logger.error('Fatal exception has occured', exc_info=True)
+        finally:
+            self._stopper.set()
 
-                            # Try to assign the previous value, if this fails, we set it "-1" then it should always be different
-                            try:
-                                value_previous = measurementprevious[key][subkey]
-                            except:
-                                value_previous = -1
+# ------------------------------------------------------------------------------------
+# Task to roll over the counters at the start of an hour, day, week and month in the
+# configured timezone. The 'dailystat' files and the history are also written here,
+# outside the processing of the telegrams.
+# ------------------------------------------------------------------------------------
+class TaskRollover(threading.Thread):
 
-                            try:
-                                if subkey in measurementlocal[key]:
+    def __init__(self, stopper):
+        super().__init__(name='Rollover', daemon=True)
+        self._stopper = stopper
+        self._timezone = None
+        self._calendar = None
+
+        # The periods of the counters per device and the start of the next hour
+        self._periods = {}
+        self._next = 0
+
+        self.Configure()
+
+    # --------------------------------------------------------------------------------
+    # Apply the timezone, it can be changed by a reload
+    # --------------------------------------------------------------------------------
+    def Configure(self):
+        if self._calendar != None and config['s0pcm']['timezone'] == self._timezone:
+            return False
+
+        self._timezone = config['s0pcm']['timezone']
+        self._calendar = rollover.Calendar(rollover.TimeZone(self._timezone))
+        self._next = 0
+        return True
+
+    # A replay checks the rollover with the time of every telegram
+    def Check(self, timestamp):
+        if timestamp >= self._next:
+            self.Rollover(timestamp)
+
+    def Rollover(self, now):
+        current = self._calendar.Periods(now)
+        self._next = self._calendar.Next(now)
+
+        with lock:
+            for device in config['devices']:
+                self.RolloverDevice(device['name'], device['dailystat'], current, now)
+
+    def RolloverDevice(self, name, dailystat, current, now):
+
+        previous = self._periods.get(name)
+        if previous == current:
+            return
+
+        # At start-up the periods are taken from the 'measurement.yaml' file
+        if previous == None:
+            previous = self._calendar.Stored(counterstore.Date(name), counterstore.Hour(name))
+
+        prefix = '' if name == None else '[' + name + '] '
+        changed = self._calendar.Changed(previous, current)
+        if len(changed) > 0:
+            logger.debug('%sRollover of the %s counters, day \'%s\' to \'%s\'', prefix, '/'.join(changed), str(previous.day), str(current.day))
+
+        snapshots = []
+        for snapshot in counterstore.Snapshot():
+            if snapshot.device != name:
+                continue
 
-                                    if config['mqtt']['split_topic'] == True:
-                                        # Check if the value not changed and publish on change is off
-                                        if measurementlocal[key][subkey] == value_previous and config['s0pcm']['publish_onchange'] == True:
-                                            continue
+            values = {}
+            historyname = ('' if name == None else name + '-') + str(snapshot.input)
+
+            if 'hour' in changed:
+                values['this_hour'] = 0
+                if historystore != None:
+                    try:
+                        historystore.SetHour(historyname, self._calendar.Local(previous.hour), snapshot.this_hour)
+                    except Exception as e:
+                        logger.error('%sHistory of input \'%d\' write failed. %s: \'%s\'', prefix, snapshot.input, type(e).__name__, str(e))
+
+            if 'day' in changed:
+                logger.debug('%sYesterday counter of input \'%d\' is \'%d\'', prefix, snapshot.input, snapshot.today)
+                values['yesterday'] = snapshot.today
+                values['today'] = 0
+
+                # Write the counters to a text file if required
+                if dailystat != None and snapshot.input in dailystat:
+                    if name == None:
+                        statname = configdirectory + 'daily-' + str(snapshot.input) + '.txt'
+                    else:
+                        statname = configdirectory + 'daily-' + name + '-' + str(snapshot.input) + '.txt'
+
+                    try:
+                        fstat = open(statname, 'a')
+                        fstat.write(str(previous.day) + ';' + str(snapshot.today) + '\n')
+                        fstat.close()
+                    except Exception as e:
+                        logger.error('Stats file \'%s\' write/create failed. %s: \'%s\'', statname, type(e).__name__, str(e))
+
+                if historystore != None:
+                    try:
+                        historystore.SetDay(historyname, previous.day, snapshot.today)
+                    except Exception as e:
+                        logger.error('%sHistory of input \'%d\' write failed. %s: \'%s\'', prefix, snapshot.input, type(e).__name__, str(e))
+
+            if 'week' in changed:
+                values['this_week'] = 0
+
+            if 'month' in changed:
+                values['last_month'] = snapshot.this_month
+                values['this_month'] = 0
+
+            counterstore.Update(name, snapshot.input, **values)
+            snapshots.append(counterstore.Get(name, snapshot.input))
+
+        # On a rollover we always write all inputs, then the new date and hour are also stored
+        counterstore.SetDate(name, current.day)
+        counterstore.SetHour(name, self._calendar.Local(current.hour).hour)
+        self._periods[name] = current
+        WriteMeasurement(name, snapshots)
+
+        # Publish the reset counters
+        pipeline.Put(sinks.Reading(now, name, tuple(snapshots), ()))
+
+    # --------------------------------------------------------------------------------
+    # Write the usage of the current hour to the history, e.g. on a stop
+    # --------------------------------------------------------------------------------
+    def Close(self):
+        if historystore == None:
+            return
+
+        with lock:
+            for snapshot in counterstore.Snapshot():
+                periods = self._periods.get(snapshot.device)
+                if periods == None:
+                    continue
 
-                                        logger.debug('MQTT Publish of topic \'%s\' and value \'%s\'',config['mqtt']['base_topic'] + '/' + instancename + '/' + subkey, str(measurementlocal[key][subkey]))
+                historyname = ('' if snapshot.device == None else snapshot.device + '-') + str(snapshot.input)
+                try:
+                    historystore.SetHour(historyname, self._calendar.Local(periods.hour), snapshot.this_hour, final=False)
+                except Exception as e:
+                    logger.error('History of \'%s\' write failed. %s: \'%s\'', historyname, type(e).__name__, str(e))
 
-                                        # Do a MQTT Publish
-                                        self._mqttc.publish(config['mqtt']['base_topic'] + '/' + instancename + '/' + subkey, measurementlocal[key][subkey], retain=config['mqtt']['retain'])
-                                    else:
-                                        jsondata[subkey] = measurementlocal[key][subkey]
+    def run(self):
+        while not self._stopper.is_set():
+            # Wait at most a minute, then a change of the clock (e.g. NTP) is also noticed
+            self._stopper.wait(min(max(self._next - time.time(), 0), 60))
+            if self._stopper.is_set():
+                break
 
-                            except Exception as e:
-                                logger.error('MQTT Publish Failed. Key=%s, SubKey=%s. %s: \'%s\'', str(key), subkey, type(e).__name__, str(e))
+            now = time.time()
+            if self.Configure() or now >= self._next or self._next - now > 3600:
+                try:
+                    self.Rollover(now)
+                except:
+                    logger.error('Fatal exception has occured', exc_info=True)
 
-                        # We should publish the json value
-                        if config['mqtt']['split_topic'] == False:
-                            try:
-                                logger.debug('MQTT Publish of topic \'%s\' and value \'%s\'',config['mqtt']['base_topic'] + '/' + instancename, json.dumps(jsondata))
+# ------------------------------------------------------------------------------------
+# Reload the 'configuration.yaml' file. The settings are changed in place, only if the
+# settings of a serialport or MQTT are changed, it is reopened or reconnected.
+# ------------------------------------------------------------------------------------
 
-                                # Do a MQTT Publish
-                                self._mqttc.publish(config['mqtt']['base_topic'] + '/' + instancename, json.dumps(jsondata), retain=config['mqtt']['retain'])
-                            except Exception as e:
-                                logger.error('MQTT Publish Failed. %s: \'%s\'', type(e).__name__, str(e))
+# The settings which require a reopen of the serialport or a new MQTT client
+SERIALSETTINGS = ['port', 'baudrate', 'parity', 'stopbits', 'bytesize', 'timeout', 'keepalive']
+MQTTSETTINGS = ['host', 'port', 'username', 'password', 'client_id', 'version', 'tls', 'tls_ca', 'tls_check_peer', 'base_topic', 'retain', 'lastwill']
 
-                # Lets make also a copy of this one, then we can compare if there is a delta
-                measurementprevious = copy.deepcopy(measurementlocal)
+# The sections which are only used during start-up
+STARTSECTIONS = ['journal', 'samples', 'history', 'metrics', 'api', 'capture', 'outbox', 'influxdb', 'csv', 'reload']
 
-                # Now sleep according to publish interval
-                if config['s0pcm']['publish_interval'] != None:
-                    time.sleep(config['s0pcm']['publish_interval'])
+def ReloadConfig():
 
-            self._mqttc.loop_stop()
+    try:
+        newconfig = LoadConfig()
+    except Exception as e:
+        logger.error('Reload of \'%s\' failed, the current configuration is kept. %s: \'%s\'', configname, type(e).__name__, str(e))
+        return
+
+    for section in STARTSECTIONS:
+        if newconfig[section] != config[section]:
+            logger.warning('Changes of the \'%s\' section require a restart', section)
+        newconfig[section] = config[section]
+
+    if newconfig['s0pcm']['runtime'] != config['s0pcm']['runtime']:
+        logger.warning('Changes of the \'runtime\' require a restart')
+        newconfig['s0pcm']['runtime'] = config['s0pcm']['runtime']
+
+    if newconfig['profile']['enabled'] != config['profile']['enabled']:
+        logger.warning('Enabling or disabling the \'profile\' requires a restart')
+        newconfig['profile']['enabled'] = config['profile']['enabled']
+
+    # Devices can't be added or removed, the reader threads are started once
+    olddevices = dict([(device['name'], device) for device in config['devices']])
+    newdevices = dict([(device['name'], device) for device in newconfig['devices']])
+    if newconfig['multidevice'] != config['multidevice'] or sorted(olddevices, key=str) != sorted(newdevices, key=str):
+        logger.warning('Adding or removing devices requires a restart')
+
+    changed = [section for section in newconfig if section != 'devices' and section != 'multidevice' and newconfig[section] != config[section]]
+    reopen = [name for name in olddevices if name in newdevices and [olddevices[name][key] for key in SERIALSETTINGS] != [newdevices[name][key] for key in SERIALSETTINGS]]
+    reconnect = [newconfig['mqtt'][key] for key in MQTTSETTINGS] != [config['mqtt'][key] for key in MQTTSETTINGS]
+
+    devicechanged = False
+    for name in olddevices:
+        if name in newdevices and newdevices[name] != olddevices[name]:
+            devicechanged = True
+
+    if len(changed) == 0 and not devicechanged:
+        logger.info('Reload of \'%s\', no changes', configname)
+        return
+
+    # The device settings are changed in place, the reader threads use the same dict
+    for name in olddevices:
+        if name in newdevices:
+            olddevices[name].clear()
+            olddevices[name].update(newdevices[name])
+    newconfig['devices'] = config['devices']
+    newconfig['multidevice'] = config['multidevice']
+
+    for section in newconfig:
+        config[section] = newconfig[section]
+
+    SetupLogging()
+
+    logger.info('Reload of \'%s\', changed: %s', configname, ', '.join(changed + (['devices'] if devicechanged else [])))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Config: %s', str(config))
+
+    for task in tasks:
+        task.Reconfigure()
+        if task.device['name'] in reopen:
+            task.Reopen()
+
+    if profile != None:
+        profile.Configure(config['profile']['interval'], config['profile']['top'], config['profile']['count'])
+
+    if reconnect:
+        t2.Reconnect()
+
+    # Publish everything again, e.g. a topic or the included inputs are changed
+    t2.Republish()
 
-            # Send an official offline message
-            if self._connected:
-                self._mqttc.publish(config['mqtt']['base_topic'] + '/status', config['mqtt']['offline'], retain=config['mqtt']['retain'])
+# ------------------------------------------------------------------------------------
+# Task to reload the configuration on a SIGHUP, or when the file is changed
+# ------------------------------------------------------------------------------------
+class TaskReload(threading.Thread):
 
-            self._mqttc.disconnect()
+    def __init__(self, stopper):
+        super().__init__(name='Reload', daemon=True)
+        self._stopper = stopper
+        self._requested = threading.Event()
+        self._modified = self._Modified()
+
+    def _Modified(self):
+        try:
+            stat = os.stat(configname)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    # Called by the SIGHUP handler
+    def Request(self, signum=None, frame=None):
+        self._requested.set()
 
     def run(self):
+        while not self._stopper.is_set():
+            self._requested.wait(config['reload']['interval'] if config['reload']['watch'] else None)
+
+            requested = self._requested.is_set()
+            self._requested.clear()
+
+            modified = self._Modified()
+            if modified != self._modified and config['reload']['watch']:
+                logger.info('\'%s\' is changed, reloading', configname)
+            elif requested:
+                logger.info('SIGHUP received, reloading \'%s\'', configname)
+            else:
+                continue
+
+            self._modified = modified
+
+            try:
+                ReloadConfig()
+            except:
+                logger.error('Fatal exception has occured', exc_info=True)
+
+# ------------------------------------------------------------------------------------
+# The '<base_topic>/profile/set' command: 'start [seconds]', 'memory [seconds]' (with
+# tracemalloc) or 'stop'
+# ------------------------------------------------------------------------------------
+def ProfileCommand(payload):
+
+    words = payload.decode('utf-8', errors='replace').strip().lower().split()
+    if len(words) == 0 or len(words) > 2 or not words[0] in ['start', 'memory', 'stop']:
+        logger.error('Invalid profile command \'%s\', supported are \'start [seconds]\', \'memory [seconds]\' and \'stop\'', payload)
+        return
+
+    if words[0] == 'stop':
+        logger.info('Profile stop requested')
+        profile.Stop()
+        return
+
+    duration = config['profile']['duration']
+    if len(words) == 2:
+        # float() also accepts 'nan' and 'inf', which would bypass the maximum duration
         try:
-            self.DoMQTT()
-        except:
-            logger.error('Fatal exception has occured', exc_info=True)
-        finally:
-            self._stopper.set()
+            duration = float(words[1])
+        except ValueError:
+            duration = None
+        if duration == None or not math.isfinite(duration):
+            logger.error('Invalid profile command \'%s\', the duration should be a number of seconds', payload)
+            return
+    duration = min(max(duration, 1), config['profile']['max_duration'])
+
+    if not profile.Start(duration, memory=words[0] == 'memory' or config['profile']['memory']):
+        logger.warning('A profile is already running')
+
+# ------------------------------------------------------------------------------------
+# The '<base_topic>/calibrate/set' command, a json object or a list of objects with the
+# 'input' (and 'device' with multiple devices) and 'set_total', 'adjust' (added to the
+# total) and/or 'reset_today'. All corrections are checked first, then applied at once.
+# ------------------------------------------------------------------------------------
+def CalibrateCommand(payload):
+
+    if not config['s0pcm']['calibrate']:
+        logger.warning('Calibrate command received, but \'calibrate\' is disabled')
+        return
+
+    commands = json.loads(payload)
+    if not isinstance(commands, list):
+        commands = [commands]
+
+    names = [device['name'] for device in config['devices']]
+    corrections = []
+
+    for command in commands:
+        if not isinstance(command, dict):
+            raise ValueError('A correction should be a json object')
+
+        unknown = [key for key in command if not key in ['device', 'input', 'set_total', 'adjust', 'reset_today']]
+        if len(unknown) > 0:
+            raise ValueError('Unknown field(s) ' + ', '.join(unknown))
+
+        name = command.get('device')
+        if name != None:
+            name = str(name)
+        if not name in names:
+            raise ValueError('Unknown device \'' + str(name) + '\'')
+
+        key = command.get('input')
+        if not isinstance(key, int) or isinstance(key, bool):
+            raise ValueError('Invalid input \'' + str(key) + '\'')
+
+        # Only the inputs of the device, e.g. input 4 of a S0PCM-2 would be created by the update
+        if not counterstore.Has(name, key):
+            raise ValueError('Unknown input \'' + str(key) + '\'' + ('' if name == None else ' of device \'' + name + '\'') + ', the inputs are known after the first telegram')
+
+        for field in ['set_total', 'adjust']:
+            if field in command and (not isinstance(command[field], int) or isinstance(command[field], bool)):
+                raise ValueError('Invalid ' + field + ' \'' + str(command[field]) + '\'')
+
+        if not 'set_total' in command and not 'adjust' in command and command.get('reset_today') != True:
+            raise ValueError('Nothing to correct for input \'' + str(key) + '\'')
+
+        corrections.append((name, key, command))
+
+    # The reader only waits for the short update and write, the serialport isn't touched
+    changed = {}
+    with lock:
+        for name, key, command in corrections:
+            current = counterstore.Get(name, key)
+            values = {}
+
+            if 'set_total' in command:
+                values['total'] = command['set_total']
+            if 'adjust' in command:
+                values['total'] = values.get('total', current.total) + command['adjust']
+            if command.get('reset_today') == True:
+                values['today'] = 0
+
+            counterstore.Update(name, key, **values)
+            logger.info('%sCalibrated input \'%d\', total \'%d\' to \'%d\', today \'%d\' to \'%d\'', '' if name == None else '[' + name + '] ', key,
+                        current.total, values.get('total', current.total), current.today, values.get('today', current.today))
+
+            if not name in changed:
+                changed[name] = {}
+            changed[name][key] = counterstore.Get(name, key)
+
+        for name in changed:
+            WriteMeasurement(name, list(changed[name].values()))
+
+        # A correction isn't repeated by the S0PCM, don't wait for the batched fsync
+        if measurementjournal != None:
+            measurementjournal.Sync()
+
+    # The corrected counters are published directly, also when held back by a publish policy
+    for name in changed:
+        pipeline.Put(sinks.Reading(time.time(), name, tuple(changed[name].values()), ()))
+    t2.Republish()
 
 # ------------------------------------------------------------------------------------
 # Main
@@ -638,26 +2060,217 @@ class TaskDoMQTT(threading.Thread):
 try:
     ReadConfig()
     ReadMeasurement()
+    metrics.startupseconds.Set(time.monotonic() - STARTTIME, 'loaded')
 except:
     logger.error('Fatal exception has occured', exc_info=True)
     # we need to quit, because we detected an error
+    StopLogging()
     exit(1)
 
+# The metrics are served by their own thread, also for the asyncio runtime
+metricsserver = None
+if config['metrics']['enabled']:
+    metrics.AddCounterStore(counterstore)
+    try:
+        metricsserver = metrics.MetricsServer(config['metrics']['host'], config['metrics']['port'])
+        metricsserver.Start()
+    except Exception as e:
+        logger.error('Metrics server on port \'%s\' failed. %s: \'%s\'', str(config['metrics']['port']), type(e).__name__, str(e))
+
+# The query API serves the counters from memory, also by its own thread
+apiserver = None
+if config['api']['enabled']:
+    try:
+        # The query API is only imported when it is enabled
+        import queryapi
+        apiserver = queryapi.ApiServer(queryapi.Query(counterstore, [device['name'] for device in config['devices']], config['api']['max_wait']),
+                                       config['api']['host'], config['api']['port'], config['api']['socket'])
+        apiserver.Start()
+    except Exception as e:
+        logger.error('Query API on port \'%s\' and socket \'%s\' failed. %s: \'%s\'', str(config['api']['port']), str(config['api']['socket']), type(e).__name__, str(e))
+
 trigger = threading.Event()
-stopper = threading.Event()
+stopper = watchdog.StopEvent()
+
+# A SIGTERM (e.g. 'docker stop') or SIGINT stops all tasks, then the shutdown at the end is done.
+# The process runtime installs its own handler, which also sets the stopper. The asyncio runtime
+# stops its loop, the stopper is set after it.
+def StopSignal(signum, frame):
+    stopper.set()
+
+for signum in [signal.SIGINT, signal.SIGTERM]:
+    signal.signal(signum, StopSignal)
+
+# The readings of all devices are handed to MQTT and the other sinks
+pipeline = sinks.Pipeline()
+if config['influxdb']['enabled']:
+    if config['influxdb']['host'] != None:
+        pipeline.Add(sinks.InfluxSink(config['influxdb']['measurement'], host=config['influxdb']['host'], port=config['influxdb']['port'], queue_size=config['influxdb']['queue_size'], batch_size=config['influxdb']['batch_size'], flush_interval=config['influxdb']['flush_interval'], drop=config['influxdb']['drop']))
+    else:
+        pipeline.Add(sinks.InfluxSink(config['influxdb']['measurement'], filename=config['influxdb']['file'], queue_size=config['influxdb']['queue_size'], batch_size=config['influxdb']['batch_size'], flush_interval=config['influxdb']['flush_interval'], drop=config['influxdb']['drop']))
+if config['csv']['enabled']:
+    pipeline.Add(sinks.CsvSink(config['csv']['file'], config['csv']['delimiter'], queue_size=config['csv']['queue_size'], batch_size=config['csv']['batch_size'], flush_interval=config['csv']['flush_interval'], drop=config['csv']['drop']))
 
-# Start our SerialPort thread
-t1 = TaskReadSerial(trigger, stopper)
-t1.start()
+try:
+    pipeline.Start()
+except Exception as e:
+    logger.error('Starting the sinks failed. %s: \'%s\'', type(e).__name__, str(e))
+    StopLogging()
+    exit(1)
 
-# Start our MQTT thread
+tasks = []
+if args.command == 'replay':
+    # Every capture is replayed as the device it was captured from
+    try:
+        import capture
+        for filename in args.filenames:
+            name, records = capture.ReadCapture(filename)
+            records.close()
+            for device in config['devices']:
+                if device['name'] == name:
+                    tasks.append(TaskReadSerial(trigger, stopper, device, replay=filename))
+                    break
+            else:
+                raise ValueError('Capture \'' + filename + '\' is of device \'' + str(name) + '\', which is not configured')
+    except Exception as e:
+        logger.error('Replay failed. %s: \'%s\'', type(e).__name__, str(e))
+        print('ERROR: ' + str(e))
+        StopLogging()
+        exit(1)
+else:
+    for device in config['devices']:
+        tasks.append(TaskReadSerial(trigger, stopper, device))
+
+# The MQTT task is shared by all devices
 t2 = TaskDoMQTT(trigger, stopper)
-t2.start()
+pipeline.Add(t2)
+
+# A profile is started by a SIGUSR1 or a MQTT command, the summary is published retained
+profile = None
+if config['profile']['enabled'] and args.command != 'replay':
+    import profiler
+    profile = profiler.Profiler(configdirectory, config['profile']['interval'], config['profile']['top'], config['profile']['count'],
+                                onreport=lambda summary: t2.Post('profile', json.dumps(summary), retain=True))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profile.Toggle(config['profile']['duration'], config['profile']['memory']))
+    t2.AddCommand('profile/set', ProfileCommand)
+
+# Corrections of the counters, without a restart
+if args.command != 'replay':
+    t2.AddCommand('calibrate/set', CalibrateCommand)
+
+# The counters are rolled over by a timer, a replay does it with the time of the capture. A
+# rollover which was missed while we were stopped is done before the first telegram.
+t4 = TaskRollover(stopper)
+if args.command != 'replay':
+    try:
+        t4.Rollover(time.time())
+    except:
+        logger.error('Fatal exception has occured', exc_info=True)
+    t4.start()
+
+# Reload the configuration on a SIGHUP or a change of the file
+if args.command != 'replay':
+    t3 = TaskReload(stopper)
+    signal.signal(signal.SIGHUP, t3.Request)
+    t3.start()
+
+# The modules of a runtime (asyncio, subprocess) are only imported when it is used
+if config['s0pcm']['runtime'] == 'asyncio':
+    # Everything runs on a single asyncio loop, the tasks are not started as thread
+    try:
+        import aioengine
+        aioengine.AsyncEngine(tasks, t2, config).Run()
+    except:
+        logger.error('Fatal exception has occured', exc_info=True)
+
+    # The loop removed its signal handlers, a second SIGTERM shouldn't kill the shutdown
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, StopSignal)
+
+    # Stop the Reload and Rollover threads before the shutdown
+    stopper.set()
+    trigger.set()
+elif config['s0pcm']['runtime'] == 'process':
+    # Every serialport is read by a worker process, the telegrams are collected by us
+    t2.start()
+
+    try:
+        import supervisor
+        supervisor.Supervisor(tasks, stopper, config).Run()
+    except:
+        logger.error('Fatal exception has occured', exc_info=True)
+
+    stopper.set()
+    trigger.set()
+    t2.join()
+else:
+    # Start a SerialPort thread per device
+    for task in tasks:
+        task.start()
+
+    # Start our MQTT thread, a replay can be done without MQTT
+    if args.command != 'replay' or not args.no_mqtt:
+        t2.start()
+
+    # Now wait until all tasks are finished
+    for task in tasks:
+        task.join()
+
+    # All replays are finished, the last values are published before MQTT stops
+    stopper.set()
+    trigger.set()
+
+    if t2.is_alive():
+        t2.join()
+
+# A failing step doesn't skip the rest of the shutdown, e.g. the queued readings of the sinks
+try:
+    for task in tasks:
+        task.Close()
+
+    # The not acknowledged publishes stay in the outbox, they are send after a restart
+    t2.Close()
+
+    # Write the usage of the current hour
+    t4.Close()
+except:
+    logger.error('Fatal exception has occured', exc_info=True)
+
+# Compact the journal, then 'measurement.yaml' is up-to-date when we are stopped. This is
+# done before the sinks are flushed, which can take a while (e.g. 'docker stop' kills us after
+# 10 seconds). The counters don't change anymore, the readers and MQTT are stopped.
+if measurementjournal != None:
+    try:
+        measurementjournal.Report(force=True)
+        measurementjournal.Compact(MeasurementContent())
+        measurementjournal.Close()
+    except:
+        logger.error('Fatal exception has occured', exc_info=True)
+
+# The state file of the final 'measurement.yaml', then the next start-up doesn't parse it
+WriteState()
+
+# Write the readings which are still queued for InfluxDB and CSV
+try:
+    pipeline.Stop()
+except:
+    logger.error('Fatal exception has occured', exc_info=True)
+
+# Write the usage of the current hour
+if historystore != None:
+    try:
+        historystore.Close()
+    except:
+        logger.error('Fatal exception has occured', exc_info=True)
 
-# Now wait until both tasks are finished
-t1.join()
-t2.join()
+if metricsserver != None:
+    metricsserver.Stop()
+
+if apiserver != None:
+    apiserver.Stop()
 
 logger.debug('Stop: s0pcm-reader')
 
+StopLogging()
+
 # End
@@ -0,0 +1,150 @@
+
+import os
+import mmap
+import struct
+import time
+import datetime
+import argparse
+
+"""
+Sample ring buffer
+------------------
+Every telegram contains the number of pulses in the last interval per input. These samples are stored
+in a fixed-size ring buffer file per device, which is memory mapped. The memory and disk usage is fixed
+by the capacity (number of samples), when the buffer is full the oldest sample is overwritten.
+
+File layout (little endian):
+Header (64 bytes):
+  magic     8s  b'S0PCMRB1'
+  inputs    I   number of inputs per sample (always 5, a S0PCM-2 only uses the first 2)
+  capacity  I   number of samples
+  head      Q   index of the next sample to write
+  count     Q   number of valid samples (max capacity)
+  sequence  Q   incremented before and after every write (odd means a write is in progress)
+Sample (8 + 4 * inputs bytes):
+  timestamp q   milliseconds since epoch (UTC)
+  pulses    I   pulses in the last interval, per input
+
+Other processes can read the file without locking (see ReadSamples), e.g.:
+python samples.py /config/samples.ring -n 10
+"""
+
+MAGIC = b'S0PCMRB1'
+HEADER = struct.Struct('<8sIIQQQ')
+HEADERSIZE = 64
+INPUTS = 5
+
+class SampleRing():
+
+    def __init__(self, filename, capacity, inputs=INPUTS):
+        self._filename = filename
+        self._inputs = inputs
+        self._sample = struct.Struct('<q' + str(inputs) + 'I')
+        size = HEADERSIZE + capacity * self._sample.size
+
+        # Reuse an existing file, if it has the same layout. Otherwise we start with a new one.
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, HEADER.size, 0)
+            if len(header) == HEADER.size:
+                magic, fileinputs, filecapacity, head, count, sequence = HEADER.unpack(header)
+            else:
+                magic = None
+
+            if magic != MAGIC or fileinputs != inputs or filecapacity != capacity or os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HEADER.pack(MAGIC, inputs, capacity, 0, 0, 0), 0)
+                head = 0
+                count = 0
+                sequence = 0
+
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self._capacity = capacity
+        self._head = head
+        self._count = count
+        self._sequence = sequence
+
+        # A write was in progress (e.g. power failure), that sample is not trusted
+        if self._sequence % 2 == 1:
+            self._sequence += 1
+
+    @property
+    def count(self):
+        return self._count
+
+    # --------------------------------------------------------------------------------
+    # Store a sample, the pulses are padded with 0 up to the number of inputs
+    # --------------------------------------------------------------------------------
+    def Append(self, timestamp, pulses):
+
+        values = list(pulses[:self._inputs]) + [0] * (self._inputs - len(pulses))
+
+        self._sequence += 1
+        HEADER.pack_into(self._mmap, 0, MAGIC, self._inputs, self._capacity, self._head, self._count, self._sequence)
+
+        self._sample.pack_into(self._mmap, HEADERSIZE + self._head * self._sample.size, int(timestamp * 1000), *values)
+        self._head = (self._head + 1) % self._capacity
+        self._count = min(self._count + 1, self._capacity)
+
+        self._sequence += 1
+        HEADER.pack_into(self._mmap, 0, MAGIC, self._inputs, self._capacity, self._head, self._count, self._sequence)
+
+    def Flush(self):
+        self._mmap.flush()
+
+    def Close(self):
+        self._mmap.flush()
+        self._mmap.close()
+
+# ------------------------------------------------------------------------------------
+# Read the samples of a ring buffer file, oldest first. Returns a list of tuples
+# (timestamp in seconds, (pulses, ...)). Can be used while the reader is writing.
+# ------------------------------------------------------------------------------------
+def ReadSamples(filename, last=None):
+
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        for attempt in range(100):
+            magic, inputs, capacity, head, count, sequence = HEADER.unpack_from(data, 0)
+            if magic != MAGIC:
+                raise ValueError('\'' + filename + '\' is not a sample ring buffer file')
+
+            sample = struct.Struct('<q' + str(inputs) + 'I')
+
+            if last != None:
+                count = min(count, last)
+
+            samples = []
+            for index in range(head - count, head):
+                values = sample.unpack_from(data, HEADERSIZE + (index % capacity) * sample.size)
+                samples.append((values[0] / 1000, values[1:]))
+
+            # Retry if the writer has changed the buffer while we were reading
+            if sequence % 2 == 0 and HEADER.unpack_from(data, 0)[5] == sequence:
+                return samples
+
+            time.sleep(0.001)
+    finally:
+        data.close()
+
+    raise ValueError('\'' + filename + '\' is changing too fast, cannot read a consistent set of samples')
+
+def main():
+    parser = argparse.ArgumentParser(prog='samples', description='Print the samples of a S0PCM-Reader ring buffer file')
+    parser.add_argument('filename', help='The ring buffer file, e.g. /config/samples.ring')
+    parser.add_argument('-n', '--number', help='Only print the last number of samples', type=int, default=None)
+    args = parser.parse_args()
+
+    for timestamp, pulses in ReadSamples(args.filename, args.number):
+        print(datetime.datetime.fromtimestamp(timestamp).isoformat(sep=' ', timespec='milliseconds') + ';' + ';'.join([str(value) for value in pulses]))
+
+if __name__ == '__main__':
+    main()
+
+# End
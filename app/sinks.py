@@ -0,0 +1,270 @@
+
+import io
+import time
+import socket
+import datetime
+import threading
+import collections
+import logging
+
+import metrics
+
+"""
+Output sinks
+------------
+Every processed telegram is handed as a Reading to the pipeline, which passes it to every sink:
+- MQTT: the publisher (TaskDoMQTT) is woken up. Its queue is the counter store, which only keeps the
+  latest value of every input, so a slow broker never blocks the reader.
+- InfluxDB: the readings are written in the line protocol to a file or send with UDP.
+- CSV: the readings are appended to a CSV file.
+
+The InfluxDB and CSV sinks have their own bounded queue and worker thread. The worker writes the
+readings in batches (at most 'batch_size' readings, or after 'flush_interval' seconds). When the queue
+is full the oldest reading is dropped ('drop: oldest') or the new reading is dropped ('drop: newest'),
+the reader never waits for a sink.
+"""
+
+logger = logging.getLogger('s0pcm.sinks')
+
+# The counters of an input which are written
+COUNTERS = ('total', 'today', 'yesterday', 'this_hour', 'this_week', 'this_month', 'last_month')
+
+# A processed telegram: the receive time, the device and the snapshots and pulses (last interval) of its inputs
+Reading = collections.namedtuple('Reading', ['timestamp', 'device', 'snapshots', 'pulses'])
+
+class QueueSink():
+
+    def __init__(self, name, queue_size=1000, batch_size=100, flush_interval=10, drop='oldest'):
+        self.name = name
+        self._queue_size = max(queue_size, 1)
+        self._batch_size = max(batch_size, 1)
+        self._flush_interval = flush_interval
+        self._drop = drop
+
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._Run, name='sink-' + name, daemon=True)
+
+    # --------------------------------------------------------------------------------
+    # Add a reading to the queue, never blocks
+    # --------------------------------------------------------------------------------
+    def Put(self, reading):
+        with self._condition:
+            if len(self._queue) >= self._queue_size:
+                metrics.sinkdropped.Inc(self.name)
+                if self._drop == 'newest':
+                    return
+                self._queue.popleft()
+
+            self._queue.append(reading)
+            metrics.sinkqueue.Set(len(self._queue), self.name)
+
+            if len(self._queue) >= self._batch_size:
+                self._condition.notify()
+
+    def Start(self):
+        self.Open()
+        self._thread.start()
+
+    # Write the readings which are still queued and stop the worker
+    def Stop(self, timeout=10):
+        self.RequestStop()
+        self._thread.join(timeout)
+        self.Close()
+
+    # The worker writes the queued readings and stops, without waiting for it
+    def RequestStop(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+
+    def _Run(self):
+
+        while True:
+            with self._condition:
+                # Wait for a full batch, the flush interval or a stop
+                deadline = time.monotonic() + self._flush_interval
+                while not self._stop and len(self._queue) < self._batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                batch = []
+                while len(self._queue) > 0 and len(batch) < self._batch_size:
+                    batch.append(self._queue.popleft())
+                metrics.sinkqueue.Set(len(self._queue), self.name)
+                stop = self._stop and len(self._queue) == 0
+
+            if len(batch) > 0:
+                try:
+                    self.Write(batch)
+                    metrics.sinkwritten.Inc(self.name, amount=len(batch))
+                except Exception as e:
+                    metrics.sinkerrors.Inc(self.name)
+                    logger.error('Sink \'%s\' write of %d reading(s) failed. %s: \'%s\'', self.name, len(batch), type(e).__name__, str(e))
+
+            if stop:
+                return
+
+    # --------------------------------------------------------------------------------
+    # Implemented by a sink, called by the worker thread
+    # --------------------------------------------------------------------------------
+    def Open(self):
+        pass
+
+    def Write(self, batch):
+        raise NotImplementedError
+
+    def Close(self):
+        pass
+
+# ------------------------------------------------------------------------------------
+# InfluxDB line protocol, e.g.:
+# s0pcm,device=water,input=1,name=kitchen pulses=1i,total=770123i,today=15i,yesterday=77i,this_hour=3i,... 1615734000000000000
+# ------------------------------------------------------------------------------------
+def EscapeTag(value):
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+class InfluxSink(QueueSink):
+
+    # The maximum size of a UDP datagram, a batch is split over multiple datagrams
+    DATAGRAM = 1400
+
+    def __init__(self, measurement='s0pcm', filename=None, host=None, port=8089, **settings):
+        super().__init__('influxdb', **settings)
+        self._measurement = EscapeTag(measurement)
+        self._filename = filename
+        self._address = None if host == None else (host, port)
+        self._f = None
+        self._socket = None
+
+    def Open(self):
+        if self._address != None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self._f = open(self._filename, 'a')
+
+    def Lines(self, reading):
+        lines = []
+        timestamp = str(int(reading.timestamp * 1000000000))
+        tags = self._measurement
+        if reading.device != None:
+            tags += ',device=' + EscapeTag(reading.device)
+
+        for snapshot in reading.snapshots:
+            if snapshot.enabled == False:
+                continue
+            line = tags + ',input=' + str(snapshot.input)
+            if snapshot.name != None:
+                line += ',name=' + EscapeTag(snapshot.name)
+            pulses = reading.pulses[snapshot.input - 1] if snapshot.input <= len(reading.pulses) else 0
+            line += ' pulses=' + str(pulses) + 'i,' + ','.join([field + '=' + str(getattr(snapshot, field)) + 'i' for field in COUNTERS])
+            for name, value in snapshot.rates:
+                line += ',' + name + '=' + repr(float(value))
+            lines.append(line + ' ' + timestamp + '\n')
+
+        return lines
+
+    def Write(self, batch):
+        lines = []
+        for reading in batch:
+            lines += self.Lines(reading)
+
+        if self._socket != None:
+            datagram = ''
+            for line in lines:
+                if len(datagram) > 0 and len(datagram) + len(line) > self.DATAGRAM:
+                    self._socket.sendto(datagram.encode('utf-8'), self._address)
+                    datagram = ''
+                datagram += line
+            if len(datagram) > 0:
+                self._socket.sendto(datagram.encode('utf-8'), self._address)
+        else:
+            self._f.write(''.join(lines))
+            self._f.flush()
+
+    def Close(self):
+        if self._f != None:
+            self._f.close()
+            self._f = None
+        if self._socket != None:
+            self._socket.close()
+            self._socket = None
+
+# ------------------------------------------------------------------------------------
+# CSV file, with a header when the file is created. The csv module is only imported
+# when the sink is used.
+# ------------------------------------------------------------------------------------
+class CsvSink(QueueSink):
+
+    HEADER = ['timestamp', 'device', 'input', 'name', 'pulses'] + list(COUNTERS)
+
+    def __init__(self, filename, delimiter=',', **settings):
+        super().__init__('csv', **settings)
+        self._filename = filename
+        self._delimiter = delimiter
+        self._f = None
+
+    def Open(self):
+        import csv
+
+        self._f = open(self._filename, 'a', newline='')
+        if self._f.tell() == 0:
+            csv.writer(self._f, delimiter=self._delimiter).writerow(self.HEADER)
+            self._f.flush()
+
+    def Write(self, batch):
+        import csv
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=self._delimiter)
+
+        for reading in batch:
+            timestamp = datetime.datetime.fromtimestamp(reading.timestamp).isoformat(sep=' ', timespec='seconds')
+            for snapshot in reading.snapshots:
+                if snapshot.enabled == False:
+                    continue
+                pulses = reading.pulses[snapshot.input - 1] if snapshot.input <= len(reading.pulses) else 0
+                writer.writerow([timestamp, '' if reading.device == None else reading.device, snapshot.input, '' if snapshot.name == None else snapshot.name, pulses] + [getattr(snapshot, field) for field in COUNTERS])
+
+        self._f.write(buffer.getvalue())
+        self._f.flush()
+
+    def Close(self):
+        if self._f != None:
+            self._f.close()
+            self._f = None
+
+# ------------------------------------------------------------------------------------
+# Hands every reading to all sinks
+# ------------------------------------------------------------------------------------
+class Pipeline():
+
+    def __init__(self):
+        self._sinks = []
+
+    def Add(self, sink):
+        self._sinks.append(sink)
+
+    def Put(self, reading):
+        for sink in self._sinks:
+            sink.Put(reading)
+
+    def Start(self):
+        for sink in self._sinks:
+            if isinstance(sink, QueueSink):
+                sink.Start()
+
+    # All sinks write their queued readings at the same time, together within the timeout
+    def Stop(self, timeout=10):
+        sinks = [sink for sink in self._sinks if isinstance(sink, QueueSink)]
+        for sink in sinks:
+            sink.RequestStop()
+
+        deadline = time.monotonic() + timeout
+        for sink in sinks:
+            sink.Stop(max(deadline - time.monotonic(), 0))
+
+# End
@@ -0,0 +1,173 @@
+
+import os
+import sys
+import zlib
+import struct
+import datetime
+import argparse
+
+"""
+State file
+----------
+The counters of all devices in a compact binary file 'measurement.state', written next to every write
+of 'measurement.yaml' (the compaction of the journal and at shutdown). At start-up the counters are
+read from this file instead of parsing the YAML file, the journal is replayed on top of it as usual.
+
+'measurement.yaml' stays the human-editable file: the state file contains the modification time and
+size of the 'measurement.yaml' it was written with, and is only used when they still match. After an
+edit of 'measurement.yaml' (or a failed or partial write of the state file) the YAML file is read.
+
+File layout (little endian):
+Header (32 bytes):
+  magic     8s  b'S0PCMST1'
+  mtime     q   modification time of 'measurement.yaml' in nanoseconds
+  size      q   size of 'measurement.yaml'
+  length    I   length of the body
+  crc       I   crc32 of the body
+Body, per device:
+  name      H + utf-8   length + name of the device, 0xFFFF for the single S0PCM (no 'devices')
+  date      i   ordinal of the date, 0 if none
+  hour      b   hour of 'this_hour', -1 if none
+  inputs    H   number of inputs, followed per input by:
+    input   H   the input number
+    enabled b   -1 none, 0 no, 1 yes
+    name    H + utf-8   length + name of the input, 0xFFFF if none
+    counters 8q  pulsecount, total, today, yesterday, this_hour, this_week, this_month, last_month
+
+The state file can be printed (e.g. to check it) with: python statefile.py /config/measurement.state
+"""
+
+MAGIC = b'S0PCMST1'
+HEADER = struct.Struct('<8sqqII')
+DEVICE = struct.Struct('<ibH')
+INPUT = struct.Struct('<Hb')
+LENGTH = struct.Struct('<H')
+
+FIELDS = ('pulsecount', 'total', 'today', 'yesterday', 'this_hour', 'this_week', 'this_month', 'last_month')
+COUNTERS = struct.Struct('<' + str(len(FIELDS)) + 'q')
+
+NONE = 0xFFFF
+
+def PackString(value):
+    if value == None:
+        return LENGTH.pack(NONE)
+    data = str(value).encode('utf-8')
+    return LENGTH.pack(len(data)) + data
+
+def UnpackString(data, offset):
+    length = LENGTH.unpack_from(data, offset)[0]
+    offset += LENGTH.size
+    if length == NONE:
+        return None, offset
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+# ------------------------------------------------------------------------------------
+# The modification time and size of 'measurement.yaml', None if it doesn't exist
+# ------------------------------------------------------------------------------------
+def Source(measurementname):
+    try:
+        stat = os.stat(measurementname)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+# ------------------------------------------------------------------------------------
+# Write the state file atomically. The measurement is a dict per device (the single
+# S0PCM as None), in the format of the 'measurement.yaml' file of a device.
+# ------------------------------------------------------------------------------------
+def Write(filename, measurement, source):
+
+    body = b''
+    for device, content in measurement.items():
+        date = content.get('date')
+        hour = content.get('hour')
+        inputs = [key for key in content if isinstance(key, int)]
+
+        body += PackString(device)
+        body += DEVICE.pack(date.toordinal() if isinstance(date, datetime.date) else 0, hour if hour != None else -1, len(inputs))
+
+        for key in inputs:
+            enabled = content[key].get('enabled')
+            body += INPUT.pack(key, -1 if enabled == None else int(bool(enabled)))
+            body += PackString(content[key].get('name'))
+            body += COUNTERS.pack(*[int(content[key].get(field, 0)) for field in FIELDS])
+
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, source[0], source[1], len(body), zlib.crc32(body)) + body)
+    os.replace(tmpname, filename)
+
+# ------------------------------------------------------------------------------------
+# Read the state file, returns the measurement per device. None if the file doesn't
+# exist, is invalid or doesn't belong to the current 'measurement.yaml'.
+# ------------------------------------------------------------------------------------
+def Read(filename, source=None, check=True):
+
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+
+    if len(data) < HEADER.size:
+        return None
+
+    magic, mtime, size, length, crc = HEADER.unpack_from(data, 0)
+    body = data[HEADER.size:]
+    if magic != MAGIC or len(body) != length or zlib.crc32(body) != crc:
+        return None
+
+    if check and source != (mtime, size):
+        return None
+
+    measurement = {}
+    offset = 0
+    try:
+        while offset < len(body):
+            device, offset = UnpackString(body, offset)
+            date, hour, count = DEVICE.unpack_from(body, offset)
+            offset += DEVICE.size
+
+            content = {}
+            if date > 0:
+                content['date'] = datetime.date.fromordinal(date)
+            if hour >= 0:
+                content['hour'] = hour
+
+            for index in range(count):
+                key, enabled = INPUT.unpack_from(body, offset)
+                offset += INPUT.size
+                name, offset = UnpackString(body, offset)
+
+                content[key] = {}
+                if name != None: content[key]['name'] = name
+                if enabled >= 0: content[key]['enabled'] = enabled == 1
+                for field, value in zip(FIELDS, COUNTERS.unpack_from(body, offset)):
+                    content[key][field] = value
+                offset += COUNTERS.size
+
+            measurement[device] = content
+    except (struct.error, ValueError, UnicodeDecodeError):
+        return None
+
+    return measurement
+
+def main():
+    parser = argparse.ArgumentParser(prog='statefile', description='Print a S0PCM-Reader state file')
+    parser.add_argument('filename', help='The state file, e.g. /config/measurement.state')
+    args = parser.parse_args()
+
+    measurement = Read(args.filename, check=False)
+    if measurement == None:
+        print('ERROR: \'' + args.filename + '\' is not a valid state file')
+        return 1
+
+    for device, content in measurement.items():
+        for key in content:
+            if isinstance(key, int):
+                print(('-' if device == None else device) + ';' + str(key) + ';' + ';'.join([field + '=' + str(content[key][field]) for field in FIELDS]))
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# End
@@ -0,0 +1,448 @@
+
+import os
+import sys
+import mmap
+import json
+import time
+import select
+import signal
+import struct
+import tempfile
+import threading
+import subprocess
+import logging
+import argparse
+
+import serial
+
+import telegram
+import watchdog
+import netserial
+import metrics
+
+"""
+Process supervisor
+------------------
+With 'runtime: process' every serialport is read by its own worker process, so a wedged port or a
+crash only takes down that device, and parsing the telegrams doesn't compete for the GIL of the
+publisher. The worker is this file, started by the supervisor with the settings of its device.
+
+A worker parses the telegrams and writes them into a small ring in its own slot of a shared counter
+block, a memory mapped file in '/dev/shm'. The supervisor (the S0PCM-Reader process itself) polls the
+slots every 'poll_interval' seconds and hands the new telegrams to the normal processing (counters,
+journal, MQTT, etc). No pickling or IPC is done per telegram, only the log messages of a worker are
+passed over a pipe (its stderr). The ring holds the last RING telegrams, so with the default
+'poll_interval' of 0.1 seconds more then 320 telegrams per second (a real S0PCM sends one every 10
+seconds) are needed before a telegram is overwritten. An overwritten telegram is logged, its pulses of
+the interval are lost (samples, rates, sinks), the totals are in every telegram so the counters are not.
+
+A worker which exits is restarted with an exponential backoff, starting at 'connect_retry' seconds.
+The backoff is reset when the worker has written a telegram. A worker is also restarted when the
+settings of its device are changed by a reload. A worker stops when the supervisor is gone.
+
+Slot layout (little endian, SLOTSIZE bytes per device), a header followed by a ring of RING telegrams:
+  sequence      Q   incremented before and after every write (odd means a write is in progress)
+  telegrams     Q   number of telegrams written, telegram n is in entry (n - 1) % RING
+  decodeerrors  Q   number of lines which could not be parsed
+  invalid       Q   number of empty packets and telegrams of another ID
+  reconnects    Q   number of failed opens and read errors of the serialport
+  stalls        Q   number of times no telegram was received in time
+
+Telegram entry:
+  timestamp     d   receive time of the telegram (seconds since epoch)
+  interval      q   the 'I' field of the telegram
+  size          q   number of inputs (2 or 5)
+  id            16s the ID of the S0PCM
+  pulses        5q  pulses in the last interval, per input
+  totals        5q  pulses since the start-up of the S0PCM, per input
+"""
+
+logger = logging.getLogger('s0pcm.supervisor')
+
+HEADER = struct.Struct('<QQQQQQ')
+ENTRY = struct.Struct('<dqq16s5q5q')
+RING = 32
+SLOTSIZE = 4096
+INPUTS = 5
+
+# The fields of the header which are counted by the worker
+COUNTS = {'decodeerrors': 2, 'invalid': 3, 'reconnects': 4, 'stalls': 5}
+
+# The device settings which are used by a worker, a change restarts the worker
+SETTINGS = ['name', 'id', 'port', 'baudrate', 'parity', 'stopbits', 'bytesize', 'timeout', 'stall_factor', 'connect_retry', 'keepalive']
+
+class CounterBlock():
+
+    def __init__(self, filename, count=None):
+        self.filename = filename
+
+        # The supervisor creates the block, a worker opens it
+        if count != None:
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.ftruncate(fd, max(count, 1) * SLOTSIZE)
+        else:
+            fd = os.open(filename, os.O_RDWR)
+
+        try:
+            self._mmap = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+    # --------------------------------------------------------------------------------
+    # Change the header of a slot and optionally write a telegram entry, only done by
+    # the worker of the slot. The even sequence is written last, after the data.
+    # --------------------------------------------------------------------------------
+    def _Update(self, index, field, entry=None):
+        offset = index * SLOTSIZE
+        values = list(HEADER.unpack_from(self._mmap, offset))
+
+        values[0] += 1
+        struct.pack_into('<Q', self._mmap, offset, values[0])
+
+        values[field] += 1
+        if entry != None:
+            ENTRY.pack_into(self._mmap, offset + HEADER.size + ((values[1] - 1) % RING) * ENTRY.size, *entry)
+        HEADER.pack_into(self._mmap, offset, *values)
+
+        values[0] += 1
+        struct.pack_into('<Q', self._mmap, offset, values[0])
+
+    def Write(self, index, timestamp, packet):
+        self._Update(index, 1, [timestamp, packet.interval, packet.size, packet.id.encode('ascii')] +
+                     list(packet.pulses[:INPUTS]) + [0] * (INPUTS - packet.size) + list(packet.totals[:INPUTS]) + [0] * (INPUTS - packet.size))
+
+    def Count(self, index, field):
+        self._Update(index, COUNTS[field])
+
+    # --------------------------------------------------------------------------------
+    # Read a consistent copy of a slot, retried while the worker is writing it. Returns
+    # the header and the telegram entries after telegram 'after' (at most RING).
+    # --------------------------------------------------------------------------------
+    def Read(self, index, after=0):
+        offset = index * SLOTSIZE
+        for attempt in range(100):
+            data = self._mmap[offset:offset + SLOTSIZE]
+            header = HEADER.unpack_from(data, 0)
+            if header[0] % 2 == 0 and struct.unpack_from('<Q', self._mmap, offset)[0] == header[0]:
+                entries = [ENTRY.unpack_from(data, HEADER.size + ((number - 1) % RING) * ENTRY.size) for number in range(max(after, header[1] - RING) + 1, header[1] + 1)]
+                return header, entries
+            time.sleep(0.0001)
+        return None
+
+    # Start a slot from zero, e.g. for a new worker
+    def Clear(self, index):
+        self._mmap[index * SLOTSIZE:(index + 1) * SLOTSIZE] = bytes(SLOTSIZE)
+
+    def Close(self):
+        self._mmap.close()
+
+    def Remove(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+# ------------------------------------------------------------------------------------
+# The state of a worker, as seen by the supervisor
+# ------------------------------------------------------------------------------------
+class Worker():
+
+    def __init__(self, index, reader, connect_retry):
+        self.index = index
+        self.reader = reader
+        self.process = None
+        self.settings = None
+        self.restart = 0
+        self.backoff = watchdog.Backoff(connect_retry)
+
+        # The last values of the slot which are handled
+        self.telegrams = 0
+        self.counts = dict([(field, 0) for field in COUNTS])
+
+class Supervisor():
+
+    def __init__(self, readers, stopper, config):
+        self._readers = readers
+        self._stopper = stopper
+        self._config = config
+        self._block = None
+        self._workers = []
+
+    def Stop(self, signum=None, frame=None):
+        logger.debug('Stop requested')
+        self._stopper.set()
+
+    def Run(self):
+
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(signum, self.Stop)
+
+        # Shared memory, without /dev/shm (e.g. not Linux) a normal temporary file is used
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self._block = CounterBlock(os.path.join(directory, 's0pcm-' + str(os.getpid()) + '.block'), len(self._readers))
+
+        try:
+            for index, reader in enumerate(self._readers):
+                worker = Worker(index, reader, reader.device['connect_retry'])
+                reader.SetWakeup(lambda: None)
+                self._workers.append(worker)
+                self._Start(worker)
+
+            while not self._stopper.is_set():
+                for worker in self._workers:
+                    self._Check(worker)
+                self._stopper.wait(self._config['supervisor']['poll_interval'])
+
+            # The last telegrams, e.g. written just before the stop
+            for worker in self._workers:
+                self._Collect(worker)
+        finally:
+            for worker in self._workers:
+                self._Terminate(worker)
+            self._block.Close()
+            self._block.Remove()
+
+    # --------------------------------------------------------------------------------
+    # Start the worker process of a device, its stderr are the log messages
+    # --------------------------------------------------------------------------------
+    def _Start(self, worker):
+
+        device = worker.reader.device
+        worker.settings = dict([(key, device[key]) for key in SETTINGS])
+
+        self._block.Clear(worker.index)
+        worker.telegrams = 0
+        worker.counts = dict([(field, 0) for field in COUNTS])
+
+        logger.debug('%sStarting worker of serialport \'%s\'', worker.reader.prefix, device['port'])
+
+        worker.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), self._block.filename, str(worker.index), json.dumps(worker.settings),
+                                           logging.getLevelName(logging.getLogger('s0pcm').getEffectiveLevel())],
+                                          stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+        threading.Thread(target=self._Log, args=(worker.reader.prefix, worker.process.stderr), name='Log-' + str(worker.process.pid), daemon=True).start()
+
+    def _Terminate(self, worker):
+
+        if worker.process == None or worker.process.poll() != None:
+            return
+
+        worker.process.terminate()
+        try:
+            worker.process.wait(5)
+        except subprocess.TimeoutExpired:
+            worker.process.kill()
+            worker.process.wait()
+
+    # --------------------------------------------------------------------------------
+    # Pass the log messages of a worker ('<level>:<message>' lines) to our logfile
+    # --------------------------------------------------------------------------------
+    def _Log(self, prefix, stream):
+        for line in stream:
+            line = line.decode('utf-8', 'replace').rstrip('\n')
+            level, separator, message = line.partition(':')
+            if separator == '' or not level in logging._nameToLevel:
+                level, message = 'ERROR', line
+            logger.log(logging._nameToLevel[level], '%s%s', prefix, message)
+        stream.close()
+
+    def _Check(self, worker):
+
+        now = time.monotonic()
+
+        # A worker which is restarted with a backoff
+        if worker.process == None:
+            if now >= worker.restart and not self._stopper.is_set():
+                self._Start(worker)
+            return
+
+        self._Collect(worker)
+
+        # The settings are changed by a reload
+        settings = dict([(key, worker.reader.device[key]) for key in SETTINGS])
+        if worker.reader.CheckReopen() or settings != worker.settings:
+            self._Terminate(worker)
+            worker.backoff = watchdog.Backoff(worker.reader.device['connect_retry'])
+            self._Start(worker)
+            return
+
+        exitcode = worker.process.poll()
+        if exitcode == None:
+            return
+
+        # Telegrams were received, it is not failing in a loop
+        if worker.telegrams > 0:
+            worker.backoff.Reset()
+
+        delay = worker.backoff.Next()
+        worker.process = None
+        worker.restart = now + delay
+        worker.reader.SerialError()
+        metrics.workerrestarts.Inc('' if worker.reader.device['name'] == None else worker.reader.device['name'])
+        logger.error('%sWorker exited with code %d, restart in %.1f seconds', worker.reader.prefix, exitcode, delay)
+
+    # --------------------------------------------------------------------------------
+    # Hand a new telegram of the slot to the reader, and count the errors of the worker
+    # --------------------------------------------------------------------------------
+    def _Collect(self, worker):
+
+        result = self._block.Read(worker.index, worker.telegrams)
+        if result == None:
+            return
+        header, entries = result
+
+        reader = worker.reader
+        label = '' if reader.device['name'] == None else reader.device['name']
+
+        for field, index in COUNTS.items():
+            amount = header[index] - worker.counts[field]
+            if amount <= 0:
+                continue
+            worker.counts[field] = header[index]
+
+            if field == 'decodeerrors':
+                metrics.decodeerrors.Inc(label, amount=amount)
+            elif field == 'invalid':
+                metrics.invalidpackets.Inc(label, amount=amount)
+            elif field == 'reconnects':
+                for count in range(amount):
+                    reader.SerialError()
+            elif field == 'stalls':
+                for count in range(amount):
+                    reader.Stalled()
+
+        if header[1] == worker.telegrams:
+            return
+
+        # More telegrams then the ring holds are written since the last poll
+        overwritten = header[1] - worker.telegrams - len(entries)
+        if overwritten > 0:
+            logger.warning('%s%d telegram(s) overwritten before they were collected, lower \'poll_interval\'', reader.prefix, overwritten)
+        worker.telegrams = header[1]
+
+        for values in entries:
+            size = values[2]
+            packet = telegram.Telegram(values[3].rstrip(b'\0').decode('ascii'), values[1], size, values[4:4 + size], values[9:9 + size])
+
+            # The monotonic clock of the receive time, for the watchdog and the rates
+            timestamp = values[0]
+            clock = time.monotonic() - max(time.time() - timestamp, 0)
+
+            reader.HandleTelegram(packet, timestamp, clock)
+
+# ------------------------------------------------------------------------------------
+# The worker process: read the serialport of a device and write its telegrams into
+# its slot. The errors are logged, the stalls are logged by the supervisor.
+# ------------------------------------------------------------------------------------
+def ReadDevice(device, block, index):
+
+    parser = telegram.TelegramParser()
+    backoff = watchdog.Backoff(device['connect_retry'])
+    telegramwatchdog = watchdog.TelegramWatchdog(device['stall_factor'], device['timeout'])
+    pool = netserial.SerialPool()
+    parent = os.getppid()
+
+    # Stop when the supervisor is gone
+    while os.getppid() == parent:
+
+        try:
+            if netserial.IsUrl(device['port']):
+                ser = pool.Open(device)
+            else:
+                ser = serial.Serial(device['port'], baudrate=device['baudrate'], parity=device['parity'], stopbits=device['stopbits'], bytesize=device['bytesize'], timeout=0)
+        except Exception as e:
+            delay = backoff.Next()
+            block.Count(index, 'reconnects')
+            logger.error('Serialport connection failed. %s: \'%s\'', type(e).__name__, str(e))
+            logger.error('Retry in %.1f seconds', delay)
+            time.sleep(delay)
+            continue
+
+        telegramwatchdog.Start(time.monotonic())
+        failed = False
+        buffer = b''
+
+        try:
+            while os.getppid() == parent:
+                timeout = telegramwatchdog.Timeout(time.monotonic())
+                if timeout == 0:
+                    block.Count(index, 'stalls')
+                    failed = True
+                    break
+
+                if len(select.select([ser.fileno()], [], [], min(timeout, 1))[0]) == 0:
+                    continue
+
+                # With timeout=0, read() never blocks. It raises an exception if the device is gone.
+                buffer += ser.read(max(ser.in_waiting, 1))
+
+                while True:
+                    position = buffer.find(b'\n')
+                    if position < 0:
+                        break
+                    datain = buffer[:position + 1]
+                    buffer = buffer[position + 1:]
+
+                    try:
+                        packet = parser.Parse(datain)
+                    except telegram.TelegramError as e:
+                        block.Count(index, 'decodeerrors')
+                        logger.error('%s', str(e))
+                        continue
+
+                    if packet == None:
+                        block.Count(index, 'invalid')
+                        logger.warning('Empty Packet received, this can happen during start-up')
+                        continue
+                    elif isinstance(packet, telegram.Header):
+                        logger.debug('Header Packet: \'%s\'', packet)
+                        continue
+
+                    if device['id'] != None and packet.id != device['id']:
+                        block.Count(index, 'invalid')
+                        logger.error('Packet has ID \'%s\', expected \'%s\'', packet.id, device['id'])
+                        continue
+
+                    telegramwatchdog.Telegram(time.monotonic(), packet.interval)
+                    block.Write(index, time.time(), packet)
+                    backoff.Reset()
+
+        except Exception as e:
+            logger.error('Serialport read error. %s: \'%s\'', type(e).__name__, str(e))
+            block.Count(index, 'reconnects')
+            failed = True
+        finally:
+            ser.close()
+
+        # Don't reopen a stalled or failing device in a tight loop
+        if failed:
+            delay = backoff.Next()
+            logger.error('Retry in %.1f seconds', delay)
+            time.sleep(delay)
+
+def main():
+    parser = argparse.ArgumentParser(prog='supervisor', description='S0PCM-Reader worker process, started by the S0PCM-Reader with \'runtime: process\'')
+    parser.add_argument('block', help='The shared counter block')
+    parser.add_argument('index', help='The slot of the device', type=int)
+    parser.add_argument('device', help='The settings of the device (json)')
+    parser.add_argument('level', help='The log level', nargs='?', default='WARNING')
+    args = parser.parse_args()
+
+    # The supervisor stops everything on a Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(levelname)s:%(message)s'))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(args.level)
+
+    block = CounterBlock(args.block)
+    try:
+        ReadDevice(json.loads(args.device), block, args.index)
+    finally:
+        block.Close()
+
+if __name__ == '__main__':
+    main()
+
+# End
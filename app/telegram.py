@@ -0,0 +1,128 @@
+
+"""
+S0PCM telegram parser
+---------------------
+Parses the raw bytes as read from the serialport (including the '\r\n'), without decoding it to a
+string first. See 's0pcm-reader.py' for a description of the S0PCM protocol.
+
+Header record:
+/8237:S0 Pulse Counter V0.6 - 30/30/30/30/30ms
+
+Data record of a S0PCM-5 (19 fields) and S0PCM-2 (10 fields):
+ID:8237:I:10:M1:0:0:M2:0:0:M3:0:0:M4:0:0:M5:0:0
+ID:8237:I:10:M1:0:0:M2:0:0
+"""
+
+# Number of fields of a data record and the number of inputs
+SIZES = {19: 5, 10: 2}
+
+# The register names of the inputs, a S0PCM-2 only uses the first 2
+MARKERS = {5: [b'M1', b'M2', b'M3', b'M4', b'M5'], 2: [b'M1', b'M2']}
+
+class TelegramError(ValueError):
+    pass
+
+# ------------------------------------------------------------------------------------
+# A data record, 'pulses' are the pulses in the last interval and 'totals' the
+# pulses since the start-up of the S0PCM. Both have one value per input.
+# ------------------------------------------------------------------------------------
+class Telegram():
+
+    __slots__ = ('id', 'interval', 'size', 'pulses', 'totals')
+
+    def __init__(self, id, interval, size, pulses, totals):
+        self.id = id
+        self.interval = interval
+        self.size = size
+        self.pulses = pulses
+        self.totals = totals
+
+    def __repr__(self):
+        return 'Telegram(id=' + self.id + ', interval=' + str(self.interval) + ', pulses=' + str(self.pulses) + ', totals=' + str(self.totals) + ')'
+
+# ------------------------------------------------------------------------------------
+# The header record, which is send once after the start-up of the S0PCM
+# ------------------------------------------------------------------------------------
+class Header():
+
+    __slots__ = ('id', 'version')
+
+    def __init__(self, id, version):
+        self.id = id
+        self.version = version
+
+    def __repr__(self):
+        return 'Header(id=' + self.id + ', version=' + self.version + ')'
+
+class TelegramParser():
+
+    def __init__(self):
+        # The ID is the same for every telegram, only decode it once
+        self._ids = {}
+
+    def _Id(self, data):
+        try:
+            return self._ids[data]
+        except KeyError:
+            if not data.isdigit():
+                raise TelegramError('Invalid ID \'' + str(data) + '\'')
+            self._ids[data] = data.decode('ascii')
+            return self._ids[data]
+
+    # --------------------------------------------------------------------------------
+    # Parse a line, returns a Telegram, a Header or None for an empty line. If the
+    # line is invalid, a TelegramError is raised.
+    # --------------------------------------------------------------------------------
+    def Parse(self, datain):
+
+        line = datain.rstrip(b'\r\n')
+
+        if line.startswith(b'ID:'):
+            s0arr = line.split(b':')
+
+            try:
+                size = SIZES[len(s0arr)]
+            except KeyError:
+                raise TelegramError('Packet has invalid length. Excepted 10 or 19, got ' + str(len(s0arr)) + '.')
+
+            if s0arr[2] != b'I':
+                raise TelegramError('Expecting \'I\', received \'' + str(s0arr[2]) + '\'')
+
+            if s0arr[4::3] != MARKERS[size]:
+                raise TelegramError('Expecting \'M1\'..\'M' + str(size) + '\', received \'' + str(s0arr[4::3]) + '\'')
+
+            # int() accepts the bytes directly, it raises a ValueError on e.g. non-digits
+            try:
+                interval = int(s0arr[3])
+                pulses = tuple(map(int, s0arr[5::3]))
+                totals = tuple(map(int, s0arr[6::3]))
+            except ValueError:
+                raise TelegramError('Cannot convert pulsecount into integer, received \'' + str(line) + '\'')
+
+            if min(totals) < 0 or min(pulses) < 0:
+                raise TelegramError('Negative pulsecount received \'' + str(line) + '\'')
+
+            # int() also accepts a sign, spaces and underscores, a S0PCM only sends digits
+            if not (s0arr[3] + b''.join(s0arr[5::3]) + b''.join(s0arr[6::3])).isdigit():
+                raise TelegramError('Cannot convert pulsecount into integer, received \'' + str(line) + '\'')
+
+            return Telegram(self._Id(s0arr[1]), interval, size, pulses, totals)
+
+        elif line.startswith(b'/'):
+            header = line[1:].split(b':', 1)
+            if len(header) != 2:
+                raise TelegramError('Invalid header \'' + str(line) + '\'')
+
+            try:
+                version = header[1].decode('ascii').strip()
+            except UnicodeDecodeError:
+                raise TelegramError('Failed to decode \'' + str(line) + '\'')
+
+            return Header(self._Id(header[0]), version)
+
+        elif line == b'':
+            return None
+
+        raise TelegramError('Invalid Packet: \'' + str(line) + '\'')
+
+# End
@@ -0,0 +1,109 @@
+
+import threading
+
+"""
+Serial watchdog
+---------------
+A S0PCM sends a telegram every interval (the 'I' field of the telegram, 10 seconds in the firmware).
+The watchdog expects a telegram within 'stall_factor' intervals (or the configured 'timeout'), when
+nothing is received the device is 'stalled' and the serialport is reopened with an exponential
+backoff. A silent S0PCM (e.g. a wedged USB device) can then be told apart from zero consumption.
+
+A telegram which is received more then 1.5 interval after the previous one is late, the number of
+telegrams which are missed in between is counted.
+"""
+
+# The interval of the S0PCM firmware, used until the first telegram is received
+DEFAULT_INTERVAL = 10
+
+# ------------------------------------------------------------------------------------
+# Exponential backoff, starting at the configured 'connect_retry'
+# ------------------------------------------------------------------------------------
+class Backoff():
+
+    def __init__(self, initial, maximum=300):
+        self._initial = max(initial, 0.1)
+        self._maximum = max(maximum, self._initial)
+        self._delay = self._initial
+
+    def Next(self):
+        delay = self._delay
+        self._delay = min(self._delay * 2, self._maximum)
+        return delay
+
+    def Reset(self):
+        self._delay = self._initial
+
+class TelegramWatchdog():
+
+    def __init__(self, factor, timeout=None):
+        self._factor = factor
+        self._timeout = timeout
+        self._interval = DEFAULT_INTERVAL
+
+        # The time the port is opened or the last data is received, and of the last telegram
+        self._last = None
+        self._lasttelegram = None
+
+        self.stalled = False
+
+    # --------------------------------------------------------------------------------
+    # Change the settings, e.g. by a reload
+    # --------------------------------------------------------------------------------
+    def Configure(self, factor, timeout=None):
+        self._factor = factor
+        self._timeout = timeout
+
+    # The serialport is opened, the deadline starts now
+    def Start(self, now):
+        self._last = now
+
+    # --------------------------------------------------------------------------------
+    # A telegram is received, returns the number of missed telegrams since the previous
+    # telegram. The interval is the 'I' field of the telegram.
+    # --------------------------------------------------------------------------------
+    def Telegram(self, now, interval):
+        if interval > 0:
+            self._interval = interval
+
+        missed = 0
+        if self._lasttelegram != None and now - self._lasttelegram > self._interval * 1.5:
+            missed = max(int(round((now - self._lasttelegram) / self._interval)) - 1, 1)
+
+        self._last = now
+        self._lasttelegram = now
+        self.stalled = False
+        return missed
+
+    # The number of seconds without a telegram before the device is stalled
+    @property
+    def limit(self):
+        if self._timeout != None:
+            return self._timeout
+        return self._interval * self._factor
+
+    # Seconds until the deadline, 0 if the deadline has passed
+    def Timeout(self, now):
+        if self._last == None:
+            self._last = now
+        return max(self._last + self.limit - now, 0)
+
+# ------------------------------------------------------------------------------------
+# The stop event of the threads. Setting it also calls the wakeup functions, e.g. to
+# wake up a serialport reader which is waiting in select().
+# ------------------------------------------------------------------------------------
+class StopEvent(threading.Event):
+
+    def __init__(self):
+        super().__init__()
+        self._wakeups = []
+
+    def AddWakeup(self, wakeup):
+        self._wakeups.append(wakeup)
+
+    def set(self):
+        super().set()
+        for wakeup in self._wakeups:
+            wakeup()
+
+# End
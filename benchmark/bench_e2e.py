@@ -0,0 +1,245 @@
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import tempfile
+
+import harness
+
+"""
+End-to-end benchmark and soak
+-----------------------------
+Runs the real S0PCM-Reader against one or more pseudo-terminal S0PCM devices (or with '--network' S0PCMs
+behind a single ser2net stand-in) and an in-process MQTT stub (see 'harness.py'), with a configurable
+telegram rate. A real S0PCM sends a telegram every 10
+seconds, so e.g. 100 telegrams/second is an acceleration of 1000x. Reported are:
+- telegrams processed by the reader (s0pcm_telegrams_total) and published. MQTT only publishes the
+  latest value, telegrams which are processed at the same time (e.g. collected in one poll with the
+  process runtime) are published once. A telegram which isn't processed is lost.
+- latency: from the write of a telegram on the pty until the PUBLISH of its 'total' arrives at the stub
+- CPU time per telegram of the reader process (all threads)
+- bytes written to files (journal, 'measurement.yaml'), this is the write() total of the process
+  ('wchar', paho uses send() which isn't included) minus the bytes written to the logfile
+- RSS at the start and end of the run, for a soak run with '--duration' of e.g. 3600
+- start-up: from the start of the process until the PUBLISH of the stored 'total' arrives at the stub,
+  for the first start (parses 'measurement.yaml') and a restart (reads the state file)
+
+Usage: python benchmark/bench_e2e.py [--devices 1] [--rate 10] [--duration 30] [--runtime threading]
+"""
+
+def Config(args, stub, devices, metricsport):
+
+    config = 'log:\n  level: error\n'
+    config += 'metrics:\n  enabled: yes\n  host: 127.0.0.1\n  port: ' + str(metricsport) + '\n'
+    config += 'mqtt:\n  host: ' + stub.host + '\n  port: ' + str(stub.port) + '\n  base_topic: bench\n  connect_retry: 1\n'
+    config += 's0pcm:\n  runtime: ' + args.runtime + '\n'
+    config += 'journal:\n  enabled: ' + ('no' if args.no_journal else 'yes') + '\n'
+    config += 'serial:\n  port: ' + devices[0].port + '\n'
+
+    if len(devices) > 1:
+        config += 'devices:\n'
+        for i, device in enumerate(devices):
+            config += '  - name: dev' + str(i) + '\n    id: ' + device.id + '\n    port: ' + device.port + '\n'
+
+    return config
+
+# The S0PCMs, a pty per device or behind a single raw TCP server
+def Devices(args):
+    if args.network:
+        server = harness.TcpServer()
+        return server, [server.Device(8000 + i, args.size) for i in range(args.devices)]
+    return None, [harness.PtyDevice(8000 + i, args.size) for i in range(args.devices)]
+
+def CloseDevices(server, devices):
+    for device in devices:
+        device.Close()
+    if server != None:
+        server.Close()
+
+# The counters of a previous run, they are published directly after the connect
+def Measurement(args, devices):
+
+    inputs = ''
+    for key in range(1, args.size + 1):
+        inputs += '%d:\n  pulsecount: 0\n  total: 0\n' % key
+
+    if len(devices) == 1:
+        return inputs
+    return ''.join(['dev' + str(i) + ':\n' + ''.join(['  ' + line + '\n' for line in inputs.splitlines()]) for i in range(len(devices))])
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_e2e', description='S0PCM-Reader end-to-end benchmark and soak')
+    parser.add_argument('--devices', help='Number of S0PCM devices', type=int, default=1)
+    parser.add_argument('--rate', help='Telegrams per second, per device', type=float, default=10)
+    parser.add_argument('--duration', help='Duration of the measurement in seconds', type=float, default=30)
+    parser.add_argument('--warmup', help='Duration of the warm-up in seconds', type=float, default=3)
+    parser.add_argument('--runtime', help='The runtime of the reader', choices=['threading', 'asyncio', 'process'], default='threading')
+    parser.add_argument('--no-journal', help='Disable the journal, rewrite \'measurement.yaml\' on every change', action='store_true')
+    parser.add_argument('--network', help='The devices are behind a single raw TCP server (socket://), instead of a pty per device', action='store_true')
+    parser.add_argument('--size', help='Number of inputs, 2 (S0PCM-2) or 5 (S0PCM-5)', type=int, choices=[2, 5], default=5)
+    parser.add_argument('--sample', help='Interval in seconds to sample the RSS', type=float, default=10)
+    parser.add_argument('--json', help='Print the result as json', action='store_true')
+    parser.add_argument('--keep', help='Keep the configuration directory', action='store_true')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='s0pcm-bench-')
+    stub = harness.MqttStub()
+    server, devices = Devices(args)
+    metricsport = harness.FreePort()
+
+    # The 'total' topic of input 1 of every device, the payload is the sequence number of the telegram
+    topics = {}
+    for i in range(args.devices):
+        topics[('bench/dev' + str(i) if args.devices > 1 else 'bench') + '/1/total'] = i
+
+    sent = {}
+    latencies = []
+    first = []
+
+    def Received(now, topic, payload):
+        if topic in topics:
+            if len(first) == 0:
+                first.append(now)
+            start = sent.pop((topics[topic], int(payload)), None)
+            if start != None:
+                latencies.append(now - start)
+
+    stub.callback = Received
+
+    reader = harness.Reader(directory, Config(args, stub, devices, metricsport))
+    logname = os.path.join(directory, 's0pcm-reader.log')
+    with open(os.path.join(directory, 'measurement.yaml'), 'w') as f:
+        f.write(Measurement(args, devices))
+
+    try:
+        # The start-up time of the first start and a restart
+        startup = []
+        for restart in range(2):
+            reader.Stop()
+            del first[:]
+            start = time.perf_counter()
+            reader.Start()
+            while len(first) == 0 and time.perf_counter() - start < 30 and reader.process.poll() == None:
+                time.sleep(0.001)
+            if len(first) == 0:
+                print('ERROR: no publish after the start, see \'' + logname + '\'')
+                args.keep = True
+                sys.exit(1)
+            startup.append(first[0] - start)
+
+        # A pty can't be opened again after a stop, the measurement uses new devices
+        reader.Stop()
+        CloseDevices(server, devices)
+        server, devices = Devices(args)
+        reader = harness.Reader(directory, Config(args, stub, devices, metricsport))
+        reader.Start()
+
+        if server != None:
+            server.WaitClient()
+        for device in devices:
+            device.Header()
+
+        interval = 1 / args.rate
+        deadline = time.perf_counter()
+        measuring = False
+        end = time.perf_counter() + args.warmup
+        nextsample = 0
+        telegrams = 0
+        rss = []
+
+        while True:
+            now = time.perf_counter()
+
+            if now >= end:
+                if measuring:
+                    break
+
+                # The warm-up is done, start the measurement
+                measuring = True
+                end = now + args.duration
+                del latencies[:]
+                telegrams = 0
+                cpu = reader.Cpu()
+                written = reader.Written()
+                received = stub.received
+                processed = harness.Metric(metricsport, 's0pcm_telegrams_total')
+                logsize = os.path.getsize(logname) if os.path.exists(logname) else 0
+                nextsample = now
+
+            if measuring and now >= nextsample:
+                rss.append((now, reader.Rss()))
+                nextsample += args.sample
+
+            for i, device in enumerate(devices):
+                sent[(i, device.sequence + 1)] = time.perf_counter()
+                device.Telegram()
+            telegrams += len(devices)
+
+            deadline += interval
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        # Wait for the last publishes
+        time.sleep(1)
+
+        cpu = reader.Cpu() - cpu
+        written = reader.Written() - written
+        received = stub.received - received
+        processed = harness.Metric(metricsport, 's0pcm_telegrams_total') - processed
+        logsize = (os.path.getsize(logname) if os.path.exists(logname) else 0) - logsize
+        rss.append((time.perf_counter(), reader.Rss()))
+
+        if reader.process.poll() != None:
+            print('ERROR: the reader has stopped, see \'' + logname + '\'')
+            args.keep = True
+            sys.exit(1)
+    finally:
+        reader.Stop()
+        stub.Close()
+        CloseDevices(server, devices)
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    result = {
+        'runtime': args.runtime,
+        'journal': not args.no_journal,
+        'devices': args.devices,
+        'rate': args.rate,
+        'telegrams': telegrams,
+        'simulated_hours': round(telegrams / args.devices * 10 / 3600, 2),
+        'processed': int(processed),
+        'published': len(latencies),
+        'lost': max(telegrams - int(processed), 0),
+        'latency_ms': {
+            'p50': round(harness.Percentile(latencies, 50) * 1000, 3),
+            'p90': round(harness.Percentile(latencies, 90) * 1000, 3),
+            'p99': round(harness.Percentile(latencies, 99) * 1000, 3),
+            'max': round(max(latencies) * 1000 if len(latencies) > 0 else 0, 3),
+        },
+        'cpu_us_per_telegram': round(cpu * 1000000 / max(telegrams, 1), 1),
+        'file_bytes_per_telegram': round((written - logsize) / max(telegrams, 1), 1),
+        'mqtt_bytes_per_telegram': round(received / max(telegrams, 1), 1),
+        'rss_kb': {'start': rss[0][1], 'end': rss[-1][1], 'max': max([value for when, value in rss])},
+        'startup_ms': {'first': round(startup[0] * 1000, 1), 'restart': round(startup[1] * 1000, 1)},
+    }
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print('runtime        %s, journal %s, %d device(s), %.1f telegrams/second per device' % (result['runtime'], 'yes' if result['journal'] else 'no', result['devices'], result['rate']))
+    print('telegrams      %d (%.2f hours of a real S0PCM), %d processed, %d published, %d lost' % (result['telegrams'], result['simulated_hours'], result['processed'], result['published'], result['lost']))
+    print('latency        p50 %.3f ms, p90 %.3f ms, p99 %.3f ms, max %.3f ms' % (result['latency_ms']['p50'], result['latency_ms']['p90'], result['latency_ms']['p99'], result['latency_ms']['max']))
+    print('cpu            %.1f us/telegram' % result['cpu_us_per_telegram'])
+    print('written        %.1f bytes/telegram to files, %.1f bytes/telegram to MQTT' % (result['file_bytes_per_telegram'], result['mqtt_bytes_per_telegram']))
+    print('startup        %.1f ms to the first publish, %.1f ms after a restart' % (result['startup_ms']['first'], result['startup_ms']['restart']))
+    print('rss            %d KB at start, %d KB at end (%+d KB), max %d KB' % (result['rss_kb']['start'], result['rss_kb']['end'], result['rss_kb']['end'] - result['rss_kb']['start'], result['rss_kb']['max']))
+
+if __name__ == '__main__':
+    main()
+
+# End
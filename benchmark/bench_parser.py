@@ -0,0 +1,153 @@
+
+import sys
+import os
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import telegram
+
+"""
+Parser benchmark
+----------------
+Compares the telegrams/second of the bytes-level parser (app/telegram.py) against the previous code
+path of 'ReadSerial' (decode, split and a str() snapshot of the measurement before and after every
+telegram). Both paths also update the counters, the end result is checked to be identical.
+
+Usage: python benchmark/bench_parser.py [-n 200000] [--size 5]
+"""
+
+def MakeTelegrams(count, size):
+    telegrams = []
+    total = [0] * size
+    for i in range(count):
+        fields = ['ID', '8237', 'I', '10']
+        for j in range(size):
+            # Only some inputs change, like a real meter
+            pulses = (i + j) % 3 if j % 2 == 0 else 0
+            total[j] += pulses
+            fields += ['M' + str(j + 1), str(pulses), str(total[j])]
+        telegrams.append((':'.join(fields) + '\r\n').encode('ascii'))
+    return telegrams
+
+# ------------------------------------------------------------------------------------
+# The code path of 'ReadSerial' before the parser was introduced
+# ------------------------------------------------------------------------------------
+def LegacyPath(telegrams):
+
+    measurement = {'date': '2021-01-01'}
+    writes = 0
+
+    for datain in telegrams:
+        datastr = datain.decode('ascii')
+        datastr = datastr.rstrip('\r\n')
+
+        if datastr.startswith('ID:'):
+            s0arr = datastr.split(':')
+            if len(s0arr) == 19:
+                size = 5
+            elif len(s0arr) == 10:
+                size = 2
+            else:
+                continue
+
+            measurementstr = str(measurement)
+
+            for count in range(1, size + 1):
+                offset = 4 + ((count - 1) * 3)
+                if s0arr[offset] == 'M' + str(count):
+                    try:
+                        pulsecount = int(s0arr[offset + 2])
+                    except:
+                        pulsecount = 0
+
+                    if not count in measurement: measurement[count] = {}
+                    if not 'pulsecount' in measurement[count]: measurement[count]['pulsecount'] = 0
+                    if not 'total' in measurement[count]: measurement[count]['total'] = 0
+
+                    if pulsecount > measurement[count]['pulsecount']:
+                        delta = pulsecount - measurement[count]['pulsecount']
+                        measurement[count]['pulsecount'] = pulsecount
+                        measurement[count]['total'] += delta
+
+            if measurementstr != str(measurement):
+                writes += 1
+
+    return measurement, writes
+
+# ------------------------------------------------------------------------------------
+# The code path with the bytes-level parser
+# ------------------------------------------------------------------------------------
+def ParserPath(telegrams):
+
+    measurement = {'date': '2021-01-01'}
+    writes = 0
+    parser = telegram.TelegramParser()
+
+    for datain in telegrams:
+        try:
+            packet = parser.Parse(datain)
+        except telegram.TelegramError:
+            continue
+
+        if not isinstance(packet, telegram.Telegram):
+            continue
+
+        changed = False
+        for count in range(1, packet.size + 1):
+            pulsecount = packet.totals[count - 1]
+
+            if not count in measurement:
+                measurement[count] = {'pulsecount': 0, 'total': 0}
+                changed = True
+
+            if pulsecount > measurement[count]['pulsecount']:
+                measurement[count]['total'] += pulsecount - measurement[count]['pulsecount']
+                measurement[count]['pulsecount'] = pulsecount
+                changed = True
+
+        if changed:
+            writes += 1
+
+    return measurement, writes
+
+def Run(name, function, telegrams, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function(telegrams)
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    rate = len(telegrams) / best
+    print('%-8s %12.0f telegrams/second (%.3f us/telegram)' % (name, rate, best * 1000000 / len(telegrams)))
+    return result, rate
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_parser', description='S0PCM telegram parser benchmark')
+    parser.add_argument('-n', '--number', help='Number of telegrams', type=int, default=200000)
+    parser.add_argument('-r', '--repeat', help='Number of runs, the best run is reported', type=int, default=3)
+    parser.add_argument('--size', help='Number of inputs, 2 (S0PCM-2) or 5 (S0PCM-5)', type=int, choices=[2, 5], default=5)
+    args = parser.parse_args()
+
+    telegrams = MakeTelegrams(args.number, args.size)
+
+    legacy, legacyrate = Run('legacy', LegacyPath, telegrams, args.repeat)
+    parsed, parsedrate = Run('parser', ParserPath, telegrams, args.repeat)
+
+    # Both paths should end up with the same counters and number of writes
+    for count in range(1, args.size + 1):
+        if legacy[0][count]['total'] != parsed[0][count]['total']:
+            print('ERROR: total of input %d differs, legacy %d, parser %d' % (count, legacy[0][count]['total'], parsed[0][count]['total']))
+            sys.exit(1)
+    if legacy[1] != parsed[1]:
+        print('ERROR: number of writes differs, legacy %d, parser %d' % (legacy[1], parsed[1]))
+        sys.exit(1)
+
+    print('speedup  %12.2fx' % (parsedrate / legacyrate))
+
+if __name__ == '__main__':
+    main()
+
+# End
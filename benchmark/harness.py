@@ -0,0 +1,319 @@
+
+import os
+import sys
+import tty
+import time
+import socket
+import struct
+import signal
+import threading
+import subprocess
+import urllib.request
+
+"""
+Benchmark harness
+-----------------
+Runs the real 's0pcm-reader.py' as a separate process, without a S0PCM or MQTT broker:
+- PtyDevice: a pseudo-terminal per S0PCM, the reader opens the slave side as its serialport
+- TcpServer: a stand-in for a serial-to-network server (ser2net in raw TCP mode) with one or more
+  S0PCMs (TcpDevice) behind it, the reader connects to it with 'socket://host:port'
+- MqttStub: a minimal MQTT 3.1.1 broker (CONNECT, PUBLISH QoS 0/1, SUBSCRIBE, PINGREQ), which
+  records every PUBLISH with the time it was received
+- Reader: writes a configuration, starts the reader and samples its CPU, RSS and I/O from /proc
+- Metric: the sum of a metric of the reader, from its metrics server
+"""
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app', 's0pcm-reader.py')
+
+# ------------------------------------------------------------------------------------
+# A S0PCM on a pseudo-terminal. The telegrams have 1 pulse on M1 every interval, so the
+# total of input 1 is the sequence number of the telegram.
+# ------------------------------------------------------------------------------------
+class PtyDevice():
+
+    def __init__(self, id, size=5):
+        self.id = str(id)
+        self.size = size
+        self.sequence = 0
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+    def Header(self):
+        self.Write(('/' + self.id + ':S0 Pulse Counter V0.6 - 30/30/30/30/30ms\r\n').encode('ascii'))
+
+    def Telegram(self):
+        self.sequence += 1
+        fields = ['ID', self.id, 'I', '10', 'M1', '1', str(self.sequence)]
+        for i in range(2, self.size + 1):
+            fields += ['M' + str(i), '0', '0']
+        self.Write((':'.join(fields) + '\r\n').encode('ascii'))
+        return self.sequence
+
+    def Write(self, data):
+        os.write(self._master, data)
+
+    def Close(self):
+        os.close(self._master)
+        os.close(self._slave)
+
+# ------------------------------------------------------------------------------------
+# A serial-to-network server in raw TCP mode. The lines of all its S0PCMs are send to
+# every connected client, like multiple S0PCMs on a single remote serialport.
+# ------------------------------------------------------------------------------------
+class TcpServer():
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen()
+        self.port = 'socket://' + host + ':' + str(self._server.getsockname()[1])
+
+        self.lock = threading.Lock()
+        self.connects = 0
+        self._clients = []
+        self._thread = threading.Thread(target=self._Accept, daemon=True)
+        self._thread.start()
+
+    def _Accept(self):
+        while True:
+            try:
+                client, address = self._server.accept()
+            except OSError:
+                return
+            with self.lock:
+                self._clients.append(client)
+                self.connects += 1
+
+    # Wait until a client is connected, lines written before are lost (like a real serialport)
+    def WaitClient(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if len(self._clients) > 0:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def Device(self, id, size=5):
+        return TcpDevice(self, id, size)
+
+    def Write(self, data):
+        with self.lock:
+            for client in list(self._clients):
+                try:
+                    client.sendall(data)
+                except OSError:
+                    self._clients.remove(client)
+                    client.close()
+
+    # Drop all connections, e.g. to test a reconnect
+    def Disconnect(self):
+        with self.lock:
+            for client in self._clients:
+                try:
+                    client.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                client.close()
+            self._clients = []
+
+    def Close(self):
+        self.Disconnect()
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        self._thread.join()
+
+class TcpDevice(PtyDevice):
+
+    def __init__(self, server, id, size=5):
+        self.id = str(id)
+        self.size = size
+        self.sequence = 0
+        self.port = server.port
+        self._server = server
+
+    def Write(self, data):
+        self._server.Write(data)
+
+    def Close(self):
+        pass
+
+class MqttStub():
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen()
+        self.host = host
+        self.port = self._server.getsockname()[1]
+
+        self.lock = threading.Lock()
+        self.messages = []
+        self.received = 0
+        self.connects = 0
+        self.callback = None
+
+        self._clients = []
+        self._thread = threading.Thread(target=self._Accept, daemon=True)
+        self._thread.start()
+
+    def _Accept(self):
+        while True:
+            try:
+                client, address = self._server.accept()
+            except OSError:
+                return
+            self._clients.append(client)
+            threading.Thread(target=self._Client, args=(client,), daemon=True).start()
+
+    def _Read(self, client, size):
+        data = b''
+        while len(data) < size:
+            chunk = client.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _Client(self, client):
+        try:
+            while True:
+                first = self._Read(client, 1)[0]
+                length = 0
+                multiplier = 1
+                count = 1
+                while True:
+                    byte = self._Read(client, 1)[0]
+                    count += 1
+                    length += (byte & 127) * multiplier
+                    multiplier *= 128
+                    if byte & 128 == 0:
+                        break
+                body = self._Read(client, length)
+
+                with self.lock:
+                    self.received += count + length
+
+                kind = first >> 4
+                if kind == 1:
+                    with self.lock:
+                        self.connects += 1
+                    client.sendall(b'\x20\x02\x00\x00')
+                elif kind == 3:
+                    now = time.perf_counter()
+                    topiclength = struct.unpack('>H', body[:2])[0]
+                    topic = body[2:2 + topiclength].decode('utf-8')
+                    payload = body[2 + topiclength:]
+                    if (first >> 1) & 3:
+                        client.sendall(b'\x40\x02' + payload[:2])
+                        payload = payload[2:]
+                    with self.lock:
+                        self.messages.append((now, topic, payload))
+                    if self.callback != None:
+                        self.callback(now, topic, payload)
+                elif kind == 8:
+                    client.sendall(b'\x90\x03' + body[:2] + b'\x00')
+                elif kind == 12:
+                    client.sendall(b'\xd0\x00')
+                elif kind == 14:
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            client.close()
+
+    # Drop all connections, e.g. to test a reconnect
+    def Disconnect(self):
+        for client in self._clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._clients = []
+
+    def Close(self):
+        self.Disconnect()
+
+        # A close alone doesn't wake up the accept, the stub would still accept connections
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        self._thread.join()
+
+# ------------------------------------------------------------------------------------
+# The reader process, with a configuration written to its own directory
+# ------------------------------------------------------------------------------------
+class Reader():
+
+    def __init__(self, directory, configuration):
+        self.directory = directory
+        with open(os.path.join(directory, 'configuration.yaml'), 'w') as f:
+            f.write(configuration)
+        self.process = None
+
+    def Start(self, *extra):
+        self.process = subprocess.Popen([sys.executable, APP, '-c', self.directory] + list(extra), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # User and system CPU time in seconds
+    def Cpu(self):
+        with open('/proc/' + str(self.process.pid) + '/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    # Resident memory in KB
+    def Rss(self):
+        with open('/proc/' + str(self.process.pid) + '/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        return 0
+
+    # Bytes passed to write() and friends, send() on a socket is not included
+    def Written(self):
+        with open('/proc/' + str(self.process.pid) + '/io', 'r') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+        return 0
+
+    def Stop(self, timeout=10):
+        if self.process == None or self.process.poll() != None:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+# A free TCP port, e.g. for the metrics server of the reader
+def FreePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# The sum of a metric over all its labels, None if the metrics server can't be reached
+def Metric(port, name):
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:' + str(port) + '/metrics', timeout=5) as response:
+            lines = response.read().decode('utf-8').splitlines()
+    except OSError:
+        return None
+    return sum([float(line.rsplit(' ', 1)[1]) for line in lines if line.split('{', 1)[0].split(' ', 1)[0] == name])
+
+def Percentile(values, percent):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+# End
@@ -0,0 +1,228 @@
+
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import history
+
+"""
+Tests of the history store (app/history.py): the slot index of a period, the slots of a series,
+the cumulative sum of a range and the day and month history of the store
+
+Usage: python -m unittest discover tests
+"""
+
+DAY = history.Index('day', datetime.date(2021, 3, 14))
+
+class TestPeriod(unittest.TestCase):
+
+    def test_index(self):
+        when = datetime.datetime(2021, 3, 14, 10, 25)
+        self.assertEqual(history.Period('hour', history.Index('hour', when)), datetime.datetime(2021, 3, 14, 10))
+        self.assertEqual(history.Period('day', history.Index('day', when)), datetime.date(2021, 3, 14))
+        self.assertEqual(history.Period('month', history.Index('month', when)), datetime.date(2021, 3, 1))
+
+        # Consecutive periods have consecutive slots, also over the end of a month and year
+        self.assertEqual(history.Index('hour', datetime.datetime(2021, 1, 1, 0)) - history.Index('hour', datetime.datetime(2020, 12, 31, 23)), 1)
+        self.assertEqual(history.Index('day', datetime.date(2021, 3, 1)) - history.Index('day', datetime.date(2021, 2, 28)), 1)
+        self.assertEqual(history.Index('month', datetime.date(2021, 1, 1)) - history.Index('month', datetime.date(2020, 12, 31)), 1)
+
+    def test_format(self):
+        when = datetime.datetime(2021, 3, 14, 10)
+        self.assertEqual(history.FormatPeriod('hour', history.Index('hour', when)), '2021-03-14 10:00')
+        self.assertEqual(history.FormatPeriod('day', history.Index('day', when)), '2021-03-14')
+        self.assertEqual(history.FormatPeriod('month', history.Index('month', when)), '2021-03')
+
+    def test_parse(self):
+        self.assertEqual(history.ParsePeriod('2021-03-14 10'), (datetime.datetime(2021, 3, 14, 10), datetime.datetime(2021, 3, 14, 10)))
+        self.assertEqual(history.ParsePeriod('2021-03-14T10'), (datetime.datetime(2021, 3, 14, 10), datetime.datetime(2021, 3, 14, 10)))
+        self.assertEqual(history.ParsePeriod('2021-03-14'), (datetime.datetime(2021, 3, 14, 0), datetime.datetime(2021, 3, 14, 23)))
+        self.assertEqual(history.ParsePeriod('2021-02'), (datetime.datetime(2021, 2, 1, 0), datetime.datetime(2021, 2, 28, 23)))
+        self.assertEqual(history.ParsePeriod('2020-12'), (datetime.datetime(2020, 12, 1, 0), datetime.datetime(2020, 12, 31, 23)))
+        self.assertEqual(history.ParsePeriod('2021'), (datetime.datetime(2021, 1, 1, 0), datetime.datetime(2021, 12, 31, 23)))
+
+    def test_parse_invalid(self):
+        for text in ['', 'yesterday', '2021-13', '2021-03-14 25']:
+            with self.assertRaises(ValueError):
+                history.ParsePeriod(text)
+
+class TestHistorySeries(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, '1.day')
+        self.series = []
+
+    def tearDown(self):
+        for series in self.series:
+            series.Close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def Open(self, unit='day', create=True):
+        series = history.HistorySeries(self.filename, unit, create)
+        self.series.append(series)
+        return series
+
+    def Size(self):
+        return (os.path.getsize(self.filename) - history.HEADER.size) // history.SLOT.size
+
+    # --------------------------------------------------------------------------------
+    # Slots
+    # --------------------------------------------------------------------------------
+    def test_empty(self):
+        series = self.Open()
+        self.assertIsNone(series.first)
+        self.assertIsNone(series.last)
+        self.assertIsNone(series.Get(DAY))
+        self.assertEqual(series.Range(), [])
+        self.assertEqual(series.Sum(), (0, 0))
+
+    def test_set_get(self):
+        series = self.Open()
+        series.Set({DAY: 10, DAY + 1: 0, DAY + 2: 30})
+        self.assertEqual((series.first, series.last), (DAY, DAY + 2))
+        self.assertEqual([series.Get(DAY + i) for i in range(-1, 4)], [None, 10, 0, 30, None])
+
+        # A slot is overwritten in place
+        series.Set({DAY + 1: 20})
+        self.assertEqual(series.Range(), [(DAY, 10), (DAY + 1, 20), (DAY + 2, 30)])
+        self.assertEqual(self.Size(), 3)
+
+    def test_gap(self):
+        # The slots between the last slot and the new data have no data
+        series = self.Open()
+        series.Set({DAY: 10})
+        series.Set({DAY + 3: 40})
+        self.assertEqual(self.Size(), 4)
+        self.assertIsNone(series.Get(DAY + 1))
+        self.assertEqual(series.Range(), [(DAY, 10), (DAY + 3, 40)])
+
+    def test_before_first(self):
+        # Data before the first slot moves the origin of the file
+        series = self.Open()
+        series.Set({DAY: 10, DAY + 1: 20})
+        series.Set({DAY - 2: 5})
+        self.assertEqual(series.first, DAY - 2)
+        self.assertEqual(series.Range(), [(DAY - 2, 5), (DAY, 10), (DAY + 1, 20)])
+        self.assertEqual(series.Sum(), (35, 3))
+        self.assertFalse(os.path.exists(self.filename + '.tmp'))
+
+    def test_add(self):
+        series = self.Open()
+        series.Add(DAY, 5)
+        series.Add(DAY, 7)
+        self.assertEqual(series.Get(DAY), 12)
+
+    def test_reopen(self):
+        series = self.Open()
+        series.Set({DAY: 10, DAY + 2: 30})
+        series.Close()
+        self.series.remove(series)
+
+        series = self.Open(create=False)
+        self.assertEqual((series.first, series.last), (DAY, DAY + 2))
+        self.assertEqual(series.Range(), [(DAY, 10), (DAY + 2, 30)])
+        self.assertEqual(series.Sum(), (40, 2))
+
+    def test_invalid_file(self):
+        self.Open().Set({DAY: 10})
+        with self.assertRaises(ValueError):
+            self.Open(unit='month')
+
+        with open(self.filename, 'wb') as f:
+            f.write(b'garbage, not a history file')
+        with self.assertRaises(ValueError):
+            self.Open()
+
+    def test_missing_file(self):
+        with self.assertRaises(FileNotFoundError):
+            self.Open(create=False)
+
+    # --------------------------------------------------------------------------------
+    # Ranges, the sum is calculated from the cumulative usage of the first and last slot
+    # --------------------------------------------------------------------------------
+    def test_sum(self):
+        series = self.Open()
+        series.Set({DAY + i: (i + 1) * 10 for i in range(5)})
+        series.Set({DAY + 7: 100})
+
+        self.assertEqual(series.Sum(), (250, 6))
+        self.assertEqual(series.Sum(DAY + 1, DAY + 3), (90, 3))
+        self.assertEqual(series.Sum(DAY + 4, DAY + 6), (50, 1))
+        self.assertEqual(series.Sum(DAY - 10, DAY), (10, 1))
+        self.assertEqual(series.Sum(DAY + 8, DAY + 20), (0, 0))
+
+        # Overwriting a slot updates the cumulative usage of the slots after it
+        series.Set({DAY + 1: 0})
+        self.assertEqual(series.Sum(DAY + 2, DAY + 7), (220, 4))
+        self.assertEqual(series.Sum(), (230, 6))
+
+    def test_range(self):
+        series = self.Open()
+        series.Set({DAY: 10, DAY + 1: 20, DAY + 3: 40})
+        self.assertEqual(series.Range(DAY + 1, DAY + 10), [(DAY + 1, 20), (DAY + 3, 40)])
+        self.assertEqual(series.Range(DAY + 2, DAY + 2), [])
+        self.assertEqual(series.Range(DAY + 3, DAY), [])
+
+    def test_top(self):
+        series = self.Open()
+        series.Set({DAY: 10, DAY + 1: 50, DAY + 2: 30, DAY + 4: 5})
+        self.assertEqual(series.Top(2), [(DAY + 1, 50), (DAY + 2, 30)])
+        self.assertEqual(series.Top(2, largest=False), [(DAY + 4, 5), (DAY, 10)])
+        self.assertEqual(series.Top(5, DAY + 2), [(DAY + 2, 30), (DAY + 4, 5)])
+
+class TestHistoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = history.HistoryStore(os.path.join(self.directory, 'history'))
+
+    def tearDown(self):
+        self.store.Close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_files(self):
+        self.store.SetDay('1', datetime.date(2021, 3, 14), 10)
+        self.store.SetDay('water-1', datetime.date(2021, 3, 14), 20)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory, 'history'))), ['1.day', '1.month', 'water-1.day', 'water-1.month'])
+
+    def test_month(self):
+        # The month is the sum of its days, also when a day is corrected later
+        self.store.SetDay('1', datetime.date(2021, 2, 28), 5)
+        self.store.SetDay('1', datetime.date(2021, 3, 1), 10)
+        self.store.SetDay('1', datetime.date(2021, 3, 2), 20)
+        self.store.SetDay('1', datetime.date(2021, 3, 1), 15)
+
+        months = self.store.Series('1', 'month')
+        self.assertEqual(months.Range(), [(history.Index('month', datetime.date(2021, 2, 1)), 5), (history.Index('month', datetime.date(2021, 3, 1)), 35)])
+
+    def test_hour(self):
+        hour = datetime.datetime(2021, 3, 14, 10)
+
+        # A partial hour (e.g. on a stop) is overwritten by the complete hour
+        self.store.SetHour('1', hour, 3, final=False)
+        self.store.SetHour('1', hour, 7)
+        self.assertEqual(self.store.Series('1', 'hour').Get(history.Index('hour', hour)), 7)
+
+        # The second hour of a daylight saving time change is added to the first one
+        self.store.SetHour('1', hour, 4)
+        self.assertEqual(self.store.Series('1', 'hour').Get(history.Index('hour', hour)), 11)
+
+    def test_import_daily(self):
+        with open(os.path.join(self.directory, 'daily-1.txt'), 'w') as f:
+            f.write('2021-03-13;10\n2021-03-14;20\ninvalid\n\n2021-04-01;5\n')
+
+        result = history.ImportDaily(self.store, self.directory)
+        self.assertEqual(result, [('daily-1.txt', '1', 3)])
+        self.assertEqual(self.store.Series('1', 'day').Sum(), (35, 3))
+        self.assertEqual(self.store.Series('1', 'month').Range(), [(history.Index('month', datetime.date(2021, 3, 1)), 30), (history.Index('month', datetime.date(2021, 4, 1)), 5)])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# End
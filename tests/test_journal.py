@@ -0,0 +1,199 @@
+
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+import unittest.mock
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import counters
+import journal
+
+"""
+Tests of the measurement journal (app/journal.py): the replay on start-up and the compaction into
+'measurement.yaml'
+
+Usage: python -m unittest discover tests
+"""
+
+DATE = datetime.date(2021, 3, 14)
+
+def Snapshot(key, total, device=None):
+    return counters.CounterSnapshot(device, key, None, None, total, total, 15, 77, 3, 120, 411, 1502, (), 1)
+
+class TestMeasurementJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.measurementname = os.path.join(self.directory, 'measurement.yaml')
+        self.journalname = os.path.join(self.directory, 'measurement.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def Journal(self, **settings):
+        return journal.MeasurementJournal(self.measurementname, self.journalname, **settings)
+
+    def Replay(self, measurement=None):
+        if measurement == None:
+            measurement = {None: {}}
+        self.Journal().Replay(measurement)
+        return measurement
+
+    def WriteJournal(self, data):
+        with open(self.journalname, 'w') as f:
+            f.write(data)
+
+    # --------------------------------------------------------------------------------
+    # Replay
+    # --------------------------------------------------------------------------------
+    def test_append_replay(self):
+        measurementjournal = self.Journal()
+        measurementjournal.Append(None, DATE, [Snapshot(1, 100), Snapshot(2, 200)], hour=15)
+        measurementjournal.Append(None, DATE, [Snapshot(1, 101)], hour=15)
+        measurementjournal.Close()
+
+        measurement = self.Replay()
+        self.assertEqual(measurement[None][1]['total'], 101)
+        self.assertEqual(measurement[None][2]['total'], 200)
+        self.assertEqual(measurement[None][1]['last_month'], 1502)
+        self.assertEqual(measurement[None]['date'], DATE)
+        self.assertEqual(measurement[None]['hour'], 15)
+
+    def test_replay_on_top_of_measurement(self):
+        self.WriteJournal('2021-03-14T15 - 1 1234 770123 15 77 3 120 411 1502\n')
+        measurement = self.Replay({None: {1: {'total': 5, 'name': 'water'}, 2: {'total': 7}}})
+        self.assertEqual(measurement[None][1]['total'], 770123)
+        self.assertEqual(measurement[None][1]['name'], 'water')
+        self.assertEqual(measurement[None][2]['total'], 7)
+
+    def test_replay_devices(self):
+        measurementjournal = self.Journal()
+        measurementjournal.Append('water', DATE, [Snapshot(1, 100, 'water')])
+        measurementjournal.Append('gas', DATE, [Snapshot(1, 200, 'gas')])
+        measurementjournal.Close()
+
+        measurement = self.Replay({'water': {}, 'gas': {}})
+        self.assertEqual(measurement['water'][1]['total'], 100)
+        self.assertEqual(measurement['gas'][1]['total'], 200)
+
+    def test_replay_torn_last_record(self):
+        # E.g. a power failure during the write of the last record
+        self.WriteJournal('2021-03-14T15 - 1 1234 770123 15 77 3 120 411 1502\n2021-03-14T15 - 1 1235 770124 16 77 4 1')
+        measurement = self.Replay()
+        self.assertEqual(measurement[None][1]['total'], 770123)
+        self.assertEqual(measurement[None][1]['pulsecount'], 1234)
+
+    def test_replay_torn_only_record(self):
+        self.WriteJournal('2021-03-14T15 - 1 1234 77')
+        measurement = self.Replay({None: {1: {'total': 5}}})
+        self.assertEqual(measurement[None][1], {'total': 5})
+
+    def test_replay_invalid_records(self):
+        self.WriteJournal('2021-03-14T15 - 1 1234 770123 15 77 3 120 411 1502\n' +
+                          'garbage\n' +
+                          '2021-03-14T15 - x 1 2 3 4 5 6 7 8\n' +
+                          '2021-02-30T15 - 1 1 2 3 4 5 6 7 8\n' +
+                          '2021-03-14T15 - 2 1234 555 15 77 3 120 411 1502\n')
+        measurement = self.Replay()
+        self.assertEqual(measurement[None][1]['total'], 770123)
+        self.assertEqual(measurement[None][2]['total'], 555)
+
+    def test_replay_unknown_device(self):
+        self.WriteJournal('2021-03-14T15 gas 1 1234 770123 15 77 3 120 411 1502\n')
+        measurement = self.Replay({'water': {}})
+        self.assertEqual(measurement, {'water': {}})
+
+    def test_replay_old_record(self):
+        # Records of older versions have only a date and the counters up to 'yesterday'
+        self.WriteJournal('2021-03-14 - 1 1234 770123 15 77\n')
+        measurement = self.Replay()
+        self.assertEqual(measurement[None][1], {'pulsecount': 1234, 'total': 770123, 'today': 15, 'yesterday': 77})
+        self.assertEqual(measurement[None]['date'], DATE)
+        self.assertFalse('hour' in measurement[None])
+
+    def test_replay_without_journal(self):
+        self.assertEqual(self.Journal().Replay({None: {}}), 0)
+
+    # --------------------------------------------------------------------------------
+    # Compaction
+    # --------------------------------------------------------------------------------
+    def test_compact(self):
+        measurementjournal = self.Journal()
+        measurementjournal.Append(None, DATE, [Snapshot(1, 100)])
+        measurementjournal.Compact({'date': DATE, 1: {'total': 100}})
+
+        with open(self.measurementname, 'r') as f:
+            self.assertEqual(yaml.safe_load(f), {'date': DATE, 1: {'total': 100}})
+        self.assertEqual(os.path.getsize(self.journalname), 0)
+        self.assertEqual(measurementjournal.Size(), 0)
+        self.assertFalse(os.path.exists(self.measurementname + '.tmp'))
+
+        # The next records are appended to the new journal
+        measurementjournal.Append(None, DATE, [Snapshot(1, 101)])
+        measurementjournal.Close()
+        self.assertEqual(self.Replay()[None][1]['total'], 101)
+
+    def test_compact_failed_write(self):
+        with open(self.measurementname, 'w') as f:
+            f.write('1:\n  total: 5\n')
+        measurementjournal = self.Journal()
+        measurementjournal.Append(None, DATE, [Snapshot(1, 100)])
+
+        # E.g. the disk is full, or a crash before the rename
+        with unittest.mock.patch('os.replace', side_effect=OSError('No space left on device')):
+            with self.assertRaises(OSError):
+                measurementjournal.Compact({1: {'total': 100}})
+        measurementjournal.Close()
+
+        # The old file is untouched and the journal still has the changes
+        with open(self.measurementname, 'r') as f:
+            self.assertEqual(f.read(), '1:\n  total: 5\n')
+        self.assertEqual(self.Replay()[None][1]['total'], 100)
+
+    def test_compact_failed_sync(self):
+        with open(self.measurementname, 'w') as f:
+            f.write('1:\n  total: 5\n')
+        measurementjournal = self.Journal()
+        measurementjournal.Append(None, DATE, [Snapshot(1, 100)])
+
+        # The temporary file can't be written to disk, it is never renamed
+        with unittest.mock.patch('os.fsync', side_effect=OSError('Input/output error')):
+            with self.assertRaises(OSError):
+                measurementjournal.Compact({1: {'total': 100}})
+        measurementjournal.Close()
+
+        with open(self.measurementname, 'r') as f:
+            self.assertEqual(f.read(), '1:\n  total: 5\n')
+        self.assertEqual(self.Replay()[None][1]['total'], 100)
+
+    def test_need_compact(self):
+        measurementjournal = self.Journal(compact_interval=3600, compact_size=150)
+        self.assertFalse(measurementjournal.NeedCompact())
+
+        measurementjournal.Append(None, DATE, [Snapshot(1, 100)])
+        self.assertFalse(measurementjournal.NeedCompact())
+
+        measurementjournal.Append(None, DATE, [Snapshot(1, 101), Snapshot(2, 200), Snapshot(3, 300)])
+        self.assertTrue(measurementjournal.NeedCompact())
+
+        measurementjournal.Compact({})
+        self.assertFalse(measurementjournal.NeedCompact())
+        measurementjournal.Close()
+
+    def test_need_compact_interval(self):
+        measurementjournal = self.Journal(compact_interval=0, compact_size=65536)
+        self.assertFalse(measurementjournal.NeedCompact())
+        measurementjournal.Append(None, DATE, [Snapshot(1, 100)])
+        self.assertTrue(measurementjournal.NeedCompact())
+        measurementjournal.Close()
+
+if __name__ == '__main__':
+    unittest.main()
+
+# End
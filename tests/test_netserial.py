@@ -0,0 +1,134 @@
+
+import os
+import sys
+import time
+import select
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmark'))
+
+import serial
+import netserial
+import harness
+
+"""
+Tests of the network serialports (app/netserial.py), against the local ser2net stand-in of the
+benchmark (harness.TcpServer)
+
+Usage: python -m unittest discover tests
+"""
+
+def Device(port, id):
+    return {'port': port, 'id': id, 'baudrate': 9600, 'parity': 'E', 'stopbits': 1, 'bytesize': 7, 'keepalive': 60}
+
+# ------------------------------------------------------------------------------------
+# Read the lines of a channel, like the serialport reader does. Stops after 'count'
+# lines or the timeout, an end-of-file raises a SerialException.
+# ------------------------------------------------------------------------------------
+def ReadLines(channel, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    buffer = b''
+    while buffer.count(b'\n') < count:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if len(select.select([channel.fileno()], [], [], remaining)[0]) > 0:
+            buffer += channel.read(channel.in_waiting)
+    return buffer.splitlines()
+
+class TestNetworkSerial(unittest.TestCase):
+
+    def setUp(self):
+        self.server = harness.TcpServer()
+        self.pool = netserial.SerialPool()
+        self.channels = []
+
+    def tearDown(self):
+        for channel in self.channels:
+            channel.close()
+        self.server.Close()
+
+    def Open(self, id):
+        channel = self.pool.Open(Device(self.server.port, id))
+        self.channels.append(channel)
+        return channel
+
+    def test_demultiplex(self):
+        first = self.Open('8000')
+        second = self.Open('8001')
+        every = self.Open(None)
+        self.assertTrue(self.server.WaitClient())
+
+        devices = [self.server.Device(8000, 2), self.server.Device(8001, 5)]
+        devices[0].Header()
+        devices[1].Header()
+        for i in range(3):
+            devices[0].Telegram()
+            devices[1].Telegram()
+
+        lines = ReadLines(first, 4)
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[0], b'/8000:S0 Pulse Counter V0.6 - 30/30/30/30/30ms')
+        self.assertTrue(all([netserial.LineId(line) == '8000' for line in lines]))
+
+        lines = ReadLines(second, 4)
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(all([netserial.LineId(line) == '8001' for line in lines]))
+        self.assertEqual(lines[-1].count(b':'), 18)
+
+        # A device without an ID receives all lines, in the original order
+        lines = ReadLines(every, 8)
+        self.assertEqual([netserial.LineId(line) for line in lines], ['8000', '8001'] * 4)
+
+        # All devices share a single connection
+        self.assertEqual(self.server.connects, 1)
+
+    def test_reconnect(self):
+        channel = self.Open('8000')
+        self.assertTrue(self.server.WaitClient())
+
+        device = self.server.Device(8000, 5)
+        device.Telegram()
+        self.assertEqual(len(ReadLines(channel, 1)), 1)
+
+        # The connection is gone, the device reads an end-of-file
+        self.server.Disconnect()
+        with self.assertRaises(serial.SerialException):
+            ReadLines(channel, 1)
+        channel.close()
+        self.channels.remove(channel)
+
+        # The device reopens, this makes a new connection
+        channel = self.Open('8000')
+        self.assertTrue(self.server.WaitClient())
+        self.assertEqual(self.server.connects, 2)
+
+        device.Telegram()
+        lines = ReadLines(channel, 1)
+        self.assertEqual(len(lines), 1)
+        # The total of input 1 is the sequence number of the telegram
+        self.assertEqual(lines[0].split(b':')[6], b'2')
+
+    def test_close_last_channel(self):
+        first = self.Open('8000')
+        second = self.Open('8001')
+        self.assertTrue(self.server.WaitClient())
+
+        # The connection stays open for the other device
+        first.close()
+        self.channels.remove(first)
+        self.server.Device(8001, 5).Telegram()
+        self.assertEqual(len(ReadLines(second, 1)), 1)
+
+        # Without devices the connection is closed, a new device connects again
+        second.close()
+        self.channels.remove(second)
+        self.Open('8001')
+        self.assertTrue(self.server.WaitClient())
+        self.assertEqual(self.server.connects, 2)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# End
@@ -0,0 +1,200 @@
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import outbox
+
+"""
+Tests of the MQTT outbox (app/outbox.py): the order of the publishes, the acknowledges, the rewind
+after a reconnect and the recovery after a restart
+
+Usage: python -m unittest discover tests
+"""
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'outbox.bin')
+        self.outboxes = []
+
+    def tearDown(self):
+        for item in self.outboxes:
+            item.Close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def Open(self, max_size=1024 * 1024):
+        item = outbox.Outbox(self.filename, max_size)
+        self.outboxes.append(item)
+        return item
+
+    def Fill(self, item, count, start=1):
+        for value in range(start, start + count):
+            item.Append(1000 + value, 't/1/total', str(value).encode('ascii'), True)
+
+    # Send all publishes, returns the (position, payload) of each
+    def Send(self, item):
+        sent = []
+        while True:
+            record = item.Next()
+            if record == None:
+                return sent
+            sent.append((record[0], record[3]))
+
+    def test_order(self):
+        item = self.Open()
+        self.Fill(item, 3)
+        self.assertEqual(item.count, 3)
+
+        record = item.Next()
+        self.assertEqual(record[1:], (1001, 't/1/total', b'1', True))
+        self.assertEqual([payload for position, payload in self.Send(item)], [b'2', b'3'])
+        self.assertIsNone(item.Next())
+
+    def test_ack(self):
+        item = self.Open()
+        self.Fill(item, 3)
+        sent = self.Send(item)
+
+        item.Ack(sent[0][0])
+        self.assertEqual(item.count, 2)
+
+        # An acknowledge out of order only moves the head when the older ones are acknowledged
+        item.Ack(sent[2][0])
+        self.assertEqual(item.count, 2)
+        item.Ack(sent[1][0])
+        self.assertEqual(item.count, 0)
+
+        # An empty outbox is truncated to its header
+        self.assertEqual(os.path.getsize(self.filename), outbox.HEADER.size)
+
+    def test_ack_twice(self):
+        item = self.Open()
+        self.Fill(item, 2)
+        sent = self.Send(item)
+        item.Ack(sent[0][0])
+        item.Ack(sent[0][0])
+        self.assertEqual(item.count, 1)
+
+    def test_rewind_after_reconnect(self):
+        item = self.Open()
+        self.Fill(item, 4)
+        sent = self.Send(item)
+
+        # Only the first and third are acknowledged before the connection is lost
+        item.Ack(sent[0][0])
+        item.Ack(sent[2][0])
+        item.Rewind()
+
+        # The publishes which are not removed are send again, in order (at least once)
+        self.assertEqual([payload for position, payload in self.Send(item)], [b'2', b'3', b'4'])
+        self.assertEqual(item.count, 3)
+
+    def test_rewind_new_publishes(self):
+        item = self.Open()
+        self.Fill(item, 2)
+        sent = self.Send(item)
+        item.Ack(sent[0][0])
+
+        # Disconnected, new publishes are appended after the ones in flight
+        self.Fill(item, 2, start=3)
+        item.Rewind()
+        sent = self.Send(item)
+        self.assertEqual([payload for position, payload in sent], [b'2', b'3', b'4'])
+
+        for position, payload in sent:
+            item.Ack(position)
+        self.assertEqual(item.count, 0)
+
+    def test_restart(self):
+        item = self.Open()
+        self.Fill(item, 3)
+        sent = self.Send(item)
+        item.Ack(sent[0][0])
+        item.Close()
+
+        # After a restart the not acknowledged publishes are send again
+        item = self.Open()
+        self.assertEqual(item.count, 2)
+        self.assertEqual([payload for position, payload in self.Send(item)], [b'2', b'3'])
+
+    def test_restart_torn_last_record(self):
+        item = self.Open()
+        self.Fill(item, 2)
+        item.Close()
+
+        # E.g. a power failure during the append of a publish
+        with open(self.filename, 'ab') as f:
+            f.write(outbox.RECORD.pack(0, 0, 9, 3) + b't/1/t')
+        size = os.path.getsize(self.filename)
+
+        item = self.Open()
+        self.assertEqual(item.count, 2)
+        self.assertEqual([payload for position, payload in self.Send(item)], [b'1', b'2'])
+        self.assertLess(os.path.getsize(self.filename), size)
+
+        # New publishes are appended after the last complete record
+        self.Fill(item, 1, start=3)
+        self.assertEqual([payload for position, payload in self.Send(item)], [b'3'])
+
+    def test_invalid_file(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'garbage, not an outbox')
+        item = self.Open()
+        self.assertEqual(item.count, 0)
+        self.assertIsNone(item.Next())
+
+    def test_full(self):
+        # The oldest publishes are dropped, the newest are kept
+        item = self.Open(max_size=200)
+        self.Fill(item, 20)
+        self.assertGreater(item.dropped, 0)
+        self.assertEqual(item.count + item.dropped, 20)
+
+        payloads = [payload for position, payload in self.Send(item)]
+        self.assertEqual(payloads[-1], b'20')
+        self.assertEqual(payloads, [str(value).encode('ascii') for value in range(21 - len(payloads), 21)])
+
+    def test_compaction(self):
+        # The space of the acknowledged publishes is reclaimed when nothing is in flight,
+        # e.g. with a window of 2 publishes and new publishes arriving while draining
+        item = self.Open(max_size=400)
+        self.Fill(item, 1)
+        for round in range(40):
+            self.Fill(item, 2, start=round * 2 + 2)
+            sent = [item.Next()[0], item.Next()[0]]
+            for position in sent:
+                item.Ack(position)
+
+        self.assertEqual(item.count, 1)
+        self.assertEqual(item.dropped, 0)
+        self.assertLess(os.path.getsize(self.filename), 400 + outbox.HEADER.size)
+        self.assertEqual([payload for position, payload in self.Send(item)], [b'81'])
+
+        # The records are still found after a restart
+        item.Close()
+        self.assertEqual([payload for position, payload in self.Send(self.Open(max_size=400))], [b'81'])
+
+    def test_stale_position(self):
+        item = self.Open()
+        self.Fill(item, 2)
+        sent = self.Send(item)
+        for position, payload in sent:
+            item.Ack(position)
+
+        # The empty outbox is reset, the new publish is at the offset of the first one. The
+        # (late) acknowledge of the old position doesn't remove it.
+        self.Fill(item, 1, start=3)
+        item.Ack(sent[0][0])
+        self.assertEqual(item.count, 1)
+        self.assertEqual([payload for position, payload in self.Send(item)], [b'3'])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# End
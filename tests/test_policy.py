@@ -0,0 +1,153 @@
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import policy
+
+"""
+Tests of the publish policies (app/policy.py): the deadband, coalescing with a minimum interval and
+the heartbeat of a maximum interval
+
+Usage: python -m unittest discover tests
+"""
+
+DEFAULTS = {'deadband': 0, 'deadband_percent': 0, 'min_interval': 0, 'max_interval': None}
+SCOPE = (None, 1, 'total')
+
+def Filter(**settings):
+    fixed = policy.PublishPolicy(**dict(DEFAULTS, **settings))
+    return policy.PublishFilter(lambda device, key, subkey: fixed)
+
+class TestResolve(unittest.TestCase):
+
+    def test_nothing_configured(self):
+        self.assertIsNone(policy.Resolve(DEFAULTS, None, 1, 'total'))
+        self.assertIsNone(policy.Resolve(DEFAULTS, {1: None, 2: {'deadband': 5}}, 1, 'total'))
+
+    def test_defaults(self):
+        result = policy.Resolve(dict(DEFAULTS, min_interval=10), None, 1, 'total')
+        self.assertEqual(result, policy.PublishPolicy(0, 0, 10, None))
+
+    def test_input_and_subkey(self):
+        inputs = {'1': {'deadband': 5, 'max_interval': 60, 'rate_1m': {'deadband': 0.5}}}
+        self.assertEqual(policy.Resolve(DEFAULTS, inputs, 1, 'total'), policy.PublishPolicy(5, 0, 0, 60))
+        self.assertEqual(policy.Resolve(DEFAULTS, inputs, 1, 'rate_1m'), policy.PublishPolicy(0.5, 0, 0, 60))
+        self.assertIsNone(policy.Resolve(DEFAULTS, inputs, 2, 'total'))
+
+class TestPublishFilter(unittest.TestCase):
+
+    def test_without_policy(self):
+        publishfilter = policy.PublishFilter(lambda device, key, subkey: None)
+        for now in range(3):
+            self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 100, 100, now))
+        self.assertEqual(publishfilter.Due(100, flush=True), [])
+        self.assertIsNone(publishfilter.NextDue(100))
+
+    # --------------------------------------------------------------------------------
+    # Deadband
+    # --------------------------------------------------------------------------------
+    def test_deadband(self):
+        publishfilter = Filter(deadband=5)
+        self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 100, 100, 0))
+        self.assertFalse(publishfilter.Offer(SCOPE, 't/1/total', 104, 104, 1))
+        self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 105, 105, 2))
+
+        # The deadband is relative to the last published value, not the last offered one
+        self.assertFalse(publishfilter.Offer(SCOPE, 't/1/total', 101, 101, 3))
+        self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 100, 100, 4))
+
+        # Nothing is held back, a value within the deadband is dropped
+        self.assertEqual(publishfilter.Due(100, flush=True), [])
+
+    def test_deadband_percent(self):
+        publishfilter = Filter(deadband_percent=10)
+        self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 200, 200, 0))
+        self.assertFalse(publishfilter.Offer(SCOPE, 't/1/total', 219, 219, 1))
+        self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 220, 220, 2))
+
+    # --------------------------------------------------------------------------------
+    # Minimum interval, the values in between are coalesced
+    # --------------------------------------------------------------------------------
+    def test_coalesce(self):
+        publishfilter = Filter(min_interval=10)
+        self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 100, b'100', 0))
+        self.assertFalse(publishfilter.Offer(SCOPE, 't/1/total', 101, b'101', 1))
+        self.assertFalse(publishfilter.Offer(SCOPE, 't/1/total', 102, b'102', 2))
+        self.assertEqual(publishfilter.NextDue(2), 8)
+
+        # Only the latest value is published, when the interval has passed
+        self.assertEqual(publishfilter.Due(9), [])
+        self.assertEqual(publishfilter.Due(10), [('t/1/total', b'102')])
+        self.assertEqual(publishfilter.Due(11), [])
+        self.assertIsNone(publishfilter.NextDue(11))
+
+        # The interval starts again at the coalesced publish
+        self.assertFalse(publishfilter.Offer(SCOPE, 't/1/total', 103, b'103', 15))
+        self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 104, b'104', 20))
+
+    def test_coalesce_back_in_deadband(self):
+        publishfilter = Filter(deadband=5, min_interval=10)
+        self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 100, 100, 0))
+        self.assertFalse(publishfilter.Offer(SCOPE, 't/1/total', 110, 110, 1))
+
+        # The value is back within the deadband of the published value, nothing is pending
+        self.assertFalse(publishfilter.Offer(SCOPE, 't/1/total', 102, 102, 2))
+        self.assertEqual(publishfilter.Due(10), [])
+
+    def test_coalesce_topics(self):
+        publishfilter = Filter(min_interval=10)
+        for key in [1, 2]:
+            self.assertTrue(publishfilter.Offer((None, key, 'total'), 't/' + str(key) + '/total', 0, 0, 0))
+            self.assertFalse(publishfilter.Offer((None, key, 'total'), 't/' + str(key) + '/total', key, key, 5))
+        self.assertEqual(sorted(publishfilter.Due(10)), [('t/1/total', 1), ('t/2/total', 2)])
+
+    def test_flush(self):
+        # E.g. at shutdown, the coalesced values are not lost
+        publishfilter = Filter(min_interval=60)
+        publishfilter.Offer(SCOPE, 't/1/total', 100, 100, 0)
+        publishfilter.Offer(SCOPE, 't/1/total', 101, 101, 1)
+        self.assertEqual(publishfilter.Due(2), [])
+        self.assertEqual(publishfilter.Due(2, flush=True), [('t/1/total', 101)])
+        self.assertEqual(publishfilter.Due(2, flush=True), [])
+
+    # --------------------------------------------------------------------------------
+    # Maximum interval (heartbeat)
+    # --------------------------------------------------------------------------------
+    def test_heartbeat(self):
+        publishfilter = Filter(deadband=5, max_interval=60)
+        self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 100, 100, 0))
+        self.assertEqual(publishfilter.NextDue(0), 60)
+
+        # The last offered value is published again, also within the deadband
+        self.assertFalse(publishfilter.Offer(SCOPE, 't/1/total', 101, 101, 30))
+        self.assertEqual(publishfilter.Due(59), [])
+        self.assertEqual(publishfilter.Due(60), [('t/1/total', 101)])
+        self.assertEqual(publishfilter.NextDue(60), 60)
+        self.assertEqual(publishfilter.Due(120), [('t/1/total', 101)])
+
+    def test_heartbeat_offer(self):
+        publishfilter = Filter(deadband=5, max_interval=60)
+        self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 100, 100, 0))
+        self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 100, 100, 60))
+
+        # A publish restarts the heartbeat interval
+        self.assertEqual(publishfilter.Due(100), [])
+        self.assertEqual(publishfilter.Due(120), [('t/1/total', 100)])
+
+    def test_reset(self):
+        publishfilter = Filter(deadband=5, min_interval=10)
+        publishfilter.Offer(SCOPE, 't/1/total', 100, 100, 0)
+        publishfilter.Offer(SCOPE, 't/1/total', 110, 110, 1)
+
+        # E.g. after a reload, the next value is published as the first value
+        publishfilter.Reset()
+        self.assertEqual(publishfilter.Due(100, flush=True), [])
+        self.assertTrue(publishfilter.Offer(SCOPE, 't/1/total', 101, 101, 2))
+
+if __name__ == '__main__':
+    unittest.main()
+
+# End
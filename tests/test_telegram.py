@@ -0,0 +1,131 @@
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import telegram
+
+"""
+Tests of the S0PCM telegram parser (app/telegram.py)
+
+Usage: python -m unittest discover tests
+"""
+
+S0PCM5 = b'ID:8237:I:10:M1:1:100:M2:0:200:M3:2:300:M4:0:400:M5:3:500\r\n'
+S0PCM2 = b'ID:8237:I:10:M1:1:100:M2:0:200\r\n'
+HEADER = b'/8237:S0 Pulse Counter V0.6 - 30/30/30/30/30ms\r\n'
+
+class TestTelegramParser(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = telegram.TelegramParser()
+
+    def assertInvalid(self, datain):
+        with self.assertRaises(telegram.TelegramError):
+            self.parser.Parse(datain)
+
+    # --------------------------------------------------------------------------------
+    # Valid records
+    # --------------------------------------------------------------------------------
+    def test_s0pcm5(self):
+        result = self.parser.Parse(S0PCM5)
+        self.assertIsInstance(result, telegram.Telegram)
+        self.assertEqual(result.id, '8237')
+        self.assertEqual(result.interval, 10)
+        self.assertEqual(result.size, 5)
+        self.assertEqual(result.pulses, (1, 0, 2, 0, 3))
+        self.assertEqual(result.totals, (100, 200, 300, 400, 500))
+
+    def test_s0pcm2(self):
+        result = self.parser.Parse(S0PCM2)
+        self.assertIsInstance(result, telegram.Telegram)
+        self.assertEqual(result.size, 2)
+        self.assertEqual(result.pulses, (1, 0))
+        self.assertEqual(result.totals, (100, 200))
+
+    def test_header(self):
+        result = self.parser.Parse(HEADER)
+        self.assertIsInstance(result, telegram.Header)
+        self.assertEqual(result.id, '8237')
+        self.assertEqual(result.version, 'S0 Pulse Counter V0.6 - 30/30/30/30/30ms')
+
+    def test_line_endings(self):
+        for ending in [b'', b'\n', b'\r\n', b'\r\r\n']:
+            result = self.parser.Parse(S0PCM2.rstrip(b'\r\n') + ending)
+            self.assertEqual(result.totals, (100, 200))
+
+    def test_empty_line(self):
+        self.assertIsNone(self.parser.Parse(b''))
+        self.assertIsNone(self.parser.Parse(b'\r\n'))
+        self.assertIsNone(self.parser.Parse(b'\n'))
+
+    def test_large_counts(self):
+        result = self.parser.Parse(b'ID:8237:I:10:M1:0:18446744073709551615:M2:0:0\r\n')
+        self.assertEqual(result.totals[0], 18446744073709551615)
+
+    # --------------------------------------------------------------------------------
+    # Invalid records
+    # --------------------------------------------------------------------------------
+    def test_wrong_id_marker(self):
+        self.assertInvalid(b'XD:8237:I:10:M1:1:100:M2:0:200\r\n')
+        self.assertInvalid(b'id:8237:I:10:M1:1:100:M2:0:200\r\n')
+
+    def test_invalid_id(self):
+        self.assertInvalid(b'ID:82a7:I:10:M1:1:100:M2:0:200\r\n')
+        self.assertInvalid(b'ID::I:10:M1:1:100:M2:0:200\r\n')
+
+    def test_wrong_interval_marker(self):
+        self.assertInvalid(b'ID:8237:X:10:M1:1:100:M2:0:200\r\n')
+
+    def test_wrong_input_markers(self):
+        self.assertInvalid(b'ID:8237:I:10:M2:1:100:M1:0:200\r\n')
+        self.assertInvalid(b'ID:8237:I:10:M1:1:100:M2:0:200:M3:2:300:M4:0:400:M6:3:500\r\n')
+        self.assertInvalid(b'ID:8237:I:10:m1:1:100:m2:0:200\r\n')
+
+    def test_wrong_field_count(self):
+        # One field too few or too many, and the size of neither a S0PCM-2 nor a S0PCM-5
+        self.assertInvalid(b'ID:8237:I:10:M1:1:100:M2:0\r\n')
+        self.assertInvalid(b'ID:8237:I:10:M1:1:100:M2:0:200:7\r\n')
+        self.assertInvalid(b'ID:8237:I:10:M1:1:100:M2:0:200:M3:2:300\r\n')
+
+    def test_negative_counts(self):
+        self.assertInvalid(b'ID:8237:I:10:M1:-1:100:M2:0:200\r\n')
+        self.assertInvalid(b'ID:8237:I:10:M1:1:-100:M2:0:200\r\n')
+
+    def test_non_digit_counts(self):
+        self.assertInvalid(b'ID:8237:I:10:M1:x:100:M2:0:200\r\n')
+        self.assertInvalid(b'ID:8237:I:10:M1:1:10a:M2:0:200\r\n')
+        self.assertInvalid(b'ID:8237:I:10:M1:1::M2:0:200\r\n')
+        self.assertInvalid(b'ID:8237:I:1x:M1:1:100:M2:0:200\r\n')
+
+        # Accepted by int(), but never send by a S0PCM
+        self.assertInvalid(b'ID:8237:I:10:M1:+1:100:M2:0:200\r\n')
+        self.assertInvalid(b'ID:8237:I:10:M1:1: 100:M2:0:200\r\n')
+        self.assertInvalid(b'ID:8237:I:10:M1:1:1_000:M2:0:200\r\n')
+
+    def test_partial_lines(self):
+        # E.g. the reader is started in the middle of a telegram, or the line is cut off
+        self.assertInvalid(S0PCM5[:20])
+        self.assertInvalid(S0PCM5[10:])
+        self.assertInvalid(b'ID:8237:I:10:M1:1:100:M2:0:')
+        self.assertInvalid(b':8237:I:10:M1:1:100:M2:0:200\r\n')
+
+    def test_invalid_header(self):
+        self.assertInvalid(b'/8237 S0 Pulse Counter\r\n')
+        self.assertInvalid(b'/82a7:S0 Pulse Counter\r\n')
+        self.assertInvalid(b'/8237:S0 Pulse Counter \xff\r\n')
+
+    def test_garbage(self):
+        self.assertInvalid(b'\x00\x13\x11\r\n')
+        self.assertInvalid(b'S0 Pulse Counter\r\n')
+
+    def test_parser_continues_after_error(self):
+        self.assertInvalid(b'ID:8237:I:10:M1:x:100:M2:0:200\r\n')
+        self.assertEqual(self.parser.Parse(S0PCM2).totals, (100, 200))
+
+if __name__ == '__main__':
+    unittest.main()
+
+# End